@@ -15,6 +15,17 @@ st.set_page_config(
 )
 
 if 'node' not in st.session_state:
-    st.session_state.node = OnionNode(bind_ip='0.0.0.0')
+    st.session_state.node = OnionNode(
+        bind_ip='0.0.0.0',
+        engine=os.getenv("ONION_RELAY_ENGINE", "threaded"),
+        peel_workers=int(os.getenv("ONION_PEEL_WORKERS", "0")),
+        circuit_lifetime=int(os.getenv("ONION_CIRCUIT_LIFETIME", "300")),
+        circuit_max_messages=int(os.getenv("ONION_CIRCUIT_MAX_MESSAGES", "1000")),
+        path_bias=float(os.getenv("ONION_PATH_BIAS", "0.5")),
+        weight_cap=float(os.getenv("ONION_RELAY_WEIGHT_CAP", "4")),
+        coalesce_delay=float(os.getenv("ONION_COALESCE_DELAY_MS", "0")) / 1000,
+        multipath=int(os.getenv("ONION_MULTIPATH", "1")),
+        multipath_parity=int(os.getenv("ONION_MULTIPATH_PARITY", "0"))
+    )
 
 render_dashboard(st.session_state.node)
\ No newline at end of file
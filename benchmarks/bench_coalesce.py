@@ -0,0 +1,76 @@
+"""
+Write coalescing: small-frame throughput and send syscalls per frame.
+
+Senders push FRAMES small frames (chat / who_has sized) through one pooled
+link to a local sink, once per coalescing deadline: back to back, and in
+bursts of BURST frames with a short pause between them (a chat broadcast
+or who_has flood). Syscalls are counted at the Connection (each
+sendmsg/sendall); throughput is measured until the sink has read every frame.
+
+Run from the repo root: python -m benchmarks.bench_coalesce [frames] [senders]
+"""
+import os
+import sys
+import socket
+import threading
+import time
+from core.transport import ConnectionPool, serve_frames
+
+FRAMES = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+SENDERS = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+DEADLINES_MS = [0, 0.2, 1, 5]
+BURST = 16
+BURST_PAUSE = 0.002
+PAYLOAD = os.urandom(200)
+
+def sink(sock, counter):
+    def on_frame(data):
+        counter[0] += 1
+    while True:
+        conn, _ = sock.accept()
+        threading.Thread(target=serve_frames, args=(conn, on_frame), daemon=True).start()
+
+def run(deadline_ms, senders, burst=None):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(16)
+    port = sock.getsockname()[1]
+    received = [0]
+    threading.Thread(target=sink, args=(sock, received), daemon=True).start()
+
+    pool = ConnectionPool(coalesce_delay=deadline_ms / 1000)
+    conn = pool.get('127.0.0.1', port)
+    per_sender = FRAMES // senders
+
+    def sender():
+        for i in range(per_sender):
+            pool.send('127.0.0.1', port, PAYLOAD)
+            if burst and i % burst == burst - 1:
+                time.sleep(BURST_PAUSE)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=sender) for _ in range(senders)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    total = per_sender * senders
+    while received[0] < total and time.perf_counter() - start < 60:
+        time.sleep(0.001)
+    elapsed = time.perf_counter() - start
+
+    print(f"  deadline {deadline_ms:>4} ms: {received[0] / elapsed:>9.0f} frames/s, "
+          f"{conn.writes:>6} syscalls ({conn.writes / total:.3f} per frame)")
+    pool.close_all()
+    sock.close()
+
+def main():
+    print(f"{FRAMES} frames of {len(PAYLOAD)} B over one link")
+    for senders in sorted({1, SENDERS}):
+        print(f"{senders} sender thread(s), back to back:")
+        for deadline in DEADLINES_MS:
+            run(deadline, senders)
+        print(f"{senders} sender thread(s), bursts of {BURST}:")
+        for deadline in DEADLINES_MS:
+            run(deadline, senders, BURST)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Codec benchmark: bytes-on-wire and CPU per hop for a 3-hop circuit carrying
+one 64 KB torrent chunk, JSON codec vs binary codec (bin1).
+
+Run from the repo root: python -m benchmarks.bench_codec
+"""
+import os
+import time
+from types import SimpleNamespace
+from core.compression import Compressor
+from core.crypto import generate_rsa_keypair, sym_decrypt
+from core.circuit import Circuit, CircuitManager
+from core.protocol import (serialize, deserialize, unpack_payload,
+                           CODEC_JSON, CODEC_BINARY, MSG_CELL)
+
+ROUNDS = 200
+
+def make_path(codec, keys):
+    return [{"host": "127.0.0.1", "port": 6000 + i, "pub_key": pub, "codecs": [codec]}
+            for i, (_, pub) in enumerate(keys)]
+
+def chunk_payload():
+    return {"module": "torrent", "payload": {
+        "action": "chunk", "hash": "0" * 16, "index": 7,
+        "data": os.urandom(64 * 1024), "holder_fp": "f" * 64
+    }}
+
+def bench_cells(codec, keys):
+    mgr = CircuitManager(node=SimpleNamespace(compressor=Compressor()), warm=False)
+    circuit = Circuit(make_path(codec, keys))
+    cell = mgr.wrap_cell(chunk_payload(), circuit)
+
+    wire_bytes = []
+    hop_seconds = [0.0] * len(circuit.path)
+    for _ in range(ROUNDS):
+        current = cell
+        for hop, key in enumerate(circuit.hop_keys):
+            frame = serialize(MSG_CELL, current, codec)
+            if len(wire_bytes) < len(circuit.path):
+                wire_bytes.append(len(frame) + 4)
+            start = time.perf_counter()
+            packet = deserialize(frame)
+            inner = sym_decrypt(key, packet['payload']['data'])
+            if hop == len(circuit.path) - 1:
+                unpack_payload(inner)
+            else:
+                current = {"circ_id": circuit.hop_ids[hop + 1], "data": inner}
+                serialize(MSG_CELL, current, codec)
+            hop_seconds[hop] += time.perf_counter() - start
+    return wire_bytes, [s / ROUNDS * 1e6 for s in hop_seconds]
+
+def main():
+    keys = [generate_rsa_keypair() for _ in range(3)]
+    payload_size = 64 * 1024
+    print(f"Payload: {payload_size} byte chunk, 3 hops, {ROUNDS} rounds")
+
+    results = {}
+    for codec in (CODEC_JSON, CODEC_BINARY):
+        results[codec] = bench_cells(codec, keys)
+        wire, micros = results[codec]
+        print(f"\nCIRC_CELL / {codec}:")
+        print("  bytes on wire per hop: " + ", ".join(str(b) for b in wire))
+        print("  CPU per hop (us):      " + ", ".join(f"{m:.0f}" for m in micros))
+
+    (jw, jm), (bw, bm) = results[CODEC_JSON], results[CODEC_BINARY]
+    print("\nSaved per hop by bin1 vs json:")
+    for hop in range(len(jw)):
+        print(f"  hop {hop}: {jw[hop] - bw[hop]} bytes ({1 - bw[hop] / jw[hop]:.0%}), "
+              f"{jm[hop] - bm[hop]:.0f} us")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+Exit fetcher: upstream requests, TCP connections and wall time for proxy
+fetches, bare requests.get (the old exit path) vs ExitFetcher.
+
+A local HTTP/1.1 server stands in for the web. Each response takes
+SERVER_DELAY to start, and the server counts requests and accepted connections.
+Workloads:
+- popular: REQUESTS fetches spread over a few cacheable URLs (max-age)
+- burst: CONCURRENCY simultaneous fetches of one no-store URL
+- distinct: REQUESTS fetches of distinct no-store URLs (connection reuse only)
+CONCURRENCY client threads each issue their next fetch when the previous
+one has been read, so at most that many are outstanding.
+
+Run from the repo root: python -m benchmarks.bench_exit_fetcher [requests]
+"""
+import sys
+import random
+import threading
+import time
+import http.server
+import requests
+from modules.http_fetcher import ExitFetcher
+
+REQUESTS = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+CONCURRENCY = 32
+POPULAR_URLS = 10
+BODY = 64 * 1024
+BURST_BODY = 1024 * 1024
+SERVER_DELAY = 0.05
+
+class Upstream(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), Handler)
+        self.requests = 0
+        self.connections = 0
+        self.lock = threading.Lock()
+
+    def process_request(self, request, client_address):
+        with self.lock:
+            self.connections += 1
+        super().process_request(request, client_address)
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests += 1
+        time.sleep(SERVER_DELAY)
+        size = BURST_BODY if self.path.startswith("/burst") else BODY
+        self.send_response(200)
+        self.send_header("Content-Length", str(size))
+        self.send_header("Cache-Control", "max-age=60" if self.path.startswith("/popular") else "no-store")
+        self.end_headers()
+        self.wfile.write(b"x" * size)
+
+def bare_fetch(url):
+    """The exit before: a new requests.get per request."""
+    try:
+        with requests.get(url, timeout=5, stream=True) as resp:
+            return sum(len(c) for c in resp.iter_content(64 * 1024))
+    except Exception:
+        return -1
+
+def fetcher_fetch(fetcher):
+    def fetch(url):
+        result = [-1]
+        done = threading.Event()
+
+        def deliver(meta, chunks):
+            result[0] = sum(len(c) for c in chunks) if not meta.get("error") else -1
+            done.set()
+
+        if fetcher.submit(url, deliver):
+            done.wait(60)
+        return result[0]
+    return fetch
+
+def run(label, fetch, urls, server):
+    server.requests = server.connections = 0
+    pending = list(urls)
+    sizes = []
+    lock = threading.Lock()
+
+    def client():
+        while True:
+            with lock:
+                if not pending: return
+                url = pending.pop()
+            size = fetch(url)
+            with lock:
+                sizes.append(size)
+
+    start = time.perf_counter()
+    clients = [threading.Thread(target=client) for _ in range(CONCURRENCY)]
+    for t in clients: t.start()
+    for t in clients: t.join()
+    elapsed = time.perf_counter() - start
+    failed = sum(1 for s in sizes if s <= 0)
+    print(f"  {label:<12} {elapsed:>6.2f} s  {len(urls) / elapsed:>7.1f} req/s  "
+          f"{server.requests:>4} upstream requests  {server.connections:>4} connections"
+          + (f"  {failed} failed" if failed else ""))
+
+def main():
+    server = Upstream()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    rng = random.Random(1)
+    workloads = {
+        "popular": [f"{base}/popular/{rng.randrange(POPULAR_URLS)}" for _ in range(REQUESTS)],
+        "burst": [f"{base}/burst"] * CONCURRENCY,
+        "distinct": [f"{base}/distinct/{i}" for i in range(REQUESTS)],
+    }
+    for name, urls in workloads.items():
+        print(f"{name}: {len(urls)} fetches")
+        run("bare get", bare_fetch, urls, server)
+        run("ExitFetcher", fetcher_fetch(ExitFetcher()), urls, server)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Multipath striping: stream throughput over single circuits vs striped across
+disjoint ones, and completion when one path stalls.
+
+Eight local nodes: a sender, an exit and six middle relays, so three 3-hop
+circuits with disjoint middles fit. Every middle forwards at FAST_MBPS except
+one at SLOW_MBPS (a sleep per forwarded cell). The stream goes first down
+each circuit alone, then striped across all three (no parity, and XOR parity
+over 2 data cells), then striped with parity while one relay drops every cell.
+
+Run from the repo root: python -m benchmarks.bench_multipath [size_mb]
+"""
+import os
+import sys
+import time
+import threading
+from core.overlay import OnionNode
+from core.protocol import MSG_CELL
+
+SIZE = int(float(sys.argv[1]) * 1024 * 1024) if len(sys.argv) > 1 else 8 * 1024 * 1024
+FAST_MBPS = 8
+SLOW_MBPS = 1
+PATHS = 3
+PARITY = 2
+BLOCK = os.urandom(1024 * 1024)
+
+class Sink:
+    """Stream consumer on the exit: counts bytes and signals the end."""
+    def __init__(self):
+        self.done = threading.Event()
+        self.received = 0
+        self.error = None
+
+    def receive(self, payload, reply=None):
+        pass
+
+    def receive_stream(self, meta, stream):
+        try:
+            for chunk in stream:
+                self.received += len(chunk)
+        except (ConnectionError, TimeoutError) as e:
+            self.error = e
+        self.done.set()
+
+def throttle(node, mbps):
+    forward = node.relay._forward
+    def slow_forward(host, port, msg_type, payload, nbytes):
+        time.sleep(nbytes / (mbps * 1024 * 1024))
+        forward(host, port, msg_type, payload, nbytes)
+    node.relay._forward = slow_forward
+
+def blackhole(node):
+    forward = node.relay._forward
+    def drop_cells(host, port, msg_type, payload, nbytes):
+        if msg_type != MSG_CELL:
+            forward(host, port, msg_type, payload, nbytes)
+    node.relay._forward = drop_cells
+
+def chunks():
+    for _ in range(SIZE // len(BLOCK)):
+        yield BLOCK
+    yield BLOCK[:SIZE % len(BLOCK)]
+
+def transfer(sender, exit_node, target, label, **kwargs):
+    sink = exit_node.modules["bench"] = Sink()
+    recovered = exit_node.streams.stats()["recovered"]
+    start = time.perf_counter()
+    sender.send_stream(target, "bench", None, chunks(), **kwargs)
+    sink.done.wait(120)
+    elapsed = time.perf_counter() - start
+    status = "ok" if sink.received == SIZE and not sink.error else f"FAILED ({sink.error or sink.received})"
+    print(f"  {label:<34} {SIZE / elapsed / (1024 * 1024):>6.2f} MB/s  {elapsed:>6.2f} s  "
+          f"rebuilt {exit_node.streams.stats()['recovered'] - recovered:>3}  {status}")
+
+def describe(circuit, slow_id):
+    return "slow relay" if any(f"{p['host']}:{p['port']}" == slow_id for p in circuit.path) else "fast relays"
+
+def main():
+    nodes = [OnionNode(bind_ip="127.0.0.1") for _ in range(8)]
+    for a in nodes:
+        for b in nodes:
+            if a is not b:
+                a.add_peer({"host": "127.0.0.1", "port": b.port, "pub_key": b.pub_key.decode(), "codecs": ["bin1"]})
+    sender, exit_node, middles = nodes[0], nodes[1], nodes[2:]
+    for node in middles[:-1]:
+        throttle(node, FAST_MBPS)
+    throttle(middles[-1], SLOW_MBPS)
+    slow_id = f"127.0.0.1:{middles[-1].port}"
+    target = f"127.0.0.1:{exit_node.port}"
+
+    circuits = sender.circuit_mgr.get_circuits(target, sender.peers[target], PATHS)
+    print(f"{SIZE / (1024 * 1024):g} MB stream, {len(circuits)} disjoint circuits, "
+          f"relays at {FAST_MBPS} MB/s and one at {SLOW_MBPS} MB/s:")
+    for i, circuit in enumerate(circuits):
+        # Pin the circuit as the pooled one for this target
+        sender.circuit_mgr.circuits[target] = circuit
+        transfer(sender, exit_node, target, f"single path {i} ({describe(circuit, slow_id)})", paths=1)
+    transfer(sender, exit_node, target, f"striped x{len(circuits)}", paths=PATHS, parity=0)
+    transfer(sender, exit_node, target, f"striped x{len(circuits)}, parity 1/{PARITY}", paths=PATHS, parity=PARITY)
+
+    stalled = next(c for c in circuits if describe(c, slow_id) == "fast relays")
+    blackhole(next(n for n in middles if f"127.0.0.1:{n.port}" == f"{stalled.path[0]['host']}:{stalled.path[0]['port']}"))
+    transfer(sender, exit_node, target, f"striped x{len(circuits)}, parity, 1 path dead", paths=PATHS, parity=PARITY)
+    per_path = ", ".join(f"{c.cells_sent}" for c in circuits)
+    print(f"cells sent per path over the whole run: {per_path}")
+    sys.stdout.flush()
+    os._exit(0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Relay engine load test: threaded vs asyncio.
+
+A child process opens CLIENTS concurrent links to one relay and sends FRAMES
+cells per link on a circuit whose next hop is a sink in that same child.
+The sink timestamps each cell on arrival (CLOCK_MONOTONIC is shared across
+processes), giving forwarding latency through the relay (decrypt + re-send).
+Load generation lives outside the relay process so it does not compete for
+the relay's GIL.
+
+Run from the repo root: python -m benchmarks.bench_relay_engines [clients] [frames]
+"""
+import os
+import sys
+import socket
+import struct
+import threading
+import time
+import multiprocessing
+from core.overlay import OnionNode
+from core.crypto import generate_session_key, sym_encrypt
+from core.protocol import serialize, deserialize, MSG_CELL, CODEC_BINARY
+from core.transport import serve_frames
+
+CLIENTS = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+FRAMES = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+PADDING = os.urandom(1024)
+
+def sink(sock, latencies, lock):
+    def on_frame(data):
+        inner = deserialize(data)['payload']['data']
+        with lock:
+            latencies.append(time.monotonic() - struct.unpack('>d', inner[:8])[0])
+    while True:
+        conn, _ = sock.accept()
+        threading.Thread(target=serve_frames, args=(conn, on_frame), daemon=True).start()
+
+def client(relay_port, circ_id, key, errors):
+    try:
+        s = socket.create_connection(('127.0.0.1', relay_port), timeout=30)
+        for _ in range(FRAMES):
+            inner = struct.pack('>d', time.monotonic()) + PADDING
+            data = serialize(MSG_CELL, {"circ_id": circ_id, "data": sym_encrypt(key, inner)}, CODEC_BINARY)
+            s.sendall(struct.pack('>I', len(data)) + data)
+        time.sleep(1)
+        s.close()
+    except OSError:
+        errors.append(1)
+
+def load_generator(sink_sock, relay_port, circ_id, key, results):
+    latencies, lock, errors = [], threading.Lock(), []
+    threading.Thread(target=sink, args=(sink_sock, latencies, lock), daemon=True).start()
+
+    start = time.monotonic()
+    threads = [threading.Thread(target=client, args=(relay_port, circ_id, key, errors)) for _ in range(CLIENTS)]
+    for t in threads: t.start()
+    deadline = start + 60
+    while len(latencies) < (CLIENTS - len(errors)) * FRAMES and time.monotonic() < deadline:
+        time.sleep(0.05)
+    elapsed = time.monotonic() - start
+    results.put((sorted(latencies), len(errors), elapsed))
+    results.close()
+    results.join_thread()
+    os._exit(0)
+
+def run(engine):
+    node = OnionNode(bind_ip='127.0.0.1', engine=engine)
+    sink_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sink_sock.bind(('127.0.0.1', 0))
+    sink_sock.listen(128)
+    sink_port = sink_sock.getsockname()[1]
+    node.add_peer({"host": "127.0.0.1", "port": sink_port, "pub_key": node.pub_key, "codecs": [CODEC_BINARY]}, keep=True)
+
+    circ_id, key = os.urandom(8).hex(), generate_session_key()
+    node.relay.circuits[circ_id] = {
+        "key": key, "next_hop": ("127.0.0.1", sink_port),
+        "next_circ_id": "sink", "last_used": time.time()
+    }
+
+    results = multiprocessing.Queue()
+    child = multiprocessing.Process(target=load_generator, args=(sink_sock, node.port, circ_id, key, results))
+    child.start()
+    peak_threads = 0
+    while results.empty():
+        peak_threads = max(peak_threads, threading.active_count())
+        time.sleep(0.05)
+    lat, errors, elapsed = results.get()
+    child.join()
+
+    expected = CLIENTS * FRAMES
+    p = lambda q: lat[min(len(lat) - 1, int(q * len(lat)))] * 1000 if lat else float('nan')
+    print(f"{engine:>9}: {CLIENTS} concurrent links, {len(lat)}/{expected} cells forwarded, "
+          f"{errors} failed links, {len(lat) / elapsed:.0f} cells/s, "
+          f"p50 {p(0.50):.1f} ms, p99 {p(0.99):.1f} ms, relay threads peak {peak_threads}")
+
+def main():
+    multiprocessing.set_start_method('fork')
+    for engine in ("threaded", "asyncio"):
+        run(engine)
+
+if __name__ == "__main__":
+    main()
+    os._exit(0)
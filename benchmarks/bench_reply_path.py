@@ -0,0 +1,119 @@
+"""
+Reply paths: RSA work and round-trip time for request/response exchanges
+when the responder answers over a circuit of its own to the requester
+(looked up by key fingerprint) vs back along the request's circuit.
+
+Eight local nodes: one responder, REQUESTERS requesters and a spare relay;
+every node relays for the others. Each requester sends an echo request to the responder and waits
+for the answer, EXCHANGES times in a row; all requesters run at once.
+Circuit pools are emptied before each mode, so the first exchange of a pair
+pays for whichever circuits it needs. RSA work is counted in-process: hybrid
+encryptions of CREATE layers, and the matching RSA decrypts on the relays.
+The last two runs remove the requesters from the responder's peer table;
+only the reply path can still answer them.
+
+Run from the repo root: python -m benchmarks.bench_reply_path [exchanges]
+"""
+import os
+import sys
+import time
+import threading
+import core.circuit
+import core.relay
+from core.overlay import OnionNode
+
+EXCHANGES = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+REQUESTERS = 6
+TIMEOUT = 2
+
+rsa = {"wraps": 0, "peels": 0}
+rsa_lock = threading.Lock()
+
+def counted(fn, name):
+    def wrapper(*args, **kwargs):
+        with rsa_lock:
+            rsa[name] += 1
+        return fn(*args, **kwargs)
+    return wrapper
+
+core.circuit.hybrid_encrypt = counted(core.circuit.hybrid_encrypt, "wraps")
+core.relay.peel_create_layer = counted(core.relay.peel_create_layer, "peels")
+
+class Echo:
+    """Answers pings (responder) and matches pongs to waiting requests (requester)."""
+    def __init__(self, node):
+        self.node = node
+        self.use_reply = True
+        self.waiting = {}  # request id -> Event
+
+    def receive(self, payload, reply=None):
+        if payload.get("type") == "ping":
+            pong = {"type": "pong", "id": payload["id"]}
+            self.node.send_reply(reply if self.use_reply else None, payload["from"], "echo", pong)
+        elif payload.get("type") == "pong":
+            done = self.waiting.pop(payload.get("id"), None)
+            if done: done.set()
+
+    def ping(self, target):
+        """Round-trip seconds, or None if no answer came."""
+        request_id = os.urandom(8).hex()
+        done = self.waiting[request_id] = threading.Event()
+        start = time.perf_counter()
+        self.node.send_onion_to_peer(target, "echo", {"type": "ping", "id": request_id, "from": self.node.fingerprint})
+        return time.perf_counter() - start if done.wait(TIMEOUT) else None
+
+def reset_pools(nodes):
+    for node in nodes:
+        mgr = node.circuit_mgr
+        with mgr.lock:
+            mgr.circuits.clear()
+            mgr.spares.clear()
+            mgr.multipath.clear()
+
+def run(label, responder, requesters, use_reply):
+    responder.modules["echo"].use_reply = use_reply
+    reset_pools([responder] + requesters)
+    target = f"127.0.0.1:{responder.port}"
+    rtts, first = [], []
+    lock = threading.Lock()
+
+    def client(node):
+        for i in range(EXCHANGES):
+            rtt = node.modules["echo"].ping(target)
+            with lock:
+                rtts.append(rtt)
+                if i == 0: first.append(rtt)
+
+    with rsa_lock:
+        rsa["wraps"] = rsa["peels"] = 0
+    threads = [threading.Thread(target=client, args=(n,)) for n in requesters]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    answered = [r for r in rtts if r is not None]
+    first = [r for r in first if r is not None]
+    pairs = len(rtts)
+    print(f"  {label:<30} {len(answered):>4}/{pairs} answered  "
+          f"{rsa['wraps'] / pairs:>5.2f} RSA wraps/pair  {rsa['peels'] / pairs:>5.2f} RSA peels/pair  "
+          + (f"first RTT {sum(first) / len(first) * 1000:>6.1f} ms  mean RTT {sum(answered) / len(answered) * 1000:>6.1f} ms"
+             if answered else "no answers"))
+
+def main():
+    nodes = [OnionNode(bind_ip="127.0.0.1") for _ in range(REQUESTERS + 2)]
+    for a in nodes:
+        a.modules["echo"] = Echo(a)
+        for b in nodes:
+            if a is not b:
+                a.add_peer({"host": "127.0.0.1", "port": b.port, "pub_key": b.pub_key.decode(), "codecs": ["bin1"]})
+    responder, requesters = nodes[0], nodes[1:REQUESTERS + 1]
+    print(f"{REQUESTERS} requesters x {EXCHANGES} echo exchanges with one responder, 3-hop circuits:")
+    run("new circuit back (lookup)", responder, requesters, use_reply=False)
+    run("reply path", responder, requesters, use_reply=True)
+    for node in requesters:
+        responder.remove_peer(f"127.0.0.1:{node.port}")
+    run("lookup, requesters unknown", responder, requesters, use_reply=False)
+    run("reply path, requesters unknown", responder, requesters, use_reply=True)
+    sys.stdout.flush()
+    os._exit(0)
+
+if __name__ == "__main__":
+    main()
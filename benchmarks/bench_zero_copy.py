@@ -0,0 +1,131 @@
+"""
+Relay data path allocations: bytes allocated per forwarded MB, per stage.
+
+One binary CIRC_CELL frame is received over a socketpair, parsed, peeled
+(AES-GCM) and re-serialized for the next hop, which is another socketpair
+drained by a sink thread. tracemalloc's peak over each stage is the memory
+that stage allocated. The receive buffer and the AES-GCM output (the
+peeled layer) are the two allocations neither path can avoid, so 2.0 MB
+per forwarded MB is the floor.
+
+"copying" re-creates the relay path as it was before frames were received
+with recv_into and parsed into memoryviews: recv + bytearray.extend,
+byte fields copied out of the frame, the ciphertext sliced into new bytes,
+and the next frame built by concatenation.
+
+Run from the repo root: python -m benchmarks.bench_zero_copy [size_mb ...]
+"""
+import os
+import sys
+import socket
+import struct
+import threading
+import time
+import tracemalloc
+from core.crypto import generate_session_key, sym_encrypt, sym_decrypt
+from core.protocol import serialize, serialize_parts, deserialize, MSG_CELL, CODEC_BINARY
+from core.transport import read_frame, send_parts
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+# Cells must fit transport.MAX_MESSAGE_SIZE (10 MB) with their framing
+SIZES_MB = [float(a) for a in sys.argv[1:]] or [1, 8]
+ROUNDS = 3
+
+# --- The relay path before zero-copy (kept here for comparison) ---
+def copying_recvall(sock, n):
+    data = bytearray()
+    while len(data) < n:
+        packet = sock.recv(n - len(data))
+        if not packet: return None
+        data.extend(packet)
+    return data
+
+def copying_read_frame(sock):
+    raw = copying_recvall(sock, 4)
+    return copying_recvall(sock, struct.unpack('>I', raw)[0])
+
+def copying_decrypt(key, payload):
+    return AESGCM(key).decrypt(payload[:12], payload[12:], None)
+
+def copying_send(sock, packet_type, payload):
+    data = serialize(packet_type, payload, CODEC_BINARY)
+    sock.sendall(struct.pack('>I', len(data)) + data)
+
+def zero_copy_send(sock, packet_type, payload):
+    parts = serialize_parts(packet_type, payload, CODEC_BINARY)
+    send_parts(sock, [struct.pack('>I', sum(len(p) for p in parts))] + parts)
+
+PATHS = {
+    "copying": {
+        "receive": copying_read_frame,
+        "parse": lambda frame: deserialize(frame),
+        "peel": copying_decrypt,
+        "forward": lambda sock, cell: copying_send(sock, MSG_CELL, cell),
+    },
+    "zero-copy": {
+        "receive": read_frame,
+        "parse": lambda frame: deserialize(frame, zero_copy=True),
+        "peel": sym_decrypt,
+        "forward": lambda sock, cell: zero_copy_send(sock, MSG_CELL, cell),
+    },
+}
+
+def drain(sock):
+    buf = bytearray(1 << 20)
+    try:
+        while sock.recv_into(buf):
+            pass
+    except OSError:
+        pass  # Closed at the end of the round
+
+def measure(fn, *args):
+    """Runs fn under tracemalloc; returns (result, bytes allocated at peak, seconds)."""
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    result = fn(*args)
+    elapsed = time.perf_counter() - start
+    return result, tracemalloc.get_traced_memory()[1] - base, elapsed
+
+def run(path, size, key):
+    fns = PATHS[path]
+    inner = os.urandom(size)
+    frame = serialize(MSG_CELL, {"circ_id": "a" * 16, "data": sym_encrypt(key, inner)}, CODEC_BINARY)
+    wire = struct.pack('>I', len(frame)) + frame
+    allocated = {"receive": 0, "parse": 0, "peel": 0, "forward": 0}
+    seconds = 0.0
+
+    for _ in range(ROUNDS):
+        rx_in, rx_out = socket.socketpair()
+        tx_in, tx_out = socket.socketpair()
+        threading.Thread(target=rx_in.sendall, args=(wire,), daemon=True).start()
+        threading.Thread(target=drain, args=(tx_out,), daemon=True).start()
+
+        tracemalloc.start()
+        received, n_receive, t_receive = measure(fns["receive"], rx_out)
+        packet, n_parse, t_parse = measure(fns["parse"], received)
+        peeled, n_peel, t_peel = measure(fns["peel"], key, packet['payload']['data'])
+        _, n_forward, t_forward = measure(fns["forward"], tx_in, {"circ_id": "b" * 16, "data": peeled})
+        tracemalloc.stop()
+
+        assert bytes(peeled) == inner
+        for stage, n in zip(allocated, (n_receive, n_parse, n_peel, n_forward)):
+            allocated[stage] += n
+        seconds += t_receive + t_parse + t_peel + t_forward
+        for s in (rx_in, rx_out, tx_in, tx_out): s.close()
+
+    mb = size / (1024 * 1024)
+    per_mb = {stage: n / ROUNDS / mb / (1024 * 1024) for stage, n in allocated.items()}
+    print(f"  {path:>9}: " + ", ".join(f"{stage} {v:.2f}" for stage, v in per_mb.items())
+          + f" | total {sum(per_mb.values()):.2f} MB per forwarded MB, {seconds / ROUNDS * 1000:.1f} ms")
+
+def main():
+    key = generate_session_key()
+    for size_mb in SIZES_MB:
+        size = int(size_mb * 1024 * 1024)
+        print(f"{size_mb:g} MB cell, MB allocated per forwarded MB by stage (avg of {ROUNDS}):")
+        for path in PATHS:
+            run(path, size, key)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+import asyncio
+import struct
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from core.relay import RelayService
+from core.transport import MAX_MESSAGE_SIZE, IDLE_TIMEOUT, IO_TIMEOUT
+from core.protocol import is_binary, BIN_TYPE_OFFSET, MSG_CELL, type_code
+
+class AsyncConnection:
+    """
+    Connection-compatible wrapper so frames can be written back on an asyncio
+    link from any thread. Off the loop, send_frame waits for drain(), so a
+    slow reader blocks the sending queue thread instead of growing the
+    transport's write buffer without bound.
+    """
+    def __init__(self, loop, writer):
+        self.loop = loop
+        self.writer = writer
+        self.addr = writer.get_extra_info('peername')
+        self.alive = True
+        self.last_read = loop.time()
+        self._loop_ident = threading.get_ident()  # Built inside _serve, on the loop thread
+
+    def send_frame(self, data):
+        if not self.alive:
+            raise ConnectionError("link closed")
+        parts = data if isinstance(data, list) else [data]
+        frame = [struct.pack('>I', sum(len(p) for p in parts))] + parts
+        if threading.get_ident() == self._loop_ident:
+            # Can't wait for drain on the loop itself; the reader task's own awaits bound this path
+            self.writer.writelines(frame)
+            return
+        future = asyncio.run_coroutine_threadsafe(self._write(frame), self.loop)
+        try:
+            future.result(IO_TIMEOUT)
+        except Exception:
+            future.cancel()
+            self.close()
+            raise ConnectionError(f"write to {self.addr} stalled or failed")
+
+    async def _write(self, frame):
+        self.writer.writelines(frame)
+        await self.writer.drain()
+
+    def close(self):
+        self.alive = False
+        self.loop.call_soon_threadsafe(self.writer.close)
+
+class AsyncRelayService(RelayService):
+    """
+    asyncio relay engine: one event loop serves every inbound link instead of
+    a thread per connection. Frames on a link are handled in order.
+    - Binary CIRC_CELL frames are peeled on the loop: one AES-GCM decrypt is
+      cheaper than an executor round trip. The loop only hands the result to
+      the next hop's outbound queue (never waiting); connecting and sending
+      happen on that queue's thread. While a queue is full cells go through
+      the executor instead, where put() may block; awaiting it stops reads on
+      that link, which is the backpressure.
+    - Frames written back on an inbound link wait for drain() on the queue
+      thread, so a slow previous hop can't grow the write buffer unbounded.
+    - Everything else (RSA CREATE/ONION layers, JSON parsing) and all exit
+      dispatch into modules run on a bounded executor, so neither CPU-heavy
+      decrypts nor slow module handlers block the loop.
+    - Exit messages queue per circuit and at most one worker serves a
+      circuit at a time, so a circuit's messages reach modules in order.
+      Cells arriving while the queue is full are dropped.
+    """
+    LISTEN_BACKLOG = 1024
+    EXIT_QUEUE_CELLS = 64                   # per circuit
+    EXIT_QUEUE_BYTES = 16 * 1024 * 1024     # across all circuits
+
+    def __init__(self, node, peel_workers=0, workers=32):
+        super().__init__(node, peel_workers)
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="relay-peel")
+        self.active_links = 0
+        self.links = set()
+        self._cell_code = type_code(MSG_CELL)
+        self._loop_ident = None
+        self.exit_queues = {}  # circ_id -> deque of payloads; present while a worker job owns the circuit
+        self.exit_bytes = 0
+        self.exit_lock = threading.Lock()
+
+    def start(self):
+        threading.Thread(target=self._run_loop, daemon=True).start()
+
+    def _backpressure_timeout(self):
+        # Never block the event loop on a full queue; drop instead
+        return 0 if threading.get_ident() == self._loop_ident else super()._backpressure_timeout()
+
+    def _run_loop(self):
+        self._loop_ident = threading.get_ident()
+        asyncio.set_event_loop(self.loop)
+        self.sock.setblocking(False)
+        self.loop.run_until_complete(
+            asyncio.start_server(self._serve, sock=self.sock, backlog=self.LISTEN_BACKLOG)
+        )
+        self.loop.create_task(self._reap_idle())
+        self.loop.run_forever()
+
+    async def _reap_idle(self):
+        # One sweep instead of a wait_for() per frame: wait_for costs a task and a
+        # timer per read and forces a loop pass even when the next frame is buffered
+        while self.running:
+            await asyncio.sleep(IDLE_TIMEOUT / 4)
+            cutoff = self.loop.time() - 2 * IDLE_TIMEOUT
+            for link in [l for l in self.links if l.last_read < cutoff]:
+                link.close()  # The reader sees EOF and _serve cleans up
+
+    def _deliver_exit(self, inner_data, circ_id=None):
+        # May run on the loop: never wait here
+        with self.exit_lock:
+            q = self.exit_queues.get(circ_id)
+            if (q is not None and len(q) >= self.EXIT_QUEUE_CELLS) \
+                    or self.exit_bytes + len(inner_data) > self.EXIT_QUEUE_BYTES:
+                print(f"[RELAY] Dropped exit cell on circuit {circ_id}: queue full")
+                return
+            self.exit_bytes += len(inner_data)
+            if q is not None:
+                q.append(inner_data)
+                return
+            self.exit_queues[circ_id] = deque([inner_data])
+        self.executor.submit(self._exit_job, circ_id)
+
+    def _exit_job(self, circ_id):
+        # One message per job; a busy circuit re-submits itself rather than hold a worker
+        with self.exit_lock:
+            inner_data = self.exit_queues[circ_id].popleft()
+            self.exit_bytes -= len(inner_data)
+        try:
+            RelayService._deliver_exit(self, inner_data, circ_id)
+        except Exception as e:
+            print(f"Exit Dispatch Error: {e}")
+        with self.exit_lock:
+            if not self.exit_queues[circ_id]:
+                del self.exit_queues[circ_id]
+                return
+        self.executor.submit(self._exit_job, circ_id)
+
+    async def _serve(self, reader, writer):
+        link = AsyncConnection(self.loop, writer)
+        self.active_links += 1
+        self.links.add(link)
+        try:
+            while self.running:
+                raw_msglen = await reader.readexactly(4)
+                link.last_read = self.loop.time()
+                msglen = struct.unpack('>I', raw_msglen)[0]
+                if msglen > MAX_MESSAGE_SIZE:
+                    print(f"[SECURITY] Rejected message: size {msglen} exceeds limit {MAX_MESSAGE_SIZE}")
+                    break
+                data = await reader.readexactly(msglen)
+                if is_binary(data) and data[BIN_TYPE_OFFSET] == self._cell_code and not self.outbound.saturated:
+                    self.handle_frame(data, link)
+                else:
+                    await self.loop.run_in_executor(self.executor, self.handle_frame, data, link)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            print(f"Relay Error: {e}")
+        finally:
+            self.active_links -= 1
+            self.links.discard(link)
+            link.alive = False
+            writer.close()
@@ -1,24 +1,209 @@
-import random
-import json
-import base64
-from core.crypto import hybrid_encrypt
+import os
+import time
+import threading
+from core.crypto import hybrid_encrypt, generate_session_key, sym_encrypt, sym_decrypt
+from core.protocol import pack_payload, unpack_payload, negotiate_codec, MSG_CREATE, MSG_CELL
+from core.flow import Window, OutboundQueues, crossed, CIRCUIT_WINDOW, STREAM_WINDOW, SENDME_INCREMENT
+from core.relay import RelayService
+
+# Originator-side circuit lifetime. Must stay below the relay idle TTL
+# (RelayService.CIRCUIT_IDLE_TTL) so relays never forget a live circuit;
+# CircuitManager clamps larger values to MAX_CIRCUIT_LIFETIME.
+CIRCUIT_LIFETIME = 300
+CIRCUIT_MAX_MESSAGES = 1000
+# A replacement is built in the background once a busy circuit is this
+# close to either limit, so the next message does not pay the RSA handshake
+WARM_AHEAD_SECONDS = 30
+WARM_AHEAD_MESSAGES = 100
+WARM_INTERVAL = 2
+# Smoothing for the per-circuit delivery rate measured from SENDMEs
+ACK_RATE_ALPHA = 0.3
+# A circuit that has left the pool still takes replies (backward cells) this
+# long after it was last used or last brought one, e.g. a response still streaming
+REPLY_GRACE = 60
+# A circuit is last used at most `lifetime` after it is built and then tracked
+# for REPLY_GRACE; relays must still know it for all of that
+MAX_CIRCUIT_LIFETIME = RelayService.CIRCUIT_IDLE_TTL - REPLY_GRACE
+
+class Circuit:
+    """
+    An established path with one circuit ID and one AES-GCM session key per hop.
+    The RSA work is paid once in the CREATE handshake; every later message
+    is layered with the session keys only.
+    """
+    def __init__(self, path, lifetime=CIRCUIT_LIFETIME, max_messages=CIRCUIT_MAX_MESSAGES):
+        self.path = path
+        self.hop_ids = [os.urandom(8).hex() for _ in path]
+        self.hop_keys = [generate_session_key() for _ in path]
+        self.lifetime = lifetime
+        self.max_messages = max_messages
+        self.created = time.time()
+        self.last_used = self.created
+        self.messages = 0
+        # Set once the CREATE is queued on the entry link; cells must not overtake it
+        self.established = threading.Event()
+        # Flow control: credits for the whole circuit and per stream (module)
+        self.window = Window(CIRCUIT_WINDOW)
+        self.streams = {}
+        self.streams_lock = threading.Lock()
+        # Cell numbers (whole circuit under None, else per stream) and the
+        # highest each SENDME has acknowledged
+        self.numbered = {}
+        self.acked_upto = {}
+        self.cell_bytes = {}  # circuit cell number -> wire size, until a SENDME covers it
+        # Set when a window stalled; the circuit is replaced on next use
+        self.retired = False
+        # Delivery rate (cells/s acknowledged by SENDMEs), for multipath striping
+        self.cells_sent = 0
+        self.cells_acked = 0
+        self.ack_rate = None
+        self.busy_since = None
+        self.last_ack = None
+        self.rate_lock = threading.Lock()
+        self.last_reply = None
+        self.reply_upto = 0  # Highest reply stream cell handled; sent back in reply SENDMEs
+
+    def stream_window(self, stream):
+        with self.streams_lock:
+            if stream not in self.streams:
+                self.streams[stream] = Window(STREAM_WINDOW)
+            return self.streams[stream]
+
+    def number(self, stream):
+        """Next (circuit, stream) cell numbers, starting at 1; the exit acknowledges them."""
+        with self.streams_lock:
+            n = self.numbered[None] = self.numbered.get(None, 0) + 1
+            sn = self.numbered[stream] = self.numbered.get(stream, 0) + 1
+        return n, sn
+
+    def note_size(self, n, nbytes):
+        with self.streams_lock:
+            self.cell_bytes[n] = nbytes
+
+    def delivered_bytes(self, upto):
+        """Bytes of the cells numbered up to `upto`, each counted once."""
+        with self.streams_lock:
+            done = [n for n in self.cell_bytes if n <= upto]
+            return sum(self.cell_bytes.pop(n) for n in done)
+
+    def credit(self, stream, upto):
+        """
+        Credits a SENDME acknowledging every cell up to `upto` (stream None:
+        the whole circuit): the cells not yet credited, dropped ones included.
+        A SENDME without a number is worth SENDME_INCREMENT.
+        """
+        with self.streams_lock:
+            acked = self.acked_upto.get(stream, 0)
+            if not isinstance(upto, int):
+                upto = acked + SENDME_INCREMENT
+            self.acked_upto[stream] = max(acked, upto)
+            return max(0, upto - acked)
+
+    def would_block(self, stream):
+        """True if sending one more cell on `stream` would wait for a SENDME."""
+        return self.window.credits <= 0 or self.stream_window(stream).credits <= 0
+
+    def note_sent(self):
+        with self.rate_lock:
+            if self.cells_sent == self.cells_acked:
+                self.busy_since = time.time()
+            self.cells_sent += 1
+
+    def note_acked(self, n=SENDME_INCREMENT, nbytes=0):
+        """
+        A circuit SENDME: n more cells (nbytes) delivered. Only time spent with
+        cells in flight counts. Returns (nbytes, seconds) for the delivery, or None.
+        """
+        now = time.time()
+        delivery = None
+        with self.rate_lock:
+            start = max(self.last_ack or 0, self.busy_since or now)
+            if now > start:
+                sample = n / (now - start)
+                self.ack_rate = sample if self.ack_rate is None else \
+                    ACK_RATE_ALPHA * sample + (1 - ACK_RATE_ALPHA) * self.ack_rate
+                delivery = (nbytes, now - start)
+            self.cells_acked = min(self.cells_acked + n, self.cells_sent)
+            self.last_ack = now
+        return delivery
+
+    def expected_delay(self, default_rate):
+        """
+        Seconds until one more cell would be delivered: cells in flight over
+        the delivery rate. A path that has owed a SENDME for a while is
+        rated down by how long it has been silent, so a stalled path stops being picked.
+        """
+        with self.rate_lock:
+            outstanding = self.cells_sent - self.cells_acked
+            rate = self.ack_rate or default_rate
+            if outstanding >= SENDME_INCREMENT:
+                silent = time.time() - max(self.last_ack or 0, self.busy_since or 0)
+                if silent > 0:
+                    rate = min(rate, SENDME_INCREMENT / silent)
+        return (outstanding + 1) / rate
+
+    def expired(self):
+        return (self.retired or time.time() - self.created > self.lifetime
+                or self.messages >= self.max_messages)
+
+    def near_expiry(self):
+        return (time.time() - self.created > self.lifetime - WARM_AHEAD_SECONDS
+                or self.messages >= self.max_messages - WARM_AHEAD_MESSAGES)
 
 class CircuitManager:
-    def __init__(self, node):
+    """
+    Keeps a pool of ready circuits, one per exit target, reused for up to
+    `max_messages` messages or `lifetime` seconds. A warming thread builds the
+    replacement for a busy circuit before it expires (a payload-less CREATE),
+    so steady traffic never waits on path selection or RSA.
+    Circuits whose relays have left the peer set are dropped on next use.
+    """
+    def __init__(self, node, lifetime=CIRCUIT_LIFETIME, max_messages=CIRCUIT_MAX_MESSAGES, warm=True):
+        if lifetime <= 0:
+            raise ValueError(f"Circuit lifetime must be positive, got {lifetime}")
+        if lifetime > MAX_CIRCUIT_LIFETIME:
+            print(f"[FLOW] Circuit lifetime {lifetime}s would outlive relay state "
+                  f"(idle TTL {RelayService.CIRCUIT_IDLE_TTL}s); using {MAX_CIRCUIT_LIFETIME}s")
+            lifetime = MAX_CIRCUIT_LIFETIME
         self.node = node
+        self.lifetime = lifetime
+        self.max_messages = max_messages
+        self.circuits = {}  # target peer_id -> Circuit in use
+        self.spares = {}    # target peer_id -> pre-built replacement
+        self.multipath = {} # target peer_id -> [Circuit] with disjoint middles, for striping
+        # Entry hop ID -> Circuit, for backward cells (SENDMEs and replies).
+        # Kept REPLY_GRACE past leaving the pool, so late replies still land
+        self.by_id = {}
+        # Replies run module code, which may block (a slow stream consumer, or
+        # window credits that arrive on the very link the reply came in on), so
+        # they are queued per circuit, in order, off the link reader
+        self.replies = OutboundQueues()
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "warm_hits": 0, "misses": 0, "builds": 0, "warmed": 0,
+                         "build_seconds": 0.0, "max_build_seconds": 0.0,
+                         "window_waits": 0, "window_stalls": 0, "sendmes": 0, "multipath_builds": 0,
+                         "replies": 0}
+        if warm:
+            threading.Thread(target=self._warm_loop, daemon=True).start()
 
     def build_circuit(self, hops=3):
-        """Original Random Circuit (Keep this for anonymous browsing)"""
+        """
+        Circuit through `hops` distinct peers, weighted by node.metrics
+        (uniform when path_bias is 0; demoted peers only as a last resort).
+        """
         peers = list(self.node.peers.values())
         if not peers: return []
-        # Sample with replacement if not enough peers, or just use what we have
+        # Just use what we have if there are not enough peers
         count = min(len(peers), hops)
-        return random.sample(peers, count)
+        return self.node.metrics.sample(peers, count)
 
-    def build_circuit_to_target(self, target_peer, hops=3):
+    def build_circuit_to_target(self, target_peer, hops=3, exclude=()):
         """
         Builds a circuit that ends specifically at 'target_peer'.
-        Path: Me -> Random -> Random -> Target
+        Path: Me -> Middle -> Middle -> Target
+        Middles are drawn by node.metrics.sample(): faster relays are more
+        likely, within the weight cap, and repeatedly failing ones are skipped.
+        Peers whose "host:port" is in `exclude` are never middles.
         
         NOTE: If there aren't enough distinct peers to build a full circuit,
         the same peer may appear multiple times in the circuit path.
@@ -30,43 +215,290 @@ class CircuitManager:
         # 1. Start with the target as the Exit Node
         circuit = [target_peer]
         
-        # 2. Fill the rest with random peers (Middle Nodes)
+        # 2. Fill the rest with weighted random peers (Middle Nodes)
         # We try to avoid picking the target again if possible
-        available_middle = [p for p in peers if p != target_peer]
+        available_middle = [p for p in peers if p != target_peer and f"{p['host']}:{p['port']}" not in exclude]
         
         # If we don't have enough other peers, we just reuse/shorten
         needed = hops - 1
         if needed > 0:
             if len(available_middle) >= needed:
-                circuit = random.sample(available_middle, needed) + circuit
+                circuit = self.node.metrics.sample(available_middle, needed) + circuit
             else:
                 # Not enough peers for a full path, just go Direct or Short
                 circuit = available_middle + circuit
 
         return circuit
 
-    def wrap_onion(self, final_payload, circuit):
+    def get_circuit(self, target_peer_id, target_peer):
+        """
+        Returns (circuit, is_new) for a live Circuit ending at target_peer,
+        building a new one when there is none yet or the current one has expired.
+        The caller that gets is_new=True owns sending the CREATE.
+        """
+        with self.lock:
+            circuit = self.circuits.get(target_peer_id)
+            is_new = False
+            if circuit is None or not self._usable(circuit):
+                spare = self.spares.pop(target_peer_id, None)
+                if spare is not None and self._usable(spare):
+                    circuit = spare
+                    self.counters["warm_hits"] += 1
+                else:
+                    path = self.build_circuit_to_target(target_peer)
+                    if not path: return None, False
+                    circuit = Circuit(path, self.lifetime, self.max_messages)
+                    self._sweep_by_id()
+                    self.by_id[circuit.hop_ids[0]] = circuit
+                    is_new = True
+                    self.counters["misses"] += 1
+                self.circuits[target_peer_id] = circuit
+            else:
+                self.counters["hits"] += 1
+            circuit.messages += 1
+            circuit.last_used = time.time()
+            return circuit, is_new
+
+    def get_circuits(self, target_peer_id, target_peer, count, hops=3):
         """
-        Wraps message in layers: Enc_A( IP_B, Enc_B( IP_C, Enc_C( Payload ) ) )
+        Up to `count` established circuits ending at target_peer whose middle
+        relays are pairwise disjoint, for striping one transfer across them.
+        They have their own pool, separate from get_circuit's. Missing ones
+        are built with a payload-less CREATE, so every circuit returned is
+        ready for cells. Fewer come back when there are not enough peers for
+        another disjoint full-length path.
         """
-        # Serialize the initial payload to bytes (JSON)
-        message_bytes = json.dumps(final_payload).encode('utf-8')
+        with self.lock:
+            live = [c for c in self.multipath.get(target_peer_id, []) if self._usable(c)][:count]
+            used = {f"{p['host']}:{p['port']}" for c in live for p in c.path[:-1]}
+            fresh = []
+            while len(live) + len(fresh) < count:
+                path = self.build_circuit_to_target(target_peer, hops, exclude=used)
+                if not path or (live or fresh) and len(path) < hops: break
+                circuit = Circuit(path, self.lifetime, self.max_messages)
+                self.by_id[circuit.hop_ids[0]] = circuit
+                fresh.append(circuit)
+                used.update(f"{p['host']}:{p['port']}" for p in path[:-1])
+            self.multipath[target_peer_id] = live + fresh
+            self.counters["multipath_builds"] += len(fresh)
+            for circuit in live + fresh:
+                circuit.messages += 1
+                circuit.last_used = time.time()
 
-        # Logic: We start from the Exit node and wrap backwards to the Entry node.
-        next_hop_addr = None  
+        for circuit in fresh:
+            self.establish(circuit)
+        return live + fresh
 
-        for peer in reversed(circuit):
-            # 1. Construct the layer content
+    def establish(self, circuit):
+        """Sends a payload-less CREATE for `circuit`; cells may follow right away."""
+        create_packet = self.wrap_create(None, circuit)
+        entry_node = circuit.path[0]
+        try:
+            self.node.send_raw(entry_node['host'], entry_node['port'], MSG_CREATE, create_packet)
+        finally:
+            circuit.established.set()
+
+    def _usable(self, circuit):
+        # NOTE: Must be called while self.lock is held
+        peers = self.node.peers
+        return not circuit.expired() and all(f"{p['host']}:{p['port']}" in peers for p in circuit.path)
+
+    def _warm_loop(self):
+        while True:
+            time.sleep(WARM_INTERVAL)
+            try:
+                self.warm()
+            except Exception as e:
+                print(f"Circuit Warm Error: {e}")
+
+    def warm(self):
+        """Pre-builds replacements for circuits that are busy and close to expiring."""
+        now = time.time()
+        due = []
+        with self.lock:
+            self._sweep_by_id()
+            for target_id, paths in list(self.multipath.items()):
+                if all(now - c.last_used > self.lifetime for c in paths):
+                    del self.multipath[target_id]
+            for target_id, circuit in list(self.circuits.items()):
+                if now - circuit.last_used > self.lifetime:
+                    # Idle target: forget it rather than keep rebuilding
+                    del self.circuits[target_id]
+                    self.spares.pop(target_id, None)
+                    continue
+                spare = self.spares.get(target_id)
+                if circuit.near_expiry() and (spare is None or not self._usable(spare)):
+                    target_peer = self.node.peers.get(target_id)
+                    path = self.build_circuit_to_target(target_peer) if target_peer else []
+                    if path:
+                        due.append((target_id, Circuit(path, self.lifetime, self.max_messages)))
+
+        for target_id, spare in due:
+            self.establish(spare)
+            with self.lock:
+                self.by_id[spare.hop_ids[0]] = spare
+                self.spares[target_id] = spare
+                self.counters["warmed"] += 1
+
+    def _sweep_by_id(self):
+        """Forgets circuits out of every pool with no use or reply for REPLY_GRACE."""
+        # NOTE: Must be called while self.lock is held
+        now = time.time()
+        pooled = {id(c) for c in self.circuits.values()} | {id(c) for c in self.spares.values()}
+        pooled.update(id(c) for paths in self.multipath.values() for c in paths)
+        for hop_id, circuit in list(self.by_id.items()):
+            if id(circuit) not in pooled and now - max(circuit.last_used, circuit.last_reply or 0) > REPLY_GRACE:
+                del self.by_id[hop_id]
+
+    def stats(self):
+        """Pool hit rate and build latency, for the dashboard."""
+        with self.lock:
+            c = dict(self.counters)
+            pooled, spares = len(self.circuits), len(self.spares)
+            multipath = sum(len(paths) for paths in self.multipath.values())
+            tracked = len(self.by_id)
+        builds = max(c["builds"], 1)
+        return {
+            "pooled": pooled, "spares": spares, "multipath": multipath,
+            "multipath_builds": c["multipath_builds"],
+            "hits": c["hits"], "warm_hits": c["warm_hits"], "misses": c["misses"],
+            "warmed": c["warmed"],
+            "window_waits": c["window_waits"], "window_stalls": c["window_stalls"], "sendmes": c["sendmes"],
+            "replies": c["replies"], "reply_drops": self.replies.counters["dropped"], "tracked": tracked,
+            "avg_build_ms": round(c["build_seconds"] / builds * 1000, 2),
+            "max_build_ms": round(c["max_build_seconds"] * 1000, 2)
+        }
+
+    def acquire(self, circuit, stream):
+        """
+        Takes one credit from the circuit and stream windows before a cell is
+        sent, blocking while the exit is behind (that is the backpressure on
+        the module). If a window stays shut past WINDOW_TIMEOUT the circuit is
+        retired and the cell goes out anyway, so a lost SENDME costs one
+        circuit rather than wedging the sender. Returns False in that case.
+        """
+        for window in (circuit.window, circuit.stream_window(stream)):
+            if window.credits <= 0:
+                with self.lock:
+                    self.counters["window_waits"] += 1
+            if not window.take():
+                circuit.retired = True
+                with self.lock:
+                    self.counters["window_stalls"] += 1
+                print(f"[FLOW] Window stalled on circuit {circuit.hop_ids[0]}; retiring it")
+                circuit.note_sent()
+                return False
+        circuit.note_sent()
+        return True
+
+    def handle_back_cell(self, cell):
+        """
+        A backward cell on one of our circuits: peel every hop's layer, then
+        apply the SENDME, or hand a reply from the exit to its module.
+        """
+        circuit = self.by_id.get(cell.get('circ_id'))
+        if circuit is None: return
+        data = cell['data']
+        for key in circuit.hop_keys:
+            data = sym_decrypt(key, data)
+            if data is None:
+                print(f"[FLOW] Undecryptable backward cell on circuit {cell['circ_id']}")
+                return
+        msg = unpack_payload(data)
+        if msg.get('module'):
+            circuit.last_reply = time.time()
+            with self.lock:
+                self.counters["replies"] += 1
+            # Never blocks the reader: a full queue means the exit overran its window
+            if not self.replies.put(circuit.hop_ids[0], self._handle_reply, (circuit, msg), len(data), timeout=0):
+                print(f"[FLOW] Dropped reply on circuit {cell['circ_id']}: reply queue full")
+            return
+        if msg.get('sendme') == "circuit":
+            credits = circuit.credit(None, msg.get('upto'))
+            if credits:
+                circuit.window.refill(credits)
+                delivery = circuit.note_acked(credits, circuit.delivered_bytes(circuit.acked_upto[None]))
+                if delivery:
+                    # The exit has these bytes: a throughput sample for every hop they crossed
+                    for hop in circuit.path:
+                        self.node.metrics.record_delivery(f"{hop['host']}:{hop['port']}", *delivery)
+        elif msg.get('sendme') == "stream":
+            stream = msg.get('stream')
+            credits = circuit.credit(stream, msg.get('upto'))
+            if credits:
+                circuit.stream_window(stream).refill(credits)
+        else:
+            return
+        with self.lock:
+            self.counters["sendmes"] += 1
+
+    def _handle_reply(self, circuit, msg):
+        """
+        Runs on the circuit's reply queue: hands one reply to its module. Reply
+        stream cells are numbered; whenever the highest one handled passes a
+        multiple of SENDME_INCREMENT the exit gets a reply SENDME with it, so
+        a consumer that falls behind slows the exit down (see ReplyPath).
+        """
+        try:
+            self.node.handle_exit_traffic(msg)
+        finally:
+            if msg.get('stream'):
+                old = circuit.reply_upto
+                n = msg.get('n')
+                circuit.reply_upto = max(old, n) if isinstance(n, int) else old + 1
+                if crossed(old, circuit.reply_upto):
+                    sendme = {"sendme": "reply", "upto": circuit.reply_upto}
+                    cell = self._layer_cell(pack_payload(sendme, negotiate_codec(circuit.path[-1])), circuit)
+                    entry_node = circuit.path[0]
+                    self.node.send_raw(entry_node['host'], entry_node['port'], MSG_CELL, cell)
+
+    def _pack_exit(self, final_payload, exit_peer):
+        """Innermost payload in the exit's codec, compressed if the exit supports it."""
+        packed = pack_payload(final_payload, negotiate_codec(exit_peer))
+        return self.node.compressor.compress(final_payload.get('module'), packed, exit_peer)
+
+    def wrap_create(self, final_payload, circuit):
+        """
+        Builds the CREATE onion for a circuit. Each hop's RSA layer hands it
+        a circuit ID and session key, plus where (and under which ID) to
+        forward the rest: Enc_A( id_A, key_A, IP_B, id_B, Enc_B( ... ) )
+        The exit layer carries the first payload so no round trip is wasted.
+        """
+        start = time.perf_counter()
+        message_bytes = self._pack_exit(final_payload, circuit.path[-1]) if final_payload is not None else b""
+        next_hop_addr = None
+        next_circ_id = None
+
+        for peer, circ_id, key in reversed(list(zip(circuit.path, circuit.hop_ids, circuit.hop_keys))):
             layer_content = {
-                "next_hop": next_hop_addr, 
-                "data_b64": base64.b64encode(message_bytes).decode('utf-8')
+                "circ_id": circ_id,
+                "key": key,
+                "next_hop": next_hop_addr,
+                "next_circ_id": next_circ_id,
+                "data": message_bytes
             }
-            
-            # 2. Serialize and Encrypt
-            serialized_layer = json.dumps(layer_content).encode('utf-8')
-            message_bytes = hybrid_encrypt(serialized_layer, peer['pub_key'])
-            
-            # 3. Set next_hop for the *next* iteration
+            # Each hop's layer uses the codec that hop advertised
+            serialized_layer = pack_payload(layer_content, negotiate_codec(peer))
+            message_bytes = hybrid_encrypt(serialized_layer, peer.get('key_obj') or peer['pub_key'])
+
             next_hop_addr = (peer['host'], peer['port'])
+            next_circ_id = circ_id
+
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.counters["builds"] += 1
+            self.counters["build_seconds"] += elapsed
+            self.counters["max_build_seconds"] = max(self.counters["max_build_seconds"], elapsed)
+        return message_bytes
+
+    def wrap_cell(self, final_payload, circuit):
+        """
+        Layers a payload with the per-hop session keys (exit innermost).
+        Returns the cell addressed to the entry relay.
+        """
+        return self._layer_cell(self._pack_exit(final_payload, circuit.path[-1]), circuit)
 
-        return message_bytes
\ No newline at end of file
+    def _layer_cell(self, data, circuit):
+        for key in reversed(circuit.hop_keys):
+            data = sym_encrypt(key, data)
+        return {"circ_id": circuit.hop_ids[0], "data": data}
\ No newline at end of file
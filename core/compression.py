@@ -0,0 +1,99 @@
+import math
+import zlib
+import lzma
+import threading
+from collections import Counter
+
+# Advertised in HELLO as "compression"; peers that omit it get uncompressed payloads
+SUPPORTED_COMPRESSION = ["zlib", "lzma"]
+
+# Compressed exit payload: [Magic (2)] [Algorithm (1)] [Compressed Payload]
+# The leading zero byte never starts a JSON payload, and the second byte
+# differs from the binary codec's magic, so unpack_payload() can tell them apart.
+COMPRESSED_MAGIC = b"\x00\xc1"
+_TAGS = {"zlib": 1, "lzma": 2}
+_NAMES = {tag: name for name, tag in _TAGS.items()}
+
+# Per-module choice: latency-sensitive traffic gets fast zlib; one-shot
+# proxy responses (HTML, JSON) get lzma's better ratio.
+MODULE_COMPRESSION = {
+    "chat": ("zlib", 6),
+    "torrent": ("zlib", 1),
+    "proxy": ("lzma", 1)
+}
+DEFAULT_COMPRESSION = ("zlib", 6)
+
+MIN_COMPRESS_SIZE = 256       # Smaller payloads are not worth the header
+ENTROPY_SKIP = 7.5            # Bits per byte; above this the sample looks already compressed
+SAMPLE_SIZE = 1024            # Bytes per sample window
+SAMPLE_WINDOWS = 4
+MAX_DECOMPRESSED = 64 * 1024 * 1024
+
+def sampled_entropy(data):
+    """Shannon entropy (bits/byte) of a few windows spread across `data`."""
+    if len(data) <= SAMPLE_SIZE * SAMPLE_WINDOWS:
+        sample = bytes(data)
+    else:
+        step = (len(data) - SAMPLE_SIZE) // (SAMPLE_WINDOWS - 1)
+        sample = b"".join(bytes(data[i * step:i * step + SAMPLE_SIZE]) for i in range(SAMPLE_WINDOWS))
+    n = len(sample)
+    if not n: return 0.0
+    return -sum(c / n * math.log2(c / n) for c in Counter(sample).values())
+
+def is_compressed(data):
+    return bytes(data[:2]) == COMPRESSED_MAGIC
+
+def decompress(data):
+    """Inverse of Compressor.compress() framing. Raises ValueError on bad or oversized input."""
+    name = _NAMES.get(data[2]) if len(data) > 2 else None
+    body = bytes(data[3:])
+    try:
+        if name == "zlib":
+            d = zlib.decompressobj()
+            out = d.decompress(body, MAX_DECOMPRESSED)
+            if d.unconsumed_tail: raise ValueError("payload exceeds decompression limit")
+        elif name == "lzma":
+            d = lzma.LZMADecompressor()
+            out = d.decompress(body, MAX_DECOMPRESSED)
+            if not d.eof: raise ValueError("payload exceeds decompression limit")
+        else:
+            raise ValueError(f"unknown compression tag {data[2:3].hex()}")
+    except (zlib.error, lzma.LZMAError) as e:
+        raise ValueError(f"corrupt compressed payload: {e}")
+    return out
+
+class Compressor:
+    """
+    Compresses exit payloads before the innermost encryption layer, when the
+    exit hop advertised support. Compressing after encryption would gain
+    nothing, so this is the only place it can help. Keeps per-module counters.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {}  # module -> counters
+
+    def compress(self, module, data, peer):
+        """Returns `data` compressed and framed, or unchanged if not worth it."""
+        algorithm, level = MODULE_COMPRESSION.get(module, DEFAULT_COMPRESSION)
+        offered = (peer or {}).get('compression') or []
+        out, skipped = data, True
+        if algorithm in offered and len(data) >= MIN_COMPRESS_SIZE and sampled_entropy(data) < ENTROPY_SKIP:
+            if algorithm == "zlib":
+                body = zlib.compress(data, level)
+            else:
+                body = lzma.compress(data, preset=level)
+            if len(body) + 3 < len(data):
+                out, skipped = COMPRESSED_MAGIC + bytes([_TAGS[algorithm]]) + body, False
+
+        with self.lock:
+            s = self.stats.setdefault(module, {"messages": 0, "skipped": 0, "bytes_in": 0, "bytes_out": 0})
+            s["messages"] += 1
+            s["skipped"] += skipped
+            s["bytes_in"] += len(data)
+            s["bytes_out"] += len(out)
+        return out
+
+    def summary(self):
+        """Per-module bytes saved, for the dashboard."""
+        with self.lock:
+            return {m: dict(s, bytes_saved=s["bytes_in"] - s["bytes_out"]) for m, s in self.stats.items()}
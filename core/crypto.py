@@ -1,4 +1,6 @@
 import os
+import hashlib
+from functools import lru_cache
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.hazmat.primitives.asymmetric import rsa, padding
 from cryptography.hazmat.primitives import serialization, hashes
@@ -17,6 +19,56 @@ def generate_rsa_keypair():
     )
     return private_key, pem_public
 
+@lru_cache(maxsize=1024)
+def _load_public_key_cached(public_key_pem: bytes):
+    return serialization.load_pem_public_key(public_key_pem)
+
+def load_public_key(public_key_pem):
+    """Parses a PEM public key once; repeat calls for the same PEM hit the cache."""
+    if isinstance(public_key_pem, str):
+        public_key_pem = public_key_pem.encode('utf-8')
+    return _load_public_key_cached(bytes(public_key_pem))
+
+def key_fingerprint(public_key) -> str:
+    """
+    SHA-256 (hex) over the DER SubjectPublicKeyInfo. Accepts a PEM or a parsed key.
+    This fixed-length (64 char) id is the node identity carried on the wire
+    in place of full PEM keys; peers resolve it via OnionNode.find_peer_by_fp.
+    """
+    if isinstance(public_key, (bytes, str)):
+        public_key = load_public_key(public_key)
+    der = public_key.public_bytes(
+        encoding=serialization.Encoding.DER,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo
+    )
+    return hashlib.sha256(der).hexdigest()
+
+def generate_session_key() -> bytes:
+    """Generates a fresh AES-GCM-256 key for a single circuit hop."""
+    return AESGCM.generate_key(bit_length=256)
+
+def sym_encrypt(key: bytes, data: bytes) -> bytes:
+    """
+    Encrypts one circuit layer with an established AES-GCM session key.
+    Structure: [Nonce (12 bytes)] + [Ciphertext + Tag]
+    """
+    nonce = os.urandom(12)
+    return nonce + AESGCM(key).encrypt(nonce, data, None)
+
+def sym_decrypt(key: bytes, payload: bytes) -> bytes:
+    """
+    Peels one circuit layer. Returns None if the tag does not verify.
+    `payload` may be any buffer; it is sliced as a memoryview, not copied.
+    """
+    try:
+        if len(payload) < 28:
+            return None
+        view = memoryview(payload)
+        return AESGCM(key).decrypt(view[:12], view[12:], None)
+    except Exception as e:
+        print(f"Cell Decryption/Integrity Error: {e}")
+        return None
+
 def hybrid_encrypt(data: bytes, public_key_pem: bytes) -> bytes:
     """
     Encrypts data using RSA-OAEP + AES-GCM (Authenticated Encryption).
@@ -33,10 +85,11 @@ def hybrid_encrypt(data: bytes, public_key_pem: bytes) -> bytes:
         ciphertext = aesgcm.encrypt(nonce, data, None)
         
         # 3. Encrypt AES Key with Receiver's RSA Public Key
-        if isinstance(public_key_pem, str):
-            public_key_pem = public_key_pem.encode('utf-8')
-        
-        public_key = serialization.load_pem_public_key(public_key_pem)
+        # (accepts a pre-parsed key object; PEMs go through the parse cache)
+        if isinstance(public_key_pem, (bytes, str)):
+            public_key = load_public_key(public_key_pem)
+        else:
+            public_key = public_key_pem
         encrypted_key = public_key.encrypt(
             aes_key,
             padding.OAEP(
@@ -63,9 +116,11 @@ def hybrid_decrypt(payload: bytes, private_key) -> bytes:
         if len(payload) < 268: 
             return None
 
-        encrypted_key = payload[:256]
-        nonce = payload[256:268]
-        ciphertext = payload[268:]
+        # Sliced as memoryviews so the (possibly large) ciphertext is not copied
+        view = memoryview(payload)
+        encrypted_key = bytes(view[:256])
+        nonce = view[256:268]
+        ciphertext = view[268:]
         
         # 1. Decrypt AES Key
         aes_key = private_key.decrypt(
@@ -84,4 +139,15 @@ def hybrid_decrypt(payload: bytes, private_key) -> bytes:
     except Exception as e:
         # Decryption fails if auth tag is invalid (Tamper Resistance)
         print(f"Decryption/Integrity Error: {e}")
-        return None
\ No newline at end of file
+        return None
+
+def export_private_key(private_key) -> bytes:
+    """PEM-encodes a private key (unencrypted) so worker processes can load it."""
+    return private_key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption()
+    )
+
+def load_private_key(pem: bytes):
+    return serialization.load_pem_private_key(pem, password=None)
@@ -0,0 +1,372 @@
+import os
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from core.protocol import MSG_DHT, SUPPORTED_CODECS
+from core.compression import SUPPORTED_COMPRESSION
+from core.crypto import key_fingerprint
+
+K = 8                       # Bucket size / replication factor
+ALPHA = 3                   # Parallel RPCs per lookup round
+ID_BITS = 256               # Node ids are SHA-256 key fingerprints
+RPC_TIMEOUT = 3
+MAX_FAILURES = 2            # Unanswered RPCs before a contact is replaced
+PROVIDER_TTL = 30 * 60      # Provider records expire unless re-announced
+MAX_PROVIDER_KEYS = 4096    # Content keys we store records for (least recently announced dropped)
+MAX_PROVIDERS_PER_KEY = 2 * K
+REPUBLISH_INTERVAL = 10 * 60
+REFRESH_INTERVAL = 15 * 60
+MAX_PINNED = 4 * K          # Peers kept outside the table (e.g. providers being fetched from)
+
+def content_key(f_hash):
+    """Maps a content id (any string) into the fingerprint id space."""
+    return hashlib.sha256(f_hash.encode('utf-8')).hexdigest()
+
+def distance(a, b):
+    return int(a, 16) ^ int(b, 16)
+
+class RoutingTable:
+    """
+    Kademlia k-buckets keyed by XOR distance from our own fingerprint.
+    Bucket i holds contacts whose distance has its highest set bit at i.
+    Long-lived contacts are kept: a full bucket parks newcomers in a small
+    replacement cache, and one is promoted only when a member stops answering.
+    """
+    def __init__(self, own_fp, k=K):
+        self.own_fp = own_fp
+        self.k = k
+        self.buckets = [OrderedDict() for _ in range(ID_BITS)]      # fp -> contact, oldest first
+        self.replacements = [OrderedDict() for _ in range(ID_BITS)]
+        self.failures = {}
+        self.lock = threading.Lock()
+
+    def _bucket_index(self, fp):
+        return distance(self.own_fp, fp).bit_length() - 1
+
+    def update(self, contact):
+        """
+        Records that `contact` is alive. Returns True if it is (now) in the table,
+        False if its bucket is full and it was parked as a replacement.
+        """
+        fp = contact['fp']
+        if fp == self.own_fp: return False
+        idx = self._bucket_index(fp)
+        with self.lock:
+            bucket = self.buckets[idx]
+            self.failures.pop(fp, None)
+            if fp in bucket:
+                bucket[fp] = contact
+                bucket.move_to_end(fp)
+                return True
+            if len(bucket) < self.k:
+                bucket[fp] = contact
+                return True
+            spare = self.replacements[idx]
+            spare[fp] = contact
+            spare.move_to_end(fp)
+            while len(spare) > self.k:
+                spare.popitem(last=False)
+            return False
+
+    def fail(self, fp):
+        """
+        Counts an unanswered RPC. After MAX_FAILURES the contact is dropped and
+        the freshest replacement takes its slot. Returns (removed, promoted) contacts.
+        """
+        if fp == self.own_fp: return None, None
+        idx = self._bucket_index(fp)
+        with self.lock:
+            bucket = self.buckets[idx]
+            if fp not in bucket: return None, None
+            self.failures[fp] = self.failures.get(fp, 0) + 1
+            if self.failures[fp] < MAX_FAILURES: return None, None
+            del self.failures[fp]
+            removed = bucket.pop(fp)
+            promoted = None
+            if self.replacements[idx]:
+                promoted = self.replacements[idx].popitem(last=True)[1]
+                bucket[promoted['fp']] = promoted
+            return removed, promoted
+
+    def remove(self, fp):
+        if fp == self.own_fp: return
+        idx = self._bucket_index(fp)
+        with self.lock:
+            self.buckets[idx].pop(fp, None)
+            self.replacements[idx].pop(fp, None)
+
+    def contains(self, fp):
+        if fp == self.own_fp: return False
+        with self.lock:
+            return fp in self.buckets[self._bucket_index(fp)]
+
+    def closest(self, target, count=K):
+        with self.lock:
+            contacts = [c for bucket in self.buckets for c in bucket.values()]
+        return sorted(contacts, key=lambda c: distance(c['fp'], target))[:count]
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(b) for b in self.buckets)
+
+class DHTService:
+    """
+    Kademlia-style node and provider lookup over direct DHT frames.
+
+    RPCs (find_node, find_providers, add_provider) go straight to the
+    contact's data port, not through onion circuits: a lookup costs
+    O(log N) small frames instead of one RSA-wrapped onion per known peer.
+    This is not anonymous: every node queried sees our address and the
+    content key, which anyone can compute from a file id, so the nodes
+    closest to it learn who is looking for that file (and, from
+    add_provider, who holds it). Only the transfers themselves use circuits.
+    """
+    def __init__(self, node):
+        self.node = node
+        self.table = RoutingTable(node.fingerprint)
+        self.providers = OrderedDict()  # content key -> OrderedDict(fp -> (contact, expires)), oldest first
+        self.provided = set()  # content keys we announce ourselves
+        self.rpcs = {}        # rpc_id -> {"event", "result"}
+        self.lock = threading.Lock()
+        # RPC fan-out only; lookups themselves run on their caller's thread
+        self.rpc_pool = ThreadPoolExecutor(max_workers=ALPHA * 4, thread_name_prefix="dht-rpc")
+        self.bootstrapped = False
+        self.stats = {"rpcs": 0, "timeouts": 0, "lookups": 0}
+        threading.Thread(target=self._maintain, daemon=True).start()
+
+    def contact(self):
+        """Our own contact record, as sent in every RPC."""
+        bind_ip = self.node.bind_ip
+        return {
+            "host": bind_ip if bind_ip not in ('0.0.0.0', '') else self.node.get_local_ip(),
+            "port": self.node.port,
+            "pub_key": self.node.pub_key.decode('utf-8'),
+            "codecs": SUPPORTED_CODECS,
+            "compression": SUPPORTED_COMPRESSION
+        }
+
+    # --- Wire ---
+    def _rpc(self, contact, method, args):
+        """Sends one request and waits for its reply. Returns the result dict or None."""
+        rpc_id = os.urandom(8).hex()
+        waiter = {"event": threading.Event(), "result": None}
+        with self.lock:
+            self.rpcs[rpc_id] = waiter
+            self.stats["rpcs"] += 1
+        start = time.perf_counter()
+        self.node.send_raw(contact['host'], contact['port'], MSG_DHT, {
+            "rpc": rpc_id, "method": method, "args": args, "sender": self.contact()
+        })
+        answered = waiter["event"].wait(RPC_TIMEOUT)
+        with self.lock:
+            self.rpcs.pop(rpc_id, None)
+        if not answered:
+            with self.lock:
+                self.stats["timeouts"] += 1
+            self._failed(contact)
+            self.node.metrics.record_failure(f"{contact['host']}:{contact['port']}")
+            return None
+        # A DHT round trip doubles as a passive RTT sample
+        self.node.metrics.record_rtt(f"{contact['host']}:{contact['port']}", time.perf_counter() - start)
+        if contact.get('fp'): self.table.update(contact)
+        return waiter["result"]
+
+    def handle(self, payload):
+        """Entry point for DHT frames (requests and replies)."""
+        sender = payload.get('sender')
+        if sender and not self._learn(sender):
+            sender = None  # Pinned to another key (or unusable): no reply, no provider record
+
+        if 'reply' in payload:
+            with self.lock:
+                waiter = self.rpcs.get(payload['reply'])
+            if waiter:
+                waiter["result"] = payload.get('result') or {}
+                waiter["event"].set()
+            return
+
+        method = payload.get('method')
+        args = payload.get('args') or {}
+        if method == "find_node":
+            result = {"nodes": self._export(self.table.closest(args.get('target', ''), K))}
+        elif method == "find_providers":
+            key = args.get('key', '')
+            result = {
+                "providers": self._export(self.local_providers(key)),
+                "nodes": self._export(self.table.closest(key, K))
+            }
+        elif method == "add_provider":
+            # A node can only announce itself: the record is the sender's own contact
+            if not sender: return
+            self._store_provider(args.get('key', ''), dict(sender))
+            result = {"ok": True}
+        else:
+            return
+        if sender:
+            self.node.send_raw(sender['host'], sender['port'], MSG_DHT, {
+                "reply": payload.get('rpc'), "result": result
+            })
+
+    def _export(self, contacts):
+        return [{"host": c['host'], "port": c['port'],
+                 "pub_key": c['pub_key'].decode('utf-8') if isinstance(c['pub_key'], bytes) else c['pub_key'],
+                 "codecs": c.get('codecs', []), "compression": c.get('compression', [])} for c in contacts]
+
+    def _failed(self, contact):
+        fp = contact.get('fp')
+        if not fp: return
+        removed, promoted = self.table.fail(fp)
+        if removed:
+            self.node.remove_peer(f"{removed['host']}:{removed['port']}")
+        if promoted:
+            self.node.add_peer(promoted)
+
+    # --- Routing table membership (called from OnionNode.add_peer) ---
+    def admit(self, peer_data):
+        """True if the peer should be kept in node.peers (it has a bucket slot)."""
+        admitted = self.table.update(peer_data)
+        if admitted and not self.bootstrapped:
+            self.bootstrapped = True
+            self._background(self._join)
+        return admitted
+
+    def _join(self):
+        # A lookup of our own id fills the buckets near us; then publish
+        # anything announced before we had contacts (e.g. resumed downloads)
+        self.lookup(self.node.fingerprint)
+        with self.lock:
+            provided = list(self.provided)
+        for key in provided:
+            self._announce_key(key)
+
+    # --- Providers ---
+    def _store_provider(self, key, contact):
+        if not isinstance(key, str) or len(key) != ID_BITS // 4 or not contact.get('pub_key'): return
+        fp = contact['fp'] = contact.get('fp') or key_fingerprint(contact['pub_key'])
+        with self.lock:
+            records = self.providers.get(key)
+            if records is None:
+                records = self.providers[key] = OrderedDict()
+                if len(self.providers) > MAX_PROVIDER_KEYS:
+                    self.providers.popitem(last=False)
+            self.providers.move_to_end(key)
+            records[fp] = (contact, time.time() + PROVIDER_TTL)
+            records.move_to_end(fp)
+            if len(records) > MAX_PROVIDERS_PER_KEY:
+                records.popitem(last=False)
+
+    def local_providers(self, key):
+        now = time.time()
+        with self.lock:
+            records = self.providers.get(key, {})
+            return [c for c, expires in records.values() if expires > now]
+
+    def announce(self, f_hash):
+        """Registers us as a provider of `f_hash` on the K nodes closest to it (async)."""
+        key = content_key(f_hash)
+        with self.lock:
+            self.provided.add(key)
+        if self.bootstrapped:
+            self._background(self._announce_key, key)
+
+    def withdraw(self, f_hash):
+        """Stops re-announcing `f_hash`; records already stored expire after PROVIDER_TTL."""
+        with self.lock:
+            self.provided.discard(content_key(f_hash))
+
+    def _background(self, fn, *args):
+        threading.Thread(target=fn, args=args, daemon=True).start()
+
+    def _announce_key(self, key):
+        closest = self.lookup(key)
+        for contact in closest:
+            self._rpc(contact, "add_provider", {"key": key})
+
+    def find_providers(self, f_hash):
+        """
+        Iterative lookup that stops at the first round returning provider records.
+        Returns provider contacts (already registered as peers), nearest first.
+        """
+        key = content_key(f_hash)
+        found = {}
+        for raw in self.local_providers(key):
+            peer = self._learn(raw, keep=True)
+            if peer: found[peer['fp']] = peer
+        if not found:
+            self.lookup(key, providers=found)
+        return sorted(found.values(), key=lambda c: distance(c['fp'], key))
+
+    # --- Iterative lookup ---
+    def lookup(self, target, providers=None):
+        """
+        Kademlia node lookup: repeatedly asks the ALPHA closest not-yet-queried
+        contacts for nodes closer to `target`, until the K closest seen have all
+        answered. With `providers` (a dict), runs find_providers instead and
+        stops as soon as any provider is found. Returns the K closest contacts.
+        """
+        with self.lock:
+            self.stats["lookups"] += 1
+        method = "find_node" if providers is None else "find_providers"
+        args = {"target": target} if providers is None else {"key": target}
+        shortlist = {c['fp']: c for c in self.table.closest(target, K)}
+        queried = set()
+
+        while True:
+            ranked = sorted(shortlist.values(), key=lambda c: distance(c['fp'], target))[:K]
+            batch = [c for c in ranked if c['fp'] not in queried][:ALPHA]
+            if not batch: return ranked
+            queried.update(c['fp'] for c in batch)
+            results = self.rpc_pool.map(lambda c: self._rpc(c, method, args), batch)
+            for contact, result in zip(batch, results):
+                if result is None:
+                    shortlist.pop(contact['fp'], None)
+                    continue
+                for raw in result.get('nodes', []):
+                    peer = self._learn(raw)
+                    if peer: shortlist.setdefault(peer['fp'], peer)
+                if providers is not None:
+                    for raw in result.get('providers', []):
+                        peer = self._learn(raw, keep=True)
+                        if peer: providers[peer['fp']] = peer
+            if providers:
+                return sorted(shortlist.values(), key=lambda c: distance(c['fp'], target))[:K]
+
+    def _learn(self, raw, keep=False):
+        """
+        Turns a contact from a frame or reply into a peer record (with 'fp').
+        Contacts are unauthenticated, so a new one must pass the known_hosts
+        check and a known host:port must keep its key. None if unusable,
+        refused, or ourselves.
+        """
+        try:
+            peer = dict(raw)
+            pid = f"{peer['host']}:{peer['port']}"
+            if pid not in self.node.peers and not self.node.discovery.vouch(peer): return None
+            self.node.add_peer(peer, keep=keep)
+        except Exception:
+            return None
+        if not peer.get('fp') or peer['fp'] == self.node.fingerprint: return None
+        known = self.node.peers.get(pid)
+        if known and known['fp'] != peer['fp']: return None
+        return peer
+
+    def _maintain(self):
+        last_refresh = last_publish = time.time()
+        while True:
+            time.sleep(30)
+            now = time.time()
+            with self.lock:
+                for key in list(self.providers):
+                    live = OrderedDict((fp, r) for fp, r in self.providers[key].items() if r[1] > now)
+                    if live: self.providers[key] = live
+                    else: del self.providers[key]
+                provided = list(self.provided)
+            if now - last_refresh >= REFRESH_INTERVAL and len(self.table):
+                last_refresh = now
+                self._background(self.lookup, self.node.fingerprint)
+            if now - last_publish >= REPUBLISH_INTERVAL:
+                last_publish = now
+                for key in provided:
+                    self._background(self._announce_key, key)
@@ -3,7 +3,8 @@ import threading
 import time
 import json
 import os
-from core.protocol import MSG_HELLO, MSG_PEX, serialize, deserialize
+from core.protocol import MSG_HELLO, MSG_PEX, SUPPORTED_CODECS, serialize, deserialize
+from core.compression import SUPPORTED_COMPRESSION
 
 # Security: File to store trusted peer identities
 KNOWN_HOSTS_FILE = "known_hosts.json"
@@ -15,9 +16,12 @@ class DiscoveryService(threading.Thread):
         self.running = True
         self.discovery_port = 0  # Will be assigned dynamically by OS
         self.known_hosts = self._load_known_hosts()
+        self.hosts_lock = threading.Lock()  # vouch() runs on DHT and relay threads too
         
-        # DEV MODE: Auto-reset trust (only when explicitly enabled)
-        if os.getenv("DISCOVERY_DEV_MODE") == "1":
+        # DEV MODE: Auto-reset trust, and pin keys per host:port so several
+        # nodes on one machine do not look like MITMs (only when explicitly enabled)
+        self.dev_mode = os.getenv("DISCOVERY_DEV_MODE") == "1"
+        if self.dev_mode:
             if os.path.exists(KNOWN_HOSTS_FILE):
                 try:
                     os.remove(KNOWN_HOSTS_FILE)
@@ -73,7 +77,9 @@ class DiscoveryService(threading.Thread):
         msg = {
             "host": self.node.get_local_ip(),
             "port": self.node.port,         # My TCP Data Port
-            "pub_key": self.node.pub_key.decode('utf-8')
+            "pub_key": self.node.pub_key.decode('utf-8'),
+            "codecs": SUPPORTED_CODECS,
+            "compression": SUPPORTED_COMPRESSION
         }
         try:
             s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -89,7 +95,9 @@ class DiscoveryService(threading.Thread):
             pex_data.append({
                 "host": meta['host'],
                 "port": meta['port'],
-                "pub_key": meta['pub_key'].decode('utf-8') if isinstance(meta['pub_key'], bytes) else meta['pub_key']
+                "pub_key": meta['pub_key'].decode('utf-8') if isinstance(meta['pub_key'], bytes) else meta['pub_key'],
+                "codecs": meta.get('codecs', []),
+                "compression": meta.get('compression', [])
             })
         
         try:
@@ -150,9 +158,27 @@ class DiscoveryService(threading.Thread):
                 continue
 
     def _validate_and_add_peer(self, payload):
+        peer_id = f"{payload.get('host')}:{payload.get('port')}"
+        if not self.vouch(payload):
+            return False
+
+        if peer_id not in self.node.peers and self.node.add_peer(payload):
+            print(f"[NEW] Peer Linked: {peer_id}")
+            return True
+        
+        return False
+
+    def vouch(self, payload):
+        """
+        Known-hosts (TOFU) check for a peer record from any source: discovery,
+        PEX, HELLO on a data link or a DHT contact. False if it is us or its
+        host is pinned to another key; a new host is pinned to this one.
+        """
         peer_host = payload.get('host')
         peer_port = payload.get('port')
         peer_key = payload.get('pub_key')
+        if isinstance(peer_key, bytes):
+            peer_key = peer_key.decode('utf-8')
         peer_id = f"{peer_host}:{peer_port}"
 
         if peer_port == self.node.port and peer_host == self.node.get_local_ip():
@@ -161,19 +187,14 @@ class DiscoveryService(threading.Thread):
         # TOFU: Use host (without port) as the stable identifier
         # This allows peers to legitimately change their TCP port between sessions
         # without being flagged as MITM attacks
-        trusted_id = peer_host
-        
-        if trusted_id in self.known_hosts:
-            if self.known_hosts[trusted_id] != peer_key:
-                print(f"[SECURITY] BLOCKED MITM: {peer_id} (key mismatch for {trusted_id})")
-                return False
-        else:
-            self.known_hosts[trusted_id] = peer_key
-            self._save_known_hosts()
-
-        if peer_id not in self.node.peers:
-            print(f"[NEW] Peer Linked: {peer_id}")
-            self.node.add_peer(payload)
-            return True
+        trusted_id = peer_id if self.dev_mode else peer_host
         
-        return False
\ No newline at end of file
+        with self.hosts_lock:
+            if trusted_id in self.known_hosts:
+                if self.known_hosts[trusted_id] != peer_key:
+                    print(f"[SECURITY] BLOCKED MITM: {peer_id} (key mismatch for {trusted_id})")
+                    return False
+            else:
+                self.known_hosts[trusted_id] = peer_key
+                self._save_known_hosts()
+        return True
\ No newline at end of file
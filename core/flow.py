@@ -0,0 +1,124 @@
+import threading
+from collections import deque
+
+# SENDME-style windows (counted in cells). The originator may have this many
+# cells in flight on a circuit, and per stream (module) on that circuit. Cells
+# are numbered, and each time the highest number the exit has delivered passes
+# a multiple of SENDME_INCREMENT it sends that number back (cumulative), so a
+# cell dropped on the way, or a lost SENDME, is credited by the next one.
+CIRCUIT_WINDOW = 256
+STREAM_WINDOW = 128
+SENDME_INCREMENT = 32
+# Reply stream cells (exit -> originator, see ReplyPath) in flight per circuit;
+# the originator's per-circuit reply queue (QUEUE_BYTES) holds them all
+REPLY_WINDOW = 48
+# A sender blocked this long on a closed window gives up on the circuit
+# (a lost SENDME must not wedge it forever) and retires it
+WINDOW_TIMEOUT = 10
+
+# Per-next-hop relay queues
+QUEUE_FRAMES = 512
+QUEUE_BYTES = 4 * 1024 * 1024
+# How long a relay blocks the inbound link before dropping a frame; kept
+# below transport.IO_TIMEOUT so the upstream sender's link survives the stall
+BACKPRESSURE_TIMEOUT = 5
+SENDER_IDLE = 5            # Seconds before an empty queue's sender thread exits
+
+def crossed(old, new, step=SENDME_INCREMENT):
+    """True if a cumulative cell count went past a multiple of `step` (time for a SENDME)."""
+    return new // step > old // step
+
+class Window:
+    """Credit counter the originator takes from per cell and the exit refills via SENDME."""
+    def __init__(self, size):
+        self.credits = size
+        self.cond = threading.Condition()
+
+    def take(self, timeout=WINDOW_TIMEOUT):
+        """Consumes one credit, waiting for a SENDME if none are left. Returns False on timeout."""
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.credits > 0, timeout):
+                return False
+            self.credits -= 1
+            return True
+
+    def refill(self, n=SENDME_INCREMENT):
+        with self.cond:
+            self.credits += n
+            self.cond.notify_all()
+
+class OutboundQueues:
+    """
+    Bounded send queues, one per destination (a next hop, or the link a
+    backward cell returns on), each drained in order by its own sender thread.
+    - A slow or dead hop only ties up its own sender, not every relay thread.
+    - put() on a full queue blocks the caller, i.e. the inbound link's reader,
+      so the kernel buffers fill and TCP pushes back on the previous hop.
+      If the queue is still full after BACKPRESSURE_TIMEOUT the frame is dropped,
+      which keeps relay memory at QUEUE_BYTES per destination.
+    """
+    def __init__(self, max_frames=QUEUE_FRAMES, max_bytes=QUEUE_BYTES):
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.queues = {}  # key -> {"items": deque of (send, args, nbytes), "bytes": int, "max_depth": int}
+        self.cond = threading.Condition()
+        self.counters = {"queued": 0, "sent": 0, "blocked": 0, "dropped": 0}
+
+    def _full(self, q, nbytes):
+        # NOTE: Must be called while self.cond is held
+        # An empty queue takes any one frame, however large
+        return q["items"] and (len(q["items"]) >= self.max_frames or q["bytes"] + nbytes > self.max_bytes)
+
+    def accepts(self, key, nbytes):
+        """True if put(key, ...) of nbytes would queue without waiting."""
+        with self.cond:
+            q = self.queues.get(key)
+            return q is None or not self._full(q, nbytes)
+
+    @property
+    def saturated(self):
+        """True while any destination's queue is full."""
+        with self.cond:
+            return any(self._full(q, 0) for q in self.queues.values())
+
+    def put(self, key, send, args, nbytes, timeout=BACKPRESSURE_TIMEOUT):
+        """Queues send(*args). Returns False if the frame was dropped."""
+        with self.cond:
+            q = self.queues.get(key)
+            if q is None:
+                q = self.queues[key] = {"items": deque(), "bytes": 0, "max_depth": 0}
+                threading.Thread(target=self._drain, args=(key, q), daemon=True).start()
+            if self._full(q, nbytes):
+                self.counters["blocked"] += 1
+                if not self.cond.wait_for(lambda: not self._full(q, nbytes), timeout):
+                    self.counters["dropped"] += 1
+                    return False
+            q["items"].append((send, args, nbytes))
+            q["bytes"] += nbytes
+            q["max_depth"] = max(q["max_depth"], len(q["items"]))
+            self.counters["queued"] += 1
+            self.cond.notify_all()
+            return True
+
+    def _drain(self, key, q):
+        while True:
+            with self.cond:
+                if not self.cond.wait_for(lambda: q["items"], SENDER_IDLE):
+                    del self.queues[key]
+                    return
+                send, args, nbytes = q["items"].popleft()
+                q["bytes"] -= nbytes
+                self.cond.notify_all()
+            try:
+                send(*args)
+                self.counters["sent"] += 1
+            except Exception as e:
+                print(f"[RELAY] Queued send to {key} failed: {e}")
+
+    def stats(self):
+        """Queue depths per destination plus totals, for the dashboard."""
+        with self.cond:
+            return dict(self.counters, queues={
+                str(key): {"depth": len(q["items"]), "bytes": q["bytes"], "max_depth": q["max_depth"]}
+                for key, q in self.queues.items()
+            })
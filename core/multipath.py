@@ -0,0 +1,35 @@
+# Multipath striping: one stream, or a run of bulk messages, spread across
+# several circuits to the same exit whose middle relays are disjoint, so the
+# transfer is not capped by the slowest relay of a single path.
+MAX_PATHS = 4
+# Rate assumed for a path with no SENDME yet. Relative only: unmeasured paths
+# rank like the best measured one, so each gets probed early in a transfer.
+DEFAULT_CELL_RATE = 1.0
+# A path expected to take this many times longer than the best one is left
+# out of a parity group; the group gets smaller instead of waiting on it
+LAG_FACTOR = 2
+
+def pick_paths(circuits, count, stream):
+    """
+    The `count` circuits expected to deliver one more cell soonest (cells in
+    flight over measured delivery rate), so faster paths get more cells as
+    their SENDMEs come back. Paths that are retired, that have a shut window
+    (while another is open) or that lag the best one by LAG_FACTOR are left
+    out, so fewer than `count` may come back, never none.
+    """
+    usable = [c for c in circuits if not c.retired] or list(circuits)
+    known = [c.ack_rate for c in usable if c.ack_rate]
+    default = max(known) if known else DEFAULT_CELL_RATE
+    ranked = sorted(((c.would_block(stream), c.expected_delay(default), c) for c in usable),
+                    key=lambda r: r[:2])
+    best_blocked, best_delay, _ = ranked[0]
+    return [c for blocked, delay, c in ranked[:count]
+            if blocked == best_blocked and delay <= best_delay * LAG_FACTOR]
+
+def xor_bytes(pieces):
+    """XOR of byte strings, each zero-padded to the longest."""
+    size = max((len(p) for p in pieces), default=0)
+    acc = 0
+    for piece in pieces:
+        acc ^= int.from_bytes(bytes(piece).ljust(size, b"\0"), 'big')
+    return acc.to_bytes(size, 'big')
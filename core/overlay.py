@@ -1,29 +1,74 @@
+import os
 import socket
-import struct
+import threading
+from collections import OrderedDict
 from core.relay import RelayService
+from core.async_relay import AsyncRelayService
+from core.transport import ConnectionPool, COALESCE_DELAY
 from core.discovery import DiscoveryService
-from core.circuit import CircuitManager
-from core.protocol import serialize, MSG_ONION
-from core.crypto import generate_rsa_keypair
+from core.circuit import CircuitManager, CIRCUIT_LIFETIME, CIRCUIT_MAX_MESSAGES
+from core.dht import DHTService, MAX_PINNED
+from core.compression import Compressor
+from core.peer_metrics import PeerMetrics, PATH_BIAS, WEIGHT_CAP
+from core.scheduler import OutboundScheduler, classify
+from core.stream import StreamReceiver, stream_cells
+from core.multipath import pick_paths, xor_bytes, MAX_PATHS
+from core.protocol import serialize_parts, negotiate_codec, MSG_CREATE, MSG_CELL
+from core.crypto import generate_rsa_keypair, load_public_key, key_fingerprint
 
 # Import Modules
 from modules.chat import ChatModule
 from modules.encrypted_torrent import TorrentModule
 from modules.http_proxy import ProxyModule
 
+# Relay engines selectable at construction
+RELAY_ENGINES = {
+    "threaded": RelayService,       # Thread per inbound link
+    "asyncio": AsyncRelayService    # Single event loop + decrypt executor
+}
+
 class OnionNode:
-    def __init__(self, bind_ip='0.0.0.0'):
+    def __init__(self, bind_ip='0.0.0.0', engine="threaded", peel_workers=0,
+                 circuit_lifetime=CIRCUIT_LIFETIME, circuit_max_messages=CIRCUIT_MAX_MESSAGES,
+                 path_bias=PATH_BIAS, weight_cap=WEIGHT_CAP, coalesce_delay=COALESCE_DELAY,
+                 multipath=1, multipath_parity=0):
         self.bind_ip = bind_ip
+        # Streams and bulk messages are striped across this many circuits (1 = off);
+        # streams add an XOR parity cell per `multipath_parity` data cells (0 = none)
+        self.multipath = max(1, min(multipath, MAX_PATHS))
+        self.multipath_parity = multipath_parity
         self.private_key, self.pub_key = generate_rsa_keypair()
+        self.fingerprint = key_fingerprint(self.pub_key)
         self.peers = {} 
+        self.peer_index = {}  # key fingerprint -> peer_id
+        self.pinned = OrderedDict()  # peer_id of peers kept outside the routing table, oldest first
+        self.peers_lock = threading.Lock()
+        self.compressor = Compressor()
+        # Orders our own module traffic by class (chat ahead of bulk chunks) and rate limits
+        self.scheduler = OutboundScheduler()
+        # RTT / throughput per peer; weights middle-relay selection
+        self.metrics = PeerMetrics(self, path_bias=path_bias, weight_cap=weight_cap)
+        # Kademlia routing table; decides which peers are kept
+        self.dht = DHTService(self)
+        # Reassembles stream cells addressed to our modules (we are the exit)
+        self.streams = StreamReceiver(self)
+        # TOFU key pinning for every peer we learn second-hand (PEX, DHT, HELLO)
+        self.discovery = DiscoveryService(self)
 
-        self.relay = RelayService(self)
+        if engine not in RELAY_ENGINES:
+            raise ValueError(f"Unknown relay engine '{engine}' (choose from {', '.join(RELAY_ENGINES)})")
+        # peel_workers > 0 moves RSA layer decrypts to a process pool
+        self.relay = RELAY_ENGINES[engine](self, peel_workers=peel_workers)
+        # Frames peers send back on our outbound links go through the same dispatch.
+        # A coalesced write that fails after send_raw returned still counts toward demotion.
+        self.pool = ConnectionPool(on_frame=self.relay.handle_frame, coalesce_delay=coalesce_delay,
+                                   on_failure=lambda key: self.metrics.record_failure(f"{key[0]}:{key[1]}"))
         self.port = self.relay.bind_and_listen(range(6000, 6010), bind_ip=self.bind_ip)
         self.relay.start()
 
-        self.discovery = DiscoveryService(self)
         self.discovery.start()
-        self.circuit_mgr = CircuitManager(self)
+        # Circuits are pooled per exit and reused up to these limits
+        self.circuit_mgr = CircuitManager(self, lifetime=circuit_lifetime, max_messages=circuit_max_messages)
 
         self.modules = {
             "chat": ChatModule(self),
@@ -32,24 +77,95 @@ class OnionNode:
         }
 
     def send_raw(self, host, port, msg_type, payload):
-        """TCP send with length prefixing."""
+        """
+        Length-prefixed send over the pooled link to (host, port),
+        in the codec negotiated with that peer. Failures count toward demotion.
+        Large byte fields go to the socket by reference (vectored write).
+        """
+        pid = f"{host}:{port}"
         try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.settimeout(5)
-            s.connect((host, port))
-            
-            data = serialize(msg_type, payload)
-            packed_data = struct.pack('>I', len(data)) + data
-            s.sendall(packed_data)
-            s.close()
+            codec = negotiate_codec(self.peers.get(pid))
+            parts = serialize_parts(msg_type, payload, codec)
+            self.pool.send(host, port, parts)
+        except OSError as e:
+            self.metrics.record_failure(pid)
+            print(f"Send failed: {e}")
         except Exception as e:
             print(f"Send failed: {e}")
 
-    def add_peer(self, peer_data):
+    def stats(self):
+        """Transport / relay counters for the dashboard."""
+        return {
+            "links": dict(self.pool.stats),
+            "circuits_relayed": len(self.relay.circuits),
+            "circuit_pool": self.circuit_mgr.stats(),
+            "relay_queues": self.relay.outbound.stats(),
+            "scheduler": {"classes": self.scheduler.stats(), "config": self.scheduler.config()},
+            "peel_pool": self.relay.peel_pool.timings() if self.relay.peel_pool else None,
+            "dht": dict(self.dht.stats, contacts=len(self.dht.table)),
+            "streams": self.streams.stats(),
+            "exit_fetcher": self.modules["proxy"].fetcher.stats(),
+            "compression": self.compressor.summary(),
+            "peer_metrics": self.metrics.summary()
+        }
+
+    def add_peer(self, peer_data, keep=False):
+        """
+        Registers a peer with its key parsed once ('key_obj') and indexed by
+        fingerprint ('fp'), so per-packet encryption and key lookups are O(1).
+        Only peers with a slot in the DHT routing table are kept, so the peer
+        set stays O(k log N); `keep` pins one anyway (e.g. a content provider
+        we are about to fetch from), up to MAX_PINNED, least recent first out.
+        A known peer_id never changes key here; it has to be removed first.
+        Returns True if the peer is in self.peers.
+        """
         pid = f"{peer_data['host']}:{peer_data['port']}"
         if isinstance(peer_data['pub_key'], str):
             peer_data['pub_key'] = peer_data['pub_key'].encode('utf-8')
-        self.peers[pid] = peer_data
+        try:
+            peer_data['key_obj'] = load_public_key(peer_data['pub_key'])
+        except Exception as e:
+            print(f"[!] Rejected peer {pid}: invalid public key ({e})")
+            return False
+        peer_data['fp'] = key_fingerprint(peer_data['key_obj'])
+        if peer_data['fp'] == self.fingerprint: return False
+        previous = self.peers.get(pid)
+        if previous and previous['fp'] != peer_data['fp']:
+            print(f"[SECURITY] Refused key change for known peer {pid}")
+            return False
+        admitted = self.dht.admit(peer_data)
+        if not admitted and not keep and pid not in self.peers:
+            return False
+
+        evicted = []
+        with self.peers_lock:
+            previous = self.peers.get(pid)
+            if previous and previous['fp'] != peer_data['fp']: return False
+            self.peers[pid] = peer_data
+            self.peer_index[peer_data['fp']] = pid
+            if admitted:
+                self.pinned.pop(pid, None)
+            elif keep or pid in self.pinned:
+                self.pinned[pid] = True
+                self.pinned.move_to_end(pid)
+                while len(self.pinned) > MAX_PINNED:
+                    evicted.append(self.pinned.popitem(last=False)[0])
+        for old in evicted:
+            self.remove_peer(old)
+        return True
+
+    def remove_peer(self, pid):
+        with self.peers_lock:
+            self.pinned.pop(pid, None)
+            peer = self.peers.pop(pid, None)
+            if peer and self.peer_index.get(peer['fp']) == pid:
+                del self.peer_index[peer['fp']]
+        if peer:
+            self.dht.table.remove(peer['fp'])
+
+    def find_peer_by_fp(self, fp):
+        """Maps a key fingerprint to a peer_id (None if unknown)."""
+        return self.peer_index.get(fp)
 
     def get_local_ip(self):
         """
@@ -64,21 +180,154 @@ class OnionNode:
         except Exception:
             return '127.0.0.1'
 
-    def send_onion_to_peer(self, target_peer_id, destination_module, payload):
+    def send_onion_to_peer(self, target_peer_id, destination_module, payload, paths=1):
+        """
+        Sends one message to the module on target_peer_id. With paths > 1 it
+        goes down whichever of that many disjoint circuits is expected to
+        deliver it soonest, so a run of bulk messages is spread across them.
+        """
         if target_peer_id not in self.peers: return
         target = self.peers[target_peer_id]
-        circuit = self.circuit_mgr.build_circuit_to_target(target)
+        if paths > 1:
+            circuits = self.circuit_mgr.get_circuits(target_peer_id, target, min(paths, MAX_PATHS))
+            if not circuits: return
+            self._dispatch_cell(pick_paths(circuits, 1, destination_module)[0], False,
+                                target_peer_id, destination_module, payload)
+            return
+        circuit, is_new = self.circuit_mgr.get_circuit(target_peer_id, target)
         if not circuit: return
-        self._dispatch_onion(circuit, destination_module, payload)
+        self._dispatch_cell(circuit, is_new, target_peer_id, destination_module, payload)
 
-    def _dispatch_onion(self, circuit, destination_module, payload):
+    def send_stream(self, target_peer_id, destination_module, meta, chunks, paths=None, parity=None):
+        """
+        Sends `chunks` (bytes, or any iterable of byte strings such as a file
+        reader or an HTTP body) to the module on target_peer_id as one stream:
+        sequenced cells of at most STREAM_CELL_SIZE bytes. Chunks are pulled
+        only as window credits allow, so the payload is never held whole.
+        The module gets receive_stream(meta, stream).
+        - paths > 1 (default: self.multipath) stripes the cells across that
+          many circuits with disjoint middles; each cell goes to the path
+          expected to deliver it soonest, so faster paths carry more.
+        - parity=K (default: self.multipath_parity) follows every K data cells
+          with their XOR, each of the K+1 on a different path, so the exit can
+          rebuild one lost cell per group, e.g. what a stalled path was carrying.
+          Groups shrink while some paths lag far behind (see pick_paths).
+        If `chunks` raises, the stream is aborted at the exit too.
+        Returns the bytes sent, or None if there was no circuit.
+        """
+        if target_peer_id not in self.peers: return None
+        target = self.peers[target_peer_id]
+        paths = self.multipath if paths is None else paths
+        parity = self.multipath_parity if parity is None else parity
+        fresh = set()  # Circuits whose first cell must ride in the CREATE
+        if paths > 1:
+            circuits = self.circuit_mgr.get_circuits(target_peer_id, target, min(paths, MAX_PATHS))
+        else:
+            circuit, is_new = self.circuit_mgr.get_circuit(target_peer_id, target)
+            circuits = [circuit] if circuit else []
+            if is_new: fresh.add(id(circuit))
+        if not circuits: return None
+
+        stream_id = os.urandom(8).hex()
+        traffic_class = classify(destination_module, meta)
+
+        def send(circuit, cell):
+            self._send_cell(circuit, id(circuit) in fresh, target_peer_id, cell, traffic_class)
+            fresh.discard(id(circuit))
+
+        seq, sent, first = 0, 0, 0
+        group, group_paths = [], []  # Pieces of the current parity group, and its paths
+        cell = {"module": destination_module, "stream": stream_id, "seq": 0, "payload": meta}
+        try:
+            for piece, fin in stream_cells(chunks):
+                if not group_paths:
+                    group_paths = pick_paths(circuits, parity + 1 if parity else 1, destination_module)
+                    first = seq
+                k = len(group_paths) - 1  # Data cells covered by this group's parity cell (0: no parity)
+                cell.update(seq=seq, fin=fin, data=piece)
+                if k: cell["group"] = first
+                send(group_paths[len(group)], cell)
+                group.append(piece)
+                seq += 1
+                sent += len(piece)
+                cell = {"module": destination_module, "stream": stream_id}
+                if len(group) == max(k, 1) or fin:
+                    if k:
+                        check = {"module": destination_module, "stream": stream_id, "parity": first,
+                                 "lens": [len(p) for p in group], "fin": fin, "data": xor_bytes(group)}
+                        if first == 0: check["payload"] = meta
+                        send(group_paths[k], check)
+                    group, group_paths = [], []
+        except Exception as e:
+            print(f"[STREAM] Aborting stream {stream_id} to {target_peer_id}: {e}")
+            cell.update(seq=seq, fin=True, data=b"", error=str(e))
+            send(pick_paths(circuits, 1, destination_module)[0], cell)
+        return sent
+
+    def _dispatch_cell(self, circuit, is_new, target_peer_id, destination_module, payload):
         final_payload = {"module": destination_module, "payload": payload}
-        onion_packet = self.circuit_mgr.wrap_onion(final_payload, circuit)
-        entry_node = circuit[0]
-        self.send_raw(entry_node['host'], entry_node['port'], MSG_ONION, onion_packet)
+        self._send_cell(circuit, is_new, target_peer_id, final_payload, classify(destination_module, payload))
 
-    def handle_exit_traffic(self, data):
+    def _send_cell(self, circuit, is_new, target_peer_id, final_payload, traffic_class):
+        """
+        First message on a circuit rides inside the CREATE handshake (RSA per hop);
+        every later one is a symmetric-only cell. Either is handed to the
+        scheduler, which decides when it goes on the wire.
+        """
+        destination_module = final_payload["module"]
+        entry_node = circuit.path[0]
+        # Blocks while the exit has not acknowledged enough earlier cells
+        self.circuit_mgr.acquire(circuit, destination_module)
+        final_payload["n"], final_payload["sn"] = circuit.number(destination_module)
+        link = (entry_node['host'], entry_node['port'])
+        if is_new:
+            queued = False
+            try:
+                create_packet = self.circuit_mgr.wrap_create(final_payload, circuit)
+                circuit.note_size(final_payload["n"], len(create_packet))
+                # Cells wait until the CREATE is in the entry link's queue, so none can overtake it
+                queued = self.scheduler.submit("control", target_peer_id, destination_module, len(create_packet),
+                                               self.send_raw, link + (MSG_CREATE, create_packet), link=link,
+                                               on_queued=circuit.established.set)
+            finally:
+                if not queued: circuit.established.set()
+        else:
+            # Should one still overtake it (wait timed out), the entry relay holds it until the CREATE lands
+            circuit.established.wait(timeout=5)
+            cell = self.circuit_mgr.wrap_cell(final_payload, circuit)
+            circuit.note_size(final_payload["n"], len(cell['data']))
+            self.scheduler.submit(traffic_class, target_peer_id, destination_module, len(cell['data']),
+                                  self.send_raw, link + (MSG_CELL, cell), link=link)
+
+    def send_reply(self, reply, reply_to_fp, destination_module, payload, paths=1):
+        """
+        Answers a request: back along the requester's own circuit when it
+        came with a ReplyPath, else over a circuit of ours to the peer with
+        fingerprint reply_to_fp (when we know it).
+        """
+        if reply is not None and reply.send(destination_module, payload): return
+        target_peer_id = self.find_peer_by_fp(reply_to_fp)
+        if target_peer_id:
+            self.send_onion_to_peer(target_peer_id, destination_module, payload, paths=paths)
+
+    def send_reply_stream(self, reply, reply_to_fp, destination_module, meta, chunks):
+        """send_reply for a stream. Returns the bytes sent, or None if there was no way back."""
+        if reply is not None:
+            sent = reply.send_stream(destination_module, meta, chunks)
+            if sent is not None: return sent
+        target_peer_id = self.find_peer_by_fp(reply_to_fp)
+        if not target_peer_id: return None
+        return self.send_stream(target_peer_id, destination_module, meta, chunks)
+
+    def handle_exit_traffic(self, data, reply=None):
+        """
+        A message for one of our modules: as the exit of someone's circuit
+        (`reply` leads back along it), or a reply on one of our own circuits.
+        """
+        if data.get('stream'):
+            self.streams.receive(data, reply)
+            return
         module_name = data.get('module')
         content = data.get('payload')
         if module_name in self.modules:
-            self.modules[module_name].receive(content)
\ No newline at end of file
+            self.modules[module_name].receive(content, reply)
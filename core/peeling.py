@@ -0,0 +1,146 @@
+import json
+import base64
+import queue
+import threading
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from core.crypto import hybrid_decrypt, export_private_key, load_private_key
+from core.protocol import unpack_payload
+
+def peel_onion_layer(encrypted_data, private_key):
+    """RSA-peels one legacy ONION layer. Returns (next_hop, inner_data) or None."""
+    decrypted_bytes = hybrid_decrypt(encrypted_data, private_key)
+    if decrypted_bytes is None: return None
+    layer_json = json.loads(decrypted_bytes.decode('utf-8'))
+    return layer_json.get('next_hop'), base64.b64decode(layer_json['data_b64'])
+
+def peel_create_layer(encrypted_data, private_key):
+    """RSA-peels one CREATE layer. Returns the layer dict or None."""
+    decrypted_bytes = hybrid_decrypt(encrypted_data, private_key)
+    if decrypted_bytes is None: return None
+    return unpack_payload(decrypted_bytes)
+
+_PEELERS = {"onion": peel_onion_layer, "create": peel_create_layer}
+
+# --- Worker process side ---
+_worker_key = None
+
+def _init_worker(private_pem):
+    global _worker_key
+    _worker_key = load_private_key(private_pem)
+
+def _peel_batch(jobs):
+    """Runs in a worker: peels a batch of (kind, data). Returns [(result, seconds)]."""
+    results = []
+    for kind, data in jobs:
+        start = time.perf_counter()
+        try:
+            result = _PEELERS[kind](data, _worker_key)
+        except Exception as e:
+            print(f"Peel Worker Error: {e}")
+            result = None
+        results.append((result, time.perf_counter() - start))
+    return results
+
+class PeelPool:
+    """
+    Process pool that takes the RSA layer decrypts (CREATE and legacy ONION)
+    off the connection threads and out from under the GIL.
+
+    Link threads submit() into a bounded queue; when it is full they block,
+    which stops reading that link and pushes back on the sender over TCP.
+    A dispatcher batches queued jobs per worker. Results are handed back to
+    one I/O thread, which runs the forwarding / exit continuation.
+    Symmetric CIRC_CELL layers stay inline: a single AES-GCM decrypt is
+    cheaper than shipping the cell to another process.
+    """
+    BATCH_WINDOW = 0.002
+
+    def __init__(self, private_key, workers=2, queue_size=256, batch_size=8):
+        self.batch_size = batch_size
+        self.inbox = queue.Queue(maxsize=queue_size)
+        self.results = queue.Queue()
+        self.in_flight = threading.Semaphore(workers * 2)
+        self.executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(export_private_key(private_key),)
+        )
+        self.running = True
+        self.stats_lock = threading.Lock()
+        self.stats = {
+            "jobs": 0, "batches": 0, "errors": 0,
+            "queue_wait": 0.0, "peel": 0.0, "dispatch": 0.0, "max_queue_wait": 0.0
+        }
+        threading.Thread(target=self._batcher, daemon=True).start()
+        threading.Thread(target=self._dispatcher, daemon=True).start()
+
+    def submit(self, kind, data, callback):
+        """Queues one layer; callback(result) runs on the I/O thread (result is None on failure)."""
+        self.inbox.put((kind, data, callback, time.perf_counter()))
+
+    def _batcher(self):
+        while self.running:
+            batch = [self.inbox.get()]
+            deadline = time.perf_counter() + self.BATCH_WINDOW
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0: break
+                try:
+                    batch.append(self.inbox.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            self.in_flight.acquire()
+            submitted_at = time.perf_counter()
+            future = self.executor.submit(_peel_batch, [(kind, data) for kind, data, _, _ in batch])
+            future.add_done_callback(lambda f, b=batch, t=submitted_at: self.results.put((b, t, f)))
+
+    def _dispatcher(self):
+        while self.running:
+            batch, submitted_at, future = self.results.get()
+            self.in_flight.release()
+            try:
+                peeled = future.result()
+            except Exception as e:
+                print(f"Peel Pool Error: {e}")
+                peeled = [(None, 0.0)] * len(batch)
+
+            for (_, _, callback, enqueued_at), (result, peel_seconds) in zip(batch, peeled):
+                start = time.perf_counter()
+                try:
+                    callback(result)
+                except Exception as e:
+                    print(f"Peel Dispatch Error: {e}")
+                with self.stats_lock:
+                    wait = submitted_at - enqueued_at
+                    self.stats["jobs"] += 1
+                    self.stats["errors"] += result is None
+                    self.stats["queue_wait"] += wait
+                    self.stats["max_queue_wait"] = max(self.stats["max_queue_wait"], wait)
+                    self.stats["peel"] += peel_seconds
+                    self.stats["dispatch"] += time.perf_counter() - start
+            with self.stats_lock:
+                self.stats["batches"] += 1
+
+    def timings(self):
+        """Per-stage averages (ms) for sizing the pool."""
+        with self.stats_lock:
+            s = dict(self.stats)
+        jobs = max(s["jobs"], 1)
+        return {
+            "jobs": s["jobs"],
+            "errors": s["errors"],
+            "avg_batch": round(s["jobs"] / max(s["batches"], 1), 2),
+            "queue_depth": self.inbox.qsize(),
+            "queue_wait_ms": round(s["queue_wait"] / jobs * 1000, 3),
+            "max_queue_wait_ms": round(s["max_queue_wait"] * 1000, 3),
+            "peel_ms": round(s["peel"] / jobs * 1000, 3),
+            "dispatch_ms": round(s["dispatch"] / jobs * 1000, 3)
+        }
+
+    def shutdown(self):
+        self.running = False
+        self.executor.shutdown(wait=False, cancel_futures=True)
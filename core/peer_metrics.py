@@ -0,0 +1,173 @@
+import random
+import socket
+import threading
+import time
+
+EWMA_ALPHA = 0.3            # Weight of the newest sample
+MIN_THROUGHPUT_SAMPLE = 16 * 1024  # Smaller deliveries mostly measure round trips, not bandwidth
+PROBE_INTERVAL = 30         # Seconds between active RTT probe rounds
+PROBE_TIMEOUT = 3
+PROBES_PER_ROUND = 16       # Peers probed per round (least recently probed first)
+DEMOTE_AFTER = 3            # Consecutive failures before a peer is demoted
+DEMOTE_SECONDS = 120        # First demotion; doubles while the peer keeps failing
+REFERENCE_BYTES = 64 * 1024  # Transfer size the score is computed for (one torrent chunk)
+
+# Anonymity vs performance: PATH_BIAS 0 is uniform selection (the original
+# behaviour), 1 is fully metric-weighted. WEIGHT_CAP bounds how much more
+# likely the best relay can be than an unmeasured one, so fast relays cannot
+# soak up most circuits.
+PATH_BIAS = 0.5
+WEIGHT_CAP = 4.0
+
+class PeerMetrics:
+    """
+    Per-peer RTT and throughput estimates, and the weights path selection uses.
+
+    - RTT: active TCP-connect probes plus passive DHT RPC round trips.
+    - Throughput: passive, from bytes the exit acknowledged (circuit SENDMEs)
+      over the time they were in flight. A circuit moves at its slowest hop's
+      pace, so every hop gets the sample; across circuits with different
+      companions the slow relay is the one that keeps scoring low. (Timing
+      our own socket writes would only measure a local copy.)
+    - Failures: failed sends, probes and RPCs. After DEMOTE_AFTER in a row the
+      peer is excluded from middle hops for a while (backing off exponentially).
+    """
+    def __init__(self, node, path_bias=PATH_BIAS, weight_cap=WEIGHT_CAP, probe=True):
+        self.node = node
+        self.path_bias = path_bias
+        self.weight_cap = weight_cap
+        self.peers = {}  # peer_id -> {rtt, throughput, failures, demotions, demoted_until, last_probe}
+        self.lock = threading.Lock()
+        if probe:
+            threading.Thread(target=self._probe_loop, daemon=True).start()
+
+    def _entry(self, peer_id):
+        # NOTE: Must be called while self.lock is held
+        entry = self.peers.get(peer_id)
+        if entry is None:
+            entry = self.peers[peer_id] = {
+                "rtt": None, "throughput": None, "failures": 0,
+                "demotions": 0, "demoted_until": 0, "last_probe": 0
+            }
+        return entry
+
+    @staticmethod
+    def _ewma(old, sample):
+        return sample if old is None else (1 - EWMA_ALPHA) * old + EWMA_ALPHA * sample
+
+    # --- Samples ---
+    def record_rtt(self, peer_id, seconds):
+        with self.lock:
+            entry = self._entry(peer_id)
+            entry['rtt'] = self._ewma(entry['rtt'], seconds)
+            self._succeeded(entry)
+
+    def record_delivery(self, peer_id, nbytes, seconds):
+        with self.lock:
+            entry = self._entry(peer_id)
+            if nbytes >= MIN_THROUGHPUT_SAMPLE and seconds > 0:
+                entry['throughput'] = self._ewma(entry['throughput'], nbytes / seconds)
+            self._succeeded(entry)
+
+    def record_failure(self, peer_id):
+        with self.lock:
+            entry = self._entry(peer_id)
+            entry['failures'] += 1
+            if entry['failures'] >= DEMOTE_AFTER:
+                entry['demoted_until'] = time.time() + DEMOTE_SECONDS * (2 ** min(entry['demotions'], 5))
+                entry['demotions'] += 1
+                entry['failures'] = 0
+
+    def _succeeded(self, entry):
+        # NOTE: Must be called while self.lock is held
+        entry['failures'] = 0
+        if entry['demoted_until'] < time.time():
+            entry['demotions'] = 0
+
+    # --- Selection ---
+    def weights(self, peer_ids):
+        """
+        Selection weight per peer id. An unmeasured peer is 1.0; measured
+        peers are scaled against the median measured peer, capped to
+        [1 / weight_cap, weight_cap] and blended with uniform by path_bias.
+        Demoted peers get 0.
+        """
+        now = time.time()
+        with self.lock:
+            scores = sorted(s for s in (self._score(e) for e in self.peers.values()) if s is not None)
+            median = scores[len(scores) // 2] if scores else None
+            out = {}
+            for peer_id in peer_ids:
+                entry = self.peers.get(peer_id)
+                score = self._score(entry) if entry else None
+                if entry and entry['demoted_until'] > now:
+                    out[peer_id] = 0.0
+                elif score is None:
+                    out[peer_id] = 1.0
+                else:
+                    relative = max(1 / self.weight_cap, min(self.weight_cap, score / median))
+                    out[peer_id] = (1 - self.path_bias) + self.path_bias * relative
+            return out
+
+    @staticmethod
+    def _score(entry):
+        """Inverse of the estimated time to move one REFERENCE_BYTES transfer."""
+        rtt, throughput = entry['rtt'], entry['throughput']
+        if rtt is None and throughput is None: return None
+        seconds = (rtt or 0) + (REFERENCE_BYTES / throughput if throughput else 0)
+        return 1 / max(seconds, 1e-4)
+
+    def sample(self, peers, count):
+        """
+        Weighted sampling without replacement (Efraimidis-Spirakis). Demoted
+        peers are only used when there are not enough others.
+        """
+        weights = self.weights([f"{p['host']}:{p['port']}" for p in peers])
+        keyed = []
+        for pos, peer in enumerate(peers):
+            w = weights[f"{peer['host']}:{peer['port']}"]
+            # random() ** (1 / w): larger weights tend toward 1; demoted peers sort last
+            keyed.append((random.random() ** (1 / w) if w > 0 else -random.random(), pos))
+        keyed.sort(reverse=True)
+        return [peers[pos] for _, pos in keyed[:count]]
+
+    # --- Active probes ---
+    def _probe_loop(self):
+        while True:
+            time.sleep(PROBE_INTERVAL)
+            try:
+                self.probe_round()
+            except Exception as e:
+                print(f"[METRICS] Probe Error: {e}")
+
+    def probe_round(self):
+        """Times a TCP connect to the least recently probed peers."""
+        peers = list(self.node.peers.items())
+        with self.lock:
+            peers.sort(key=lambda item: self._entry(item[0])['last_probe'])
+            batch = peers[:PROBES_PER_ROUND]
+            for peer_id, _ in batch:
+                self._entry(peer_id)['last_probe'] = time.time()
+        for peer_id, peer in batch:
+            start = time.perf_counter()
+            try:
+                with socket.create_connection((peer['host'], peer['port']), timeout=PROBE_TIMEOUT):
+                    pass
+                self.record_rtt(peer_id, time.perf_counter() - start)
+            except OSError:
+                self.record_failure(peer_id)
+
+    def summary(self):
+        """Per-peer estimates and current weights, for the dashboard."""
+        with self.lock:
+            snapshot = {pid: dict(e) for pid, e in self.peers.items()}
+        weights = self.weights(snapshot)
+        now = time.time()
+        return {
+            pid: {
+                "rtt_ms": round(e['rtt'] * 1000, 2) if e['rtt'] is not None else None,
+                "throughput_kbps": round(e['throughput'] * 8 / 1000) if e['throughput'] else None,
+                "demoted": e['demoted_until'] > now,
+                "weight": round(weights[pid], 3)
+            } for pid, e in snapshot.items()
+        }
@@ -1,52 +1,259 @@
 import json
 import base64
+import struct
+from core.compression import is_compressed, decompress
 
 # Packet Constants
 MSG_HELLO = "HELLO"         # Discovery (Key Exchange)
 MSG_ONION = "ONION_MSG"     # Routed Traffic (Encrypted)
 MSG_CHUNK = "FILE_CHUNK"    # Torrent/File (Direct P2P)
-MSG_DIRECT = "DIRECT"       # Direct Response (e.g., from Exit Node)  
+MSG_DIRECT = "DIRECT"       # Direct Response (e.g., from Exit Node)
 MSG_PEX = "PEX_LIST"        # Constant for Peer Exchange
+MSG_CREATE = "CIRC_CREATE"  # Circuit Setup (RSA, once per hop)
+MSG_CELL = "CIRC_CELL"      # Circuit Traffic (AES-GCM session keys only)
+MSG_DHT = "DHT"             # Kademlia RPCs (direct, not onion-routed)
+MSG_CELL_BACK = "CIRC_BACK" # Circuit Traffic toward the originator (each hop adds a layer)
 
-def serialize(packet_type, payload):
+# Codecs (advertised in HELLO as "codecs", negotiated per peer)
+CODEC_JSON = "json"
+CODEC_BINARY = "bin1"
+SUPPORTED_CODECS = [CODEC_BINARY, CODEC_JSON]
+
+# Binary framing: [Magic (2)] [Version (1)] [Type (1)] [Flags (1)] [Typed Payload]
+# JSON frames always start with '{', so the magic's leading zero byte
+# lets deserialize() tell the two codecs apart without any out-of-band state.
+BIN_MAGIC = b"\x00\xb1"
+BIN_VERSION = 1
+_BIN_HEADER = struct.Struct('>2sBBB')
+BIN_TYPE_OFFSET = 3
+_BIN_PAYLOAD_HEADER = struct.Struct('>2sB')
+
+_TYPE_CODES = {
+    MSG_HELLO: 1, MSG_ONION: 2, MSG_CHUNK: 3, MSG_DIRECT: 4,
+    MSG_PEX: 5, MSG_CREATE: 6, MSG_CELL: 7, MSG_DHT: 8, MSG_CELL_BACK: 9
+}
+_TYPE_NAMES = {code: name for name, code in _TYPE_CODES.items()}
+
+# Typed field tags
+_T_NONE, _T_TRUE, _T_FALSE, _T_INT, _T_FLOAT, _T_STR, _T_BYTES, _T_LIST, _T_DICT = range(9)
+_U32 = struct.Struct('>I')
+# serialize_parts() hands byte fields at least this large to the socket
+# by reference instead of copying them into the frame
+ZERO_COPY_MIN = 1024
+_I64 = struct.Struct('>q')
+_F64 = struct.Struct('>d')
+
+def _encode_bytes(item):
+    """Recursively encodes bytes to Base64 strings for JSON compatibility."""
+    if isinstance(item, (bytes, bytearray, memoryview)):
+        return {'__bytes__': base64.b64encode(item).decode('utf-8')}
+    elif isinstance(item, dict):
+        return {k: _encode_bytes(v) for k, v in item.items()}
+    elif isinstance(item, (list, tuple)):
+        return [_encode_bytes(i) for i in item]
+    return item
+
+def _decode_bytes(item):
+    """Recursively decodes Base64 strings back to bytes."""
+    if isinstance(item, dict) and '__bytes__' in item:
+        return base64.b64decode(item['__bytes__'])
+    elif isinstance(item, dict):
+        return {k: _decode_bytes(v) for k, v in item.items()}
+    elif isinstance(item, list):
+        return [_decode_bytes(i) for i in item]
+    return item
+
+class _FrameParts:
+    """
+    bytearray stand-in for _bin_encode() that leaves large byte fields out of
+    the buffer: they become separate parts for a vectored write.
+    """
+    def __init__(self, head):
+        self.parts = []
+        self.buf = bytearray(head)
+
+    def append(self, byte):
+        self.buf.append(byte)
+
+    def __iadd__(self, data):
+        if len(data) >= ZERO_COPY_MIN and isinstance(data, (bytes, bytearray, memoryview)):
+            self.parts.append(self.buf)
+            self.parts.append(data)
+            self.buf = bytearray()
+        else:
+            self.buf += data
+        return self
+
+    def finish(self):
+        if self.buf: self.parts.append(self.buf)
+        return self.parts
+
+def _bin_encode(item, out):
+    """Appends one typed field to the bytearray `out` (or _FrameParts). Byte payloads are copied raw."""
+    if item is None:
+        out.append(_T_NONE)
+    elif item is True:
+        out.append(_T_TRUE)
+    elif item is False:
+        out.append(_T_FALSE)
+    elif isinstance(item, int):
+        out.append(_T_INT)
+        out += _I64.pack(item)
+    elif isinstance(item, float):
+        out.append(_T_FLOAT)
+        out += _F64.pack(item)
+    elif isinstance(item, str):
+        raw = item.encode('utf-8')
+        out.append(_T_STR)
+        out += _U32.pack(len(raw))
+        out += raw
+    elif isinstance(item, (bytes, bytearray, memoryview)):
+        out.append(_T_BYTES)
+        out += _U32.pack(len(item))
+        out += item
+    elif isinstance(item, (list, tuple)):
+        out.append(_T_LIST)
+        out += _U32.pack(len(item))
+        for i in item:
+            _bin_encode(i, out)
+    elif isinstance(item, dict):
+        out.append(_T_DICT)
+        out += _U32.pack(len(item))
+        for k, v in item.items():
+            raw = str(k).encode('utf-8')
+            out += _U32.pack(len(raw))
+            out += raw
+            _bin_encode(v, out)
+    else:
+        raise TypeError(f"Unsupported field type: {type(item).__name__}")
+
+def _bin_decode(view, pos, zero_copy=False):
+    """
+    Reads one typed field from memoryview `view` at `pos`. Returns (value, new_pos).
+    With zero_copy, byte fields come back as memoryview slices of `view`.
+    """
+    tag = view[pos]
+    pos += 1
+    if tag == _T_NONE:
+        return None, pos
+    if tag == _T_TRUE:
+        return True, pos
+    if tag == _T_FALSE:
+        return False, pos
+    if tag == _T_INT:
+        return _I64.unpack_from(view, pos)[0], pos + 8
+    if tag == _T_FLOAT:
+        return _F64.unpack_from(view, pos)[0], pos + 8
+    if tag in (_T_STR, _T_BYTES):
+        length = _U32.unpack_from(view, pos)[0]
+        pos += 4
+        if pos + length > len(view):
+            raise ValueError("Truncated field")
+        if tag == _T_BYTES and zero_copy:
+            return view[pos:pos + length], pos + length
+        raw = bytes(view[pos:pos + length])
+        return (raw.decode('utf-8') if tag == _T_STR else raw), pos + length
+    if tag == _T_LIST:
+        count = _U32.unpack_from(view, pos)[0]
+        pos += 4
+        items = []
+        for _ in range(count):
+            item, pos = _bin_decode(view, pos, zero_copy)
+            items.append(item)
+        return items, pos
+    if tag == _T_DICT:
+        count = _U32.unpack_from(view, pos)[0]
+        pos += 4
+        result = {}
+        for _ in range(count):
+            klen = _U32.unpack_from(view, pos)[0]
+            pos += 4
+            key = bytes(view[pos:pos + klen]).decode('utf-8')
+            pos += klen
+            result[key], pos = _bin_decode(view, pos, zero_copy)
+        return result, pos
+    raise ValueError(f"Unknown field tag {tag}")
+
+def is_binary(data_bytes):
+    return bytes(data_bytes[:2]) == BIN_MAGIC
+
+def type_code(packet_type):
+    """Binary type code, e.g. for peeking at data[BIN_TYPE_OFFSET] without decoding."""
+    return _TYPE_CODES[packet_type]
+
+def serialize(packet_type, payload, codec=CODEC_JSON):
     """
-    Serializes packet to JSON bytes.
-    Recursively encodes bytes to Base64 strings for JSON compatibility.
+    Serializes packet to bytes.
+    JSON: recursively encodes bytes to Base64 strings for JSON compatibility.
+    Binary: fixed header + typed fields, byte payloads carried raw.
     """
-    def encode_helper(item):
-        if isinstance(item, bytes):
-            return {'__bytes__': base64.b64encode(item).decode('utf-8')}
-        elif isinstance(item, dict):
-            return {k: encode_helper(v) for k, v in item.items()}
-        elif isinstance(item, list):
-            return [encode_helper(i) for i in item]
-        return item
+    if codec == CODEC_BINARY:
+        out = bytearray(_BIN_HEADER.pack(BIN_MAGIC, BIN_VERSION, _TYPE_CODES[packet_type], 0))
+        _bin_encode(payload, out)
+        return bytes(out)
 
     data = {
-        "type": packet_type, 
-        "payload": encode_helper(payload)
+        "type": packet_type,
+        "payload": _encode_bytes(payload)
     }
     return json.dumps(data).encode('utf-8')
 
-def deserialize(data_bytes):
+def serialize_parts(packet_type, payload, codec=CODEC_JSON):
     """
-    Parses JSON bytes back to Python objects.
-    Recursively decodes Base64 strings back to bytes.
+    Like serialize(), but returns a list of buffers for a vectored write.
+    In the binary codec, large byte fields (a forwarded cell's data) are
+    referenced rather than copied into the frame.
     """
-    def decode_helper(item):
-        if isinstance(item, dict) and '__bytes__' in item:
-            return base64.b64decode(item['__bytes__'])
-        elif isinstance(item, dict):
-            return {k: decode_helper(v) for k, v in item.items()}
-        elif isinstance(item, list):
-            return [decode_helper(i) for i in item]
-        return item
+    if codec != CODEC_BINARY:
+        return [serialize(packet_type, payload, codec)]
+    out = _FrameParts(_BIN_HEADER.pack(BIN_MAGIC, BIN_VERSION, _TYPE_CODES[packet_type], 0))
+    _bin_encode(payload, out)
+    return out.finish()
 
+def deserialize(data_bytes, zero_copy=False):
+    """
+    Parses either codec back to {'type': ..., 'payload': ...}.
+    Byte payloads come back as bytes, or (binary codec with zero_copy) as
+    memoryviews into data_bytes, which must then not be reused.
+    """
     try:
-        data_str = data_bytes.decode('utf-8')
+        if is_binary(data_bytes):
+            view = memoryview(data_bytes)
+            _, version, code, _ = _BIN_HEADER.unpack_from(view, 0)
+            if version != BIN_VERSION:
+                raise ValueError(f"Unsupported binary version {version}")
+            payload, _ = _bin_decode(view, _BIN_HEADER.size, zero_copy)
+            return {"type": _TYPE_NAMES[code], "payload": payload}
+
+        data_str = bytes(data_bytes).decode('utf-8')
         packet = json.loads(data_str)
-        packet['payload'] = decode_helper(packet['payload'])
+        packet['payload'] = _decode_bytes(packet['payload'])
         return packet
     except Exception as e:
         print(f"Protocol Error (Deserialize): {e}")
-        return None
\ No newline at end of file
+        return None
+
+def pack_payload(payload, codec=CODEC_JSON):
+    """Encodes an exit payload or circuit layer (anything inside the encryption) to bytes."""
+    if codec == CODEC_BINARY:
+        out = bytearray(_BIN_PAYLOAD_HEADER.pack(BIN_MAGIC, BIN_VERSION))
+        _bin_encode(payload, out)
+        return bytes(out)
+    return json.dumps(_encode_bytes(payload)).encode('utf-8')
+
+def unpack_payload(data_bytes):
+    """Inverse of pack_payload; the codec (and any compression) is detected from the leading bytes."""
+    if is_compressed(data_bytes):
+        data_bytes = decompress(data_bytes)
+    if is_binary(data_bytes):
+        view = memoryview(data_bytes)
+        return _bin_decode(view, _BIN_PAYLOAD_HEADER.size)[0]
+    return _decode_bytes(json.loads(bytes(data_bytes).decode('utf-8')))
+
+def negotiate_codec(peer):
+    """Picks the best codec both sides speak. Peers that never advertised any get JSON."""
+    offered = (peer or {}).get('codecs') or [CODEC_JSON]
+    for codec in SUPPORTED_CODECS:
+        if codec in offered:
+            return codec
+    return CODEC_JSON
@@ -1,23 +1,121 @@
+import os
 import socket
 import threading
-import json
-import base64
-import struct
-from core.protocol import deserialize, MSG_HELLO, MSG_ONION, MSG_DIRECT
-from core.crypto import hybrid_decrypt
+import time
+from core.transport import Connection, serve_frames, IO_TIMEOUT, IDLE_TIMEOUT
+from core.protocol import (deserialize, serialize_parts, pack_payload, unpack_payload, is_binary, type_code,
+                           BIN_TYPE_OFFSET, CODEC_BINARY, CODEC_JSON,
+                           MSG_HELLO, MSG_ONION, MSG_DIRECT, MSG_CREATE, MSG_CELL, MSG_CELL_BACK, MSG_DHT)
+from core.crypto import sym_decrypt, sym_encrypt
+from core.flow import OutboundQueues, Window, crossed, REPLY_WINDOW, BACKPRESSURE_TIMEOUT
+from core.peeling import PeelPool, peel_onion_layer, peel_create_layer
+from core.stream import stream_cells
+from core.scheduler import classify
+
+class ReplyPath:
+    """
+    Handle for answering whoever sent a message down a circuit we are the
+    exit of; modules get it as receive(payload, reply) (and stream.reply).
+    Replies travel back along that circuit as backward cells: one AES-GCM
+    layer per hop, no RSA, and the requester need not be a peer of ours.
+    """
+    def __init__(self, relay, circ_id):
+        self.relay = relay
+        self.circ_id = circ_id
+
+    def send(self, module, payload):
+        """One message to `module` at the originator. Returns False if the circuit is gone."""
+        return self._send({"module": module, "payload": payload})
+
+    def send_stream(self, module, meta, chunks):
+        """
+        Like OnionNode.send_stream, back along the circuit. Each cell takes a
+        credit from the circuit's REPLY_WINDOW, which the originator refills
+        as its module consumes the stream, so this blocks while it is behind:
+        call it off the receive() thread (as the proxy's fetch workers do).
+        Returns the bytes sent, or None if the circuit was gone before
+        anything went out.
+        """
+        if not self.alive(): return None
+        stream_id = os.urandom(8).hex()
+        seq, sent = 0, 0
+        cell = {"module": module, "stream": stream_id, "seq": 0, "payload": meta}
+        try:
+            for piece, fin in stream_cells(chunks):
+                cell.update(seq=seq, fin=fin, data=piece)
+                if not self._send(cell, windowed=True):
+                    print(f"[RELAY] Reply stream {stream_id} cut off after {sent} bytes")
+                    return sent
+                seq += 1
+                sent += len(piece)
+                cell = {"module": module, "stream": stream_id}
+        except Exception as e:
+            print(f"[STREAM] Aborting reply stream {stream_id}: {e}")
+            cell.update(seq=seq, fin=True, data=b"", error=str(e))
+            self._send(cell)
+        return sent
+
+    def alive(self):
+        with self.relay.circuits_lock:
+            entry = self.relay.circuits.get(self.circ_id)
+        return entry is not None and entry['prev'][0] is not None and entry['prev'][0].alive
+
+    def _send(self, msg, windowed=False):
+        with self.relay.circuits_lock:
+            entry = self.relay.circuits.get(self.circ_id)
+            if entry:
+                entry['last_used'] = time.time()
+        if entry is None: return False
+        if windowed:
+            if not entry['reply_window'].take():
+                print(f"[FLOW] Reply window stalled on circuit {self.circ_id}")
+                return False
+            # Numbered so the originator's SENDMEs also credit cells lost on the way
+            with self.relay.circuits_lock:
+                entry['reply_sent'] += 1
+                msg["n"] = entry['reply_sent']
+        return self.relay._send_back(self.circ_id, entry, pack_payload(msg, entry['prev'][1]),
+                                     module=msg["module"], traffic_class=classify(msg["module"], msg.get("payload")))
 
 class RelayService:
-    def __init__(self, node):
+    LISTEN_BACKLOG = 128
+    # Circuits with no traffic for this long are forgotten
+    CIRCUIT_IDLE_TTL = 600
+    # Cells that overtake their CREATE (e.g. after a link reconnect) are held briefly
+    PENDING_CELL_TTL = 10
+    MAX_PENDING_CELLS = 64      # per unknown circuit
+    MAX_PENDING_TOTAL = 1024    # across all unknown circuits
+    MAX_PENDING_BYTES = 4 * 1024 * 1024
+    # Frame types parsed zero-copy: their data is only decrypted and forwarded
+    ZERO_COPY_TYPES = {type_code(MSG_CELL), type_code(MSG_CELL_BACK)}
+
+    def __init__(self, node, peel_workers=0):
         self.node = node
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.running = True
 
+        # Optional process pool for RSA layer decrypts (0 = peel inline)
+        self.peel_pool = PeelPool(node.private_key, workers=peel_workers) if peel_workers else None
+
+        # Circuit table: circ_id -> {key, next_hop, next_circ_id, prev, last_used, delivered, streams,
+        #                           reply_window, reply_sent, reply_acked}
+        # 'prev' is the (link, codec) the latest CREATE or cell arrived on; backward cells return over it
+        self.circuits = {}
+        self.backward = {}  # next_circ_id -> circ_id, to route backward cells from the next hop
+        self.pending_cells = {}  # circ_id -> [(received_at, cell, prev)], oldest circuit first
+        self.pending_count = 0
+        self.pending_bytes = 0
+        self.circuits_lock = threading.Lock()
+        self._last_sweep = time.time()
+        # Forwarded frames go through bounded per-next-hop queues, never send_raw inline
+        self.outbound = OutboundQueues()
+
     def bind_and_listen(self, port_range, bind_ip='0.0.0.0'):
         """Attempts to bind the node to an available port in the range."""
         for port in port_range:
             try:
                 self.sock.bind((bind_ip, port))
-                self.sock.listen(5)
+                self.sock.listen(self.LISTEN_BACKLOG)
                 return port
             except OSError:
                 continue
@@ -35,32 +133,42 @@ class RelayService:
                 break
 
     def _handle(self, conn):
+        """Serves every frame the peer sends on this link, in order, until it closes."""
+        link = Connection(conn, conn.getpeername())
         try:
-            # Read 4-byte length prefix
-            raw_msglen = self.recvall(conn, 4)
-            if not raw_msglen: return
-            msglen = struct.unpack('>I', raw_msglen)[0]
-            
-            # Validate message size to prevent DoS attacks
-            MAX_MESSAGE_SIZE = 10 * 1024 * 1024  # 10MB limit
-            if msglen > MAX_MESSAGE_SIZE:
-                print(f"[SECURITY] Rejected message: size {msglen} exceeds limit {MAX_MESSAGE_SIZE}")
-                return
-            
-            # Read the full packet based on the prefix length
-            data = self.recvall(conn, msglen)
-            if not data: return
-            
-            packet = deserialize(data)
+            conn.settimeout(IO_TIMEOUT)
+            serve_frames(conn, lambda data: self.handle_frame(data, link),
+                         idle_timeout=2 * IDLE_TIMEOUT, running=lambda: self.running)
+        except Exception as e:
+            print(f"Relay Error: {e}")
+        finally:
+            link.close()
+
+    def handle_frame(self, data, link=None):
+        """Dispatches one frame, whether it arrived on an inbound link or a pooled outbound one."""
+        try:
+            # Cell data stays a view into the received frame until it is decrypted
+            zero_copy = is_binary(data) and data[BIN_TYPE_OFFSET] in self.ZERO_COPY_TYPES
+            packet = deserialize(data, zero_copy)
             if not packet: return
 
             msg_type = packet['type']
             payload = packet['payload']
 
             if msg_type == MSG_HELLO:
-                self.node.add_peer(payload)
+                if self.node.discovery.vouch(payload):
+                    self.node.add_peer(payload)
             elif msg_type == MSG_ONION:
                 self._process_onion(payload)
+            elif msg_type == MSG_CREATE:
+                # Backward cells are answered in the codec the previous hop used
+                self._process_create(payload, (link, CODEC_BINARY if is_binary(data) else CODEC_JSON))
+            elif msg_type == MSG_CELL:
+                self._process_cell(payload, (link, CODEC_BINARY if is_binary(data) else CODEC_JSON))
+            elif msg_type == MSG_CELL_BACK:
+                self._process_back_cell(payload)
+            elif msg_type == MSG_DHT:
+                self.node.dht.handle(payload)
             elif msg_type == MSG_DIRECT:
                 mod = payload.get('module')
                 content = payload.get('payload')
@@ -69,32 +177,249 @@ class RelayService:
 
         except Exception as e:
             print(f"Relay Error: {e}")
-        finally:
-            conn.close()
-
-    def recvall(self, sock, n):
-        """Helper to receive exactly n bytes to prevent fragmentation."""
-        data = bytearray()
-        while len(data) < n:
-            packet = sock.recv(n - len(data))
-            if not packet: return None
-            data.extend(packet)
-        return data
 
     def _process_onion(self, encrypted_data):
+        if self.peel_pool:
+            self.peel_pool.submit("onion", encrypted_data, self._finish_onion)
+            return
+        try:
+            self._finish_onion(peel_onion_layer(encrypted_data, self.node.private_key))
+        except Exception as e:
+            print(f"Onion Processing Error: {e}")
+
+    def _finish_onion(self, peeled):
+        try:
+            if peeled is None: return
+            next_hop, inner_data = peeled
+
+            if next_hop is None:
+                self._deliver_exit(inner_data)
+            else:
+                host, port = next_hop
+                self._forward(host, port, MSG_ONION, inner_data, len(inner_data))
+        except Exception as e:
+            print(f"Onion Processing Error: {e}")
+
+    def _process_create(self, encrypted_data, prev=(None, CODEC_JSON)):
+        """
+        Circuit handshake: the only RSA decrypt this relay does per circuit.
+        Stores the hop's session key, then forwards the rest of the CREATE.
+        """
+        if self.peel_pool:
+            self.peel_pool.submit("create", encrypted_data, lambda layer: self._finish_create(layer, prev))
+            return
         try:
-            decrypted_bytes = hybrid_decrypt(encrypted_data, self.node.private_key)
-            if decrypted_bytes is None: return
+            self._finish_create(peel_create_layer(encrypted_data, self.node.private_key), prev)
+        except Exception as e:
+            print(f"Circuit Create Error: {e}")
 
-            layer_json = json.loads(decrypted_bytes.decode('utf-8'))
-            inner_data = base64.b64decode(layer_json['data_b64'])
-            next_hop = layer_json.get('next_hop')
+    def _finish_create(self, layer, prev=(None, CODEC_JSON)):
+        try:
+            if layer is None: return
+            inner_data = layer['data']
+            next_hop = layer.get('next_hop')
+
+            circ_id = layer['circ_id']
+            with self.circuits_lock:
+                self._sweep_circuits()
+                # circ_ids are random per hop; a repeat is a replay or a hijack attempt
+                if circ_id in self.circuits:
+                    print(f"[SECURITY] Rejected CREATE for existing circuit {circ_id}")
+                    return
+                self.circuits[circ_id] = {
+                    "key": layer['key'],
+                    "next_hop": tuple(next_hop) if next_hop else None,
+                    "next_circ_id": layer.get('next_circ_id'),
+                    "prev": prev,
+                    "last_used": time.time(),
+                    "delivered": 0,  # Highest cell number delivered (exit only)
+                    "streams": {},   # module -> highest stream cell number delivered (exit only)
+                    "reply_window": Window(REPLY_WINDOW),  # Credits for reply stream cells (exit only)
+                    "reply_sent": 0,
+                    "reply_acked": 0
+                }
+                if layer.get('next_circ_id'):
+                    self.backward[layer['next_circ_id']] = circ_id
+                held = self._release_pending(circ_id)
 
             if next_hop is None:
-                final_payload = json.loads(inner_data.decode('utf-8'))
-                self.node.handle_exit_traffic(final_payload)
+                if inner_data:
+                    self._deliver_exit(inner_data, circ_id)
             else:
                 host, port = next_hop
-                self.node.send_raw(host, port, MSG_ONION, inner_data)
+                self._forward(host, port, MSG_CREATE, inner_data, len(inner_data))
+
+            for _, cell, cell_prev in held:
+                self._process_cell(cell, cell_prev)
         except Exception as e:
-            print(f"Onion Processing Error: {e}")
\ No newline at end of file
+            print(f"Circuit Create Error: {e}")
+
+    def _process_cell(self, cell, prev=(None, CODEC_JSON)):
+        """
+        Peels one symmetric layer using the circuit table. The link the cell
+        came on becomes the circuit's way back, so backward cells follow the
+        previous hop across a reconnect.
+        """
+        try:
+            circ_id = cell.get('circ_id')
+            with self.circuits_lock:
+                entry = self.circuits.get(circ_id)
+                if entry is None:
+                    # The CREATE may still be in flight on another link
+                    self._sweep_circuits()
+                    self._hold_cell(circ_id, cell, prev)
+                    return
+
+            # circ_id is cleartext: only a cell that authenticates may touch the entry
+            inner_data = sym_decrypt(entry['key'], cell['data'])
+            if inner_data is None: return
+            with self.circuits_lock:
+                entry['last_used'] = time.time()
+                if prev[0] is not None:
+                    entry['prev'] = prev
+
+            if entry['next_hop'] is None:
+                self._deliver_exit(inner_data, circ_id)
+            else:
+                host, port = entry['next_hop']
+                self._forward(host, port, MSG_CELL, {
+                    "circ_id": entry['next_circ_id'], "data": inner_data
+                }, len(inner_data))
+        except Exception as e:
+            print(f"Cell Processing Error: {e}")
+
+    def _process_back_cell(self, cell):
+        """
+        A cell travelling toward the originator: add this hop's layer and pass it
+        back over the link the CREATE came in on. If no relayed circuit matches,
+        we built the circuit ourselves.
+        """
+        try:
+            with self.circuits_lock:
+                circ_id = self.backward.get(cell.get('circ_id'))
+                entry = self.circuits.get(circ_id)
+                if entry:
+                    entry['last_used'] = time.time()
+            if entry is None:
+                self.node.circuit_mgr.handle_back_cell(cell)
+            else:
+                self._send_back(circ_id, entry, cell['data'])
+        except Exception as e:
+            print(f"Cell Processing Error: {e}")
+
+    def _send_back(self, circ_id, entry, data, module=None, traffic_class=None):
+        """
+        Adds our layer and queues the cell toward the originator. Returns False if it was not sent.
+        Our own replies (`module` set) go through the node's scheduler like any
+        traffic we originate; relayed cells and SENDMEs go straight to the link queue.
+        """
+        link, codec = entry['prev']
+        if link is None or not link.alive: return False
+        frame = serialize_parts(MSG_CELL_BACK, {"circ_id": circ_id, "data": sym_encrypt(entry['key'], data)}, codec)
+        nbytes = sum(len(p) for p in frame)
+        key = ("back", id(link))
+        if module is not None:
+            # The originator is anonymous; rate limits per peer apply to the link back
+            if not self.node.scheduler.submit(traffic_class, key, module, nbytes, link.send_frame, (frame,), link=key):
+                print(f"[RELAY] Dropped reply on circuit {circ_id}: scheduler queue full")
+                return False
+            return True
+        if not self.outbound.put(key, link.send_frame, (frame,), nbytes,
+                                 timeout=self._backpressure_timeout()):
+            print(f"[RELAY] Dropped backward cell on circuit {circ_id}: queue full")
+            return False
+        return True
+
+    def _forward(self, host, port, msg_type, payload, nbytes):
+        """Queues a frame for the next hop; blocks (backpressure) while that hop's queue is full."""
+        if not self.outbound.put((host, port), self.node.send_raw, (host, port, msg_type, payload), nbytes,
+                                 timeout=self._backpressure_timeout()):
+            print(f"[RELAY] Dropped frame for {host}:{port}: queue full")
+
+    def _backpressure_timeout(self):
+        return BACKPRESSURE_TIMEOUT
+
+    def _deliver_exit(self, inner_data, circ_id=None):
+        """
+        We are the exit: hand the innermost payload to its module, with a
+        ReplyPath back along the circuit it came on, then credit the sender.
+        """
+        data = unpack_payload(inner_data)
+        if data.get('sendme') == "reply":
+            # The originator consumed our reply stream cells up to this number
+            credits = 0
+            with self.circuits_lock:
+                entry = self.circuits.get(circ_id)
+                upto = data.get('upto')
+                if entry and isinstance(upto, int) and upto > entry['reply_acked']:
+                    credits, entry['reply_acked'] = upto - entry['reply_acked'], upto
+            if credits: entry['reply_window'].refill(credits)
+            return
+        self.node.handle_exit_traffic(data, ReplyPath(self, circ_id) if circ_id else None)
+        if circ_id: self._credit(circ_id, data.get('module'), data.get('n'), data.get('sn'))
+
+    def _credit(self, circ_id, module, n=None, sn=None):
+        """
+        Records a delivered cell by its circuit and stream numbers (n, sn).
+        Whenever the highest delivered number passes a multiple of
+        SENDME_INCREMENT, per circuit and per stream (module) on it, the
+        originator gets a SENDME carrying it, crediting any cells lost before it.
+        Sent after the module has handled the cell, so a slow consumer slows the sender.
+        """
+        sendmes = []
+        with self.circuits_lock:
+            entry = self.circuits.get(circ_id)
+            if entry is None: return
+            old, old_stream = entry['delivered'], entry['streams'].get(module, 0)
+            # Unnumbered cells (older senders) count one each
+            entry['delivered'] = max(old, n) if isinstance(n, int) else old + 1
+            entry['streams'][module] = max(old_stream, sn) if isinstance(sn, int) else old_stream + 1
+            if crossed(old, entry['delivered']):
+                sendmes.append({"sendme": "circuit", "upto": entry['delivered']})
+            if crossed(old_stream, entry['streams'][module]):
+                sendmes.append({"sendme": "stream", "stream": module, "upto": entry['streams'][module]})
+        for msg in sendmes:
+            self._send_back(circ_id, entry, pack_payload(msg))
+
+    def _sweep_circuits(self):
+        # NOTE: Must be called while self.circuits_lock is held
+        now = time.time()
+        if now - self._last_sweep < 60: return
+        self._last_sweep = now
+        stale = [cid for cid, e in self.circuits.items()
+                 if now - e['last_used'] > self.CIRCUIT_IDLE_TTL]
+        for cid in stale:
+            del self.circuits[cid]
+        self.backward = {nxt: cid for nxt, cid in self.backward.items() if cid in self.circuits}
+        self._expire_pending(now)
+
+    def _hold_cell(self, circ_id, cell, prev):
+        # NOTE: Must be called while self.circuits_lock is held
+        now = time.time()
+        self._expire_pending(now)
+        size = len(cell['data'])
+        if len(self.pending_cells.get(circ_id, ())) >= self.MAX_PENDING_CELLS \
+                or self.pending_count >= self.MAX_PENDING_TOTAL \
+                or self.pending_bytes + size > self.MAX_PENDING_BYTES:
+            print(f"[RELAY] Dropped cell for unknown circuit {circ_id}")
+            return
+        # Copied out: a zero-copy view would pin the whole received frame
+        held_cell = dict(cell, data=bytes(cell['data']))
+        self.pending_cells.setdefault(circ_id, []).append((now, held_cell, prev))
+        self.pending_count += 1
+        self.pending_bytes += size
+
+    def _release_pending(self, circ_id):
+        # NOTE: Must be called while self.circuits_lock is held
+        held = self.pending_cells.pop(circ_id, [])
+        self.pending_count -= len(held)
+        self.pending_bytes -= sum(len(cell['data']) for _, cell, _ in held)
+        return held
+
+    def _expire_pending(self, now):
+        # NOTE: Must be called while self.circuits_lock is held
+        # Circuits are kept in first-arrival order, so stale ones are at the front
+        while self.pending_cells:
+            circ_id, held = next(iter(self.pending_cells.items()))
+            if now - held[0][0] <= self.PENDING_CELL_TTL: break
+            self._release_pending(circ_id)
\ No newline at end of file
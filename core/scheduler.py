@@ -0,0 +1,208 @@
+import threading
+import time
+from collections import deque
+from core.flow import OutboundQueues
+
+# Traffic classes and their weighted-fair-queuing shares. Service is by bytes,
+# so a small chat message queued behind a run of 64KB chunks goes out next.
+CLASS_WEIGHTS = {
+    "control": 16,      # Torrent coordination (who_has, have, request, ...)
+    "interactive": 16,  # Chat
+    "proxy": 4,
+    "bulk": 1           # Torrent chunk payloads
+}
+MODULE_CLASSES = {"chat": "interactive", "proxy": "proxy", "torrent": "control"}
+BULK_ACTIONS = {"chunk"}
+
+MAX_CLASS_BYTES = 8 * 1024 * 1024  # Per-class queue bound; submit() blocks beyond it
+SUBMIT_TIMEOUT = 10
+SCAN_DEPTH = 32  # Items looked at per class when the head's peer is rate-limited
+LINK_RETRY = 0.05  # Re-check interval while the only eligible items wait on full link queues
+# Per-link hand-off queues stay short: whatever sits there is past the fair
+# queuing, so a chat message can wait behind at most this much bulk
+LINK_QUEUE_FRAMES = 8
+LINK_QUEUE_BYTES = 256 * 1024
+
+def classify(module, payload):
+    """Traffic class for one outbound module message."""
+    if isinstance(payload, dict) and payload.get('action') in BULK_ACTIONS:
+        return "bulk"
+    return MODULE_CLASSES.get(module, "control")
+
+class TokenBucket:
+    """Byte-rate limiter. A message larger than the burst goes out once the bucket is full."""
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.last = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def delay(self, nbytes, now):
+        """Seconds until `nbytes` may be sent (0 if now)."""
+        self._refill(now)
+        need = min(nbytes, self.burst)
+        return 0 if self.tokens >= need else (need - self.tokens) / self.rate
+
+    def consume(self, nbytes):
+        self.tokens -= nbytes
+
+class OutboundScheduler:
+    """
+    Orders locally originated module traffic before it reaches send_raw.
+    - One FIFO per traffic class, served by start-time fair queuing on bytes.
+    - Optional token buckets per destination peer and per module (bytes/s).
+    - A single dispatcher thread picks the order, then hands each message to
+      its link's sender (OutboundQueues: one thread per link), so the order
+      it picks is the wire order on every link, and a dead or slow link only
+      stalls its own messages. While a link's queue is full its messages are
+      passed over like a rate-limited peer's.
+    - on_queued() runs once a message is in its link's queue; nothing queued
+      on that link afterwards can overtake it (used to keep CREATEs first).
+    Relayed traffic is not scheduled here: relays cannot see the module.
+    Replies we send as a circuit's exit are (see RelayService._send_back).
+    """
+    def __init__(self, weights=None, peer_rate=None, module_rates=None):
+        self.weights = dict(weights or CLASS_WEIGHTS)
+        self.peer_rate = None
+        self.module_rates = {}
+        self.peer_buckets = {}    # peer_id -> TokenBucket
+        self.module_buckets = {}  # module -> TokenBucket
+        self.queues = {cls: deque() for cls in self.weights}
+        self.queued_bytes = {cls: 0 for cls in self.weights}
+        self.last_finish = {cls: 0.0 for cls in self.weights}
+        self.vtime = 0.0
+        self.class_stats = {cls: {"sent": 0, "bytes": 0, "wait_seconds": 0.0, "max_wait_seconds": 0.0, "dropped": 0}
+                            for cls in self.weights}
+        self.cond = threading.Condition()
+        self.senders = OutboundQueues(LINK_QUEUE_FRAMES, LINK_QUEUE_BYTES)
+        self.configure(peer_rate=peer_rate, module_rates=module_rates or {})
+        threading.Thread(target=self._dispatch_loop, daemon=True).start()
+
+    def configure(self, weights=None, peer_rate=False, module_rates=None):
+        """
+        Runtime reconfiguration. Rates are bytes/s with a one-second burst;
+        None (or 0) removes a limit. Arguments left out keep their current value.
+        """
+        with self.cond:
+            if weights:
+                for cls, weight in weights.items():
+                    if cls in self.weights and weight > 0:
+                        self.weights[cls] = weight
+            if peer_rate is not False:
+                self.peer_rate = peer_rate or None
+                self.peer_buckets = {}
+            if module_rates is not None:
+                self.module_rates = {m: r for m, r in module_rates.items() if r}
+                self.module_buckets = {m: TokenBucket(r) for m, r in self.module_rates.items()}
+            self.cond.notify_all()
+
+    def config(self):
+        with self.cond:
+            return {"weights": dict(self.weights), "peer_rate": self.peer_rate,
+                    "module_rates": dict(self.module_rates)}
+
+    def submit(self, cls, peer_id, module, nbytes, send, args, link=None, on_queued=None):
+        """
+        Queues send(*args) for the link `link` (default: the peer). Blocks while
+        the class queue is full; returns False if it gave up.
+        """
+        if cls not in self.queues: cls = "control"
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.queued_bytes[cls] < MAX_CLASS_BYTES, SUBMIT_TIMEOUT):
+                self.class_stats[cls]["dropped"] += 1
+                print(f"[SCHED] Dropped {cls} message for {peer_id}: queue full")
+                return False
+            start = max(self.vtime, self.last_finish[cls])
+            self.last_finish[cls] = start + nbytes / self.weights[cls]
+            self.queues[cls].append({
+                "start": start, "finish": self.last_finish[cls], "peer": peer_id, "module": module,
+                "link": link or peer_id, "nbytes": nbytes, "send": send, "args": args,
+                "on_queued": on_queued, "queued_at": time.monotonic()
+            })
+            self.queued_bytes[cls] += nbytes
+            self.cond.notify_all()
+            return True
+
+    def _pick(self, now):
+        """
+        Returns (cls, pos, None) for the eligible item with the smallest finish tag,
+        or (None, None, seconds) to wait for a bucket to refill (None: queues empty).
+        NOTE: Must be called while self.cond is held
+        """
+        best, best_cls, best_pos, wait = None, None, None, None
+        for cls, q in self.queues.items():
+            if not q: continue
+            blocked = set()  # Peers and links already held back; their later items must not overtake
+            for pos, item in enumerate(q):
+                if pos >= SCAN_DEPTH: break
+                if item["peer"] in blocked or item["link"] in blocked: continue
+                if not self.senders.accepts(item["link"], item["nbytes"]):
+                    blocked.add(item["link"])
+                    wait = LINK_RETRY if wait is None else min(wait, LINK_RETRY)
+                    continue
+                delay = self._delay(item, now)
+                if delay == 0:
+                    if best is None or item["finish"] < best["finish"]:
+                        best, best_cls, best_pos = item, cls, pos
+                    break
+                blocked.add(item["peer"])
+                wait = delay if wait is None else min(wait, delay)
+        if best is not None: return best_cls, best_pos, None
+        return None, None, wait
+
+    def _delay(self, item, now):
+        # NOTE: Must be called while self.cond is held
+        delay = 0
+        module_bucket = self.module_buckets.get(item["module"])
+        if module_bucket:
+            delay = module_bucket.delay(item["nbytes"], now)
+        if self.peer_rate:
+            bucket = self.peer_buckets.get(item["peer"])
+            if bucket is None:
+                bucket = self.peer_buckets[item["peer"]] = TokenBucket(self.peer_rate)
+            delay = max(delay, bucket.delay(item["nbytes"], now))
+        return delay
+
+    def _dispatch_loop(self):
+        while True:
+            with self.cond:
+                while True:
+                    now = time.monotonic()
+                    cls, pos, wait = self._pick(now)
+                    if cls: break
+                    self.cond.wait(wait)
+                item = self.queues[cls][pos]
+                del self.queues[cls][pos]
+                self.queued_bytes[cls] -= item["nbytes"]
+                self.vtime = item["start"]
+                if item["module"] in self.module_buckets:
+                    self.module_buckets[item["module"]].consume(item["nbytes"])
+                if self.peer_rate:
+                    self.peer_buckets[item["peer"]].consume(item["nbytes"])
+                waited = now - item["queued_at"]
+                s = self.class_stats[cls]
+                s["sent"] += 1
+                s["bytes"] += item["nbytes"]
+                s["wait_seconds"] += waited
+                s["max_wait_seconds"] = max(s["max_wait_seconds"], waited)
+                self.cond.notify_all()
+            # Only this thread puts to self.senders, so the queue still has room
+            self.senders.put(item["link"], item["send"], item["args"], item["nbytes"], timeout=0)
+            if item["on_queued"]:
+                item["on_queued"]()
+
+    def stats(self):
+        """Queue depth and wait time per class, for the dashboard."""
+        with self.cond:
+            return {
+                cls: {
+                    "depth": len(self.queues[cls]), "queued_bytes": self.queued_bytes[cls],
+                    "sent": s["sent"], "bytes": s["bytes"], "dropped": s["dropped"],
+                    "avg_wait_ms": round(s["wait_seconds"] / max(s["sent"], 1) * 1000, 2),
+                    "max_wait_ms": round(s["max_wait_seconds"] * 1000, 2)
+                } for cls, s in self.class_stats.items()
+            }
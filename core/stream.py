@@ -0,0 +1,308 @@
+import asyncio
+import queue
+import threading
+import time
+from core.flow import STREAM_WINDOW, BACKPRESSURE_TIMEOUT
+from core.multipath import xor_bytes, MAX_PATHS
+
+# A stream carries one large payload (a proxy response, a file) as a sequence
+# of cells of at most STREAM_CELL_SIZE bytes. Relays forward each cell as it
+# arrives, and the exit hands each chunk to the module once it is in order,
+# so no hop ever holds the whole payload.
+STREAM_CELL_SIZE = 64 * 1024
+# In-order chunks queued for the module. Past this the exit blocks before
+# crediting the cell (see RelayService._credit), which slows the sender down.
+STREAM_BUFFER_CELLS = 64
+# Cells that arrived ahead of a gap. The sender's stream window on each path
+# bounds this already; a stream that exceeds it is aborted.
+MAX_OUT_OF_ORDER = STREAM_WINDOW * MAX_PATHS
+# ...and so do the bytes those cells hold (a window's worth of full cells is more)
+MAX_STREAM_BUFFER = 8 * 1024 * 1024
+# Streams open at once, per circuit they arrive on and in total. Each one may
+# buffer up to the limits above and runs a consumer thread; cells opening more are dropped
+MAX_STREAMS_PER_CIRCUIT = 16
+MAX_OPEN_STREAMS = 64
+STREAM_READ_TIMEOUT = 30  # A consumer waiting this long for the next chunk gets TimeoutError
+STREAM_IDLE_TTL = 120     # The exit forgets a stream that has had no cells for this long
+FINISHED_TTL = 60         # Late cells (e.g. ones parity already rebuilt) of a finished stream are ignored this long
+
+_FIN = object()
+
+def stream_cells(chunks, size=STREAM_CELL_SIZE):
+    """
+    Re-slices bytes, or an iterable of byte strings, into (piece, fin) pairs of
+    at most `size` bytes. Pieces are views of the caller's chunks, and one
+    chunk is read ahead so the last piece carries fin=True. Empty input
+    still yields one empty fin piece.
+    """
+    if isinstance(chunks, (bytes, bytearray, memoryview)):
+        chunks = [chunks]
+    pending = None
+    try:
+        for chunk in chunks:
+            view = memoryview(chunk)
+            for pos in range(0, len(view), size):
+                if pending is not None:
+                    yield pending, False
+                pending = view[pos:pos + size]
+    except Exception:
+        # What was read before the failure still goes out
+        if pending is not None:
+            yield pending, False
+        raise
+    yield (pending if pending is not None else b""), True
+
+class InboundStream:
+    """
+    The receiving side of one stream, passed to the module as receive_stream(meta, stream).
+    `reply` answers the sender along the stream's circuit (None for replies).
+    Iterate it (`for chunk in stream`, or `async for`) to get the data in order
+    as it arrives. Iteration ends at the sender's last cell. It raises
+    ConnectionError if the stream was aborted and TimeoutError if it stalls.
+    """
+    def __init__(self, stream_id, module, reply=None):
+        self.stream_id = stream_id
+        self.module = module
+        self.reply = reply
+        self.meta = None
+        self.next_seq = 0
+        self.out_of_order = {}  # seq -> cell, waiting for the gap before it
+        self.parity = {}        # first seq of a group -> its XOR parity cell
+        self.recent = {}        # seq -> data of delivered cells in the current parity group
+        self.recent_group = None
+        self.circuit = reply.circ_id if reply else None  # Whose stream quota it counts against
+        self.last_seen = time.time()
+        self.bytes = 0
+        self.buffered = 0       # Bytes held in out_of_order and parity
+        self.lock = threading.Lock()  # Held while cells are reordered and queued
+        self.queue = queue.Queue(STREAM_BUFFER_CELLS)
+        self.error = None
+        self.end = None         # _FIN or the error, also kept here in case the queue was full
+        self.done = False       # Consumer has seen the end
+        self.abandoned = False  # Consumer returned early; further chunks are discarded
+
+    def read(self, timeout=STREAM_READ_TIMEOUT):
+        """Next chunk in order, or None once the stream has ended."""
+        if self.done: return None
+        try:
+            item = self.queue.get_nowait()
+        except queue.Empty:
+            # Everything queued before the end has been read
+            item = self.end
+        if item is None:
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                self.done = True
+                raise self.error or TimeoutError(f"Stream {self.stream_id} stalled")
+        if item is _FIN:
+            self.done = True
+            return None
+        if isinstance(item, Exception):
+            self.done = True
+            raise item
+        return item
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        chunk = self.read()
+        if chunk is None: raise StopIteration
+        return chunk
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        chunk = await asyncio.get_running_loop().run_in_executor(None, self.read)
+        if chunk is None: raise StopAsyncIteration
+        return chunk
+
+class StreamReceiver:
+    """
+    Reassembles stream cells at the exit, and reply streams at the originator.
+    - Cells are put back in order by seq. A few may overtake each other, e.g.
+      around the CREATE, or when the asyncio engine delivers them from its executor.
+    - Each chunk is queued for the module as soon as everything before it has
+      arrived. The module's receive_stream(meta, stream) runs in its own thread
+      from the first cell on.
+    """
+    def __init__(self, node):
+        self.node = node
+        self.streams = {}  # stream id -> InboundStream
+        self.lock = threading.Lock()
+        self._last_sweep = time.time()
+        self.finished = {}  # stream id -> when it ended
+        self.counters = {"opened": 0, "completed": 0, "aborted": 0, "refused": 0, "cells": 0, "bytes": 0,
+                         "recovered": 0}
+
+    def receive(self, data, reply=None):
+        """
+        One stream cell: {"module", "stream", "seq", "fin", "data"} plus "payload"
+        on seq 0, "group" when parity covers it and "error" if the sender aborted;
+        or a parity cell: {"module", "stream", "parity", "lens", "fin", "data"}.
+        `reply` is the ReplyPath of the circuit it came on, if any.
+        """
+        sid, module = data.get('stream'), data.get('module')
+        if not hasattr(self.node.modules.get(module), 'receive_stream'):
+            print(f"[STREAM] No stream handler for module '{module}'")
+            return
+        position = data.get('parity', data.get('seq', 0))
+        chunk = data.get('data') or b""
+        if not isinstance(sid, str) or not isinstance(position, int) or position < 0 \
+                or not isinstance(chunk, (bytes, bytearray)) or len(chunk) > STREAM_CELL_SIZE:
+            print(f"[STREAM] Dropped malformed cell for stream {sid}")
+            return
+        with self.lock:
+            self._sweep()
+            if sid in self.finished: return
+            stream = self.streams.get(sid)
+            if stream is None:
+                circuit = reply.circ_id if reply else None
+                if len(self.streams) >= MAX_OPEN_STREAMS or \
+                        sum(1 for s in self.streams.values() if s.circuit == circuit) >= MAX_STREAMS_PER_CIRCUIT:
+                    self.counters["refused"] += 1
+                    print(f"[STREAM] Refused stream {sid}: too many open streams")
+                    return
+                stream = self.streams[sid] = InboundStream(sid, module, reply)
+                self.counters["opened"] += 1
+            stream.last_seen = time.time()
+            self.counters["cells"] += 1
+
+        # Per-stream lock: cells of one stream are queued in order even when
+        # several threads deliver them, and a full queue only stalls this stream
+        with stream.lock:
+            if len(stream.out_of_order) + len(stream.parity) >= MAX_OUT_OF_ORDER \
+                    or stream.buffered + len(chunk) > MAX_STREAM_BUFFER:
+                self._abort(stream, ConnectionError(f"Stream {sid} lost cell {stream.next_seq}"))
+                return
+            if 'parity' in data:
+                lens = data.get('lens')
+                if not isinstance(lens, list) or not all(isinstance(n, int) for n in lens): return
+                if position + len(lens) <= stream.next_seq or position in stream.parity: return  # Group already complete
+                stream.parity[position] = data
+            else:
+                if position < stream.next_seq or position in stream.out_of_order: return  # Duplicate
+                stream.out_of_order[position] = data
+            stream.buffered += len(chunk)
+            while True:
+                while stream.next_seq in stream.out_of_order:
+                    cell = stream.out_of_order.pop(stream.next_seq)
+                    stream.buffered -= len(cell.get('data') or b"")
+                    stream.next_seq += 1
+                    if not self._deliver(stream, cell): return
+                if not (stream.parity and self._recover(stream)): break
+
+    def _recover(self, stream):
+        """
+        Rebuilds the missing cell at stream.next_seq from its group's parity
+        cell once every other cell of the group is here. Returns True if it did.
+        NOTE: Must be called while stream.lock is held
+        """
+        for first in [f for f, p in stream.parity.items() if f + len(p['lens']) <= stream.next_seq]:
+            stream.buffered -= len(stream.parity.pop(first).get('data') or b"")
+        firsts = [f for f in stream.parity if f <= stream.next_seq]
+        if not firsts: return False
+        check = stream.parity[max(firsts)]
+        first, lens = check['parity'], check['lens']
+        pieces = [check['data']]
+        for seq in range(first, first + len(lens)):
+            if seq == stream.next_seq: continue
+            if seq in stream.recent:
+                pieces.append(stream.recent[seq])
+            elif seq in stream.out_of_order:
+                pieces.append(stream.out_of_order[seq].get('data') or b"")
+            else:
+                return False  # More than one cell of the group is missing
+        seq = stream.next_seq
+        last = seq == first + len(lens) - 1
+        stream.out_of_order[seq] = {"seq": seq, "group": first, "fin": check.get('fin') and last,
+                                    "payload": check.get('payload'),
+                                    "data": xor_bytes(pieces)[:lens[seq - first]]}
+        del stream.parity[first]
+        stream.buffered += len(stream.out_of_order[seq]['data']) - len(check['data'] or b"")
+        with self.lock:
+            self.counters["recovered"] += 1
+        return True
+
+    def _deliver(self, stream, cell):
+        """
+        Queues one in-order cell for the consumer. Returns False once the stream is finished.
+        NOTE: Must be called while stream.lock is held
+        """
+        if cell.get('seq') == 0:
+            stream.meta = cell.get('payload')
+            threading.Thread(target=self._consume, args=(stream,), daemon=True).start()
+        chunk = cell.get('data')
+        # Cells of the current parity group are kept until it is complete, to rebuild a lost one
+        if cell.get('group') != stream.recent_group:
+            stream.recent, stream.recent_group = {}, cell.get('group')
+        if stream.recent_group is not None:
+            stream.recent[cell['seq']] = chunk or b""
+        if chunk and not stream.abandoned:
+            try:
+                stream.queue.put(chunk, timeout=BACKPRESSURE_TIMEOUT)
+            except queue.Full:
+                self._abort(stream, TimeoutError(f"Stream {stream.stream_id} consumer is not reading"))
+                return False
+            stream.bytes += len(chunk)
+            with self.lock:
+                self.counters["bytes"] += len(chunk)
+        if cell.get('error'):
+            self._abort(stream, ConnectionError(f"Stream {stream.stream_id} aborted by sender: {cell['error']}"))
+            return False
+        if cell.get('fin'):
+            self._finish(stream, _FIN)
+            with self.lock:
+                self.counters["completed"] += 1
+            return False
+        return True
+
+    def _consume(self, stream):
+        try:
+            self.node.modules[stream.module].receive_stream(stream.meta, stream)
+        except Exception as e:
+            print(f"[STREAM] {stream.module} stream {stream.stream_id} error: {e}")
+        finally:
+            stream.abandoned = not stream.done
+
+    def _abort(self, stream, error):
+        print(f"[STREAM] {error}")
+        stream.error = error
+        self._finish(stream, error)
+        with self.lock:
+            self.counters["aborted"] += 1
+
+    def _finish(self, stream, last):
+        """Ends the stream for the consumer (FIN or the error) and forgets it."""
+        stream.end = last  # Set first: read() falls back to it once the queue is drained
+        try:
+            stream.queue.put_nowait(last)
+        except queue.Full:
+            pass
+        stream.parity, stream.recent, stream.out_of_order, stream.buffered = {}, {}, {}, 0
+        with self.lock:
+            if self.streams.get(stream.stream_id) is stream:
+                del self.streams[stream.stream_id]
+                self.finished[stream.stream_id] = time.time()
+
+    def _sweep(self):
+        # NOTE: Must be called while self.lock is held
+        now = time.time()
+        if now - self._last_sweep < 60: return
+        self._last_sweep = now
+        self.finished = {sid: t for sid, t in self.finished.items() if now - t < FINISHED_TTL}
+        for sid, stream in list(self.streams.items()):
+            if now - stream.last_seen > STREAM_IDLE_TTL:
+                del self.streams[sid]
+                stream.error = stream.end = ConnectionError(f"Stream {sid} timed out")
+                self.counters["aborted"] += 1
+                try:
+                    stream.queue.put_nowait(stream.error)
+                except queue.Full:
+                    pass
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, open=len(self.streams))
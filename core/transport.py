@@ -0,0 +1,344 @@
+import socket
+import select
+import struct
+import threading
+import time
+
+# Validate message size to prevent DoS attacks
+MAX_MESSAGE_SIZE = 10 * 1024 * 1024  # 10MB limit
+
+CONNECT_TIMEOUT = 5
+IO_TIMEOUT = 10          # A frame that stalls mid-read/write this long kills the link
+IDLE_TIMEOUT = 120       # Pooled links unused this long are closed
+BACKOFF_BASE = 0.5       # Reconnect backoff: 0.5s, 1s, 2s, ... capped at BACKOFF_MAX
+BACKOFF_MAX = 30
+# Write coalescing: frames sent to a link within this many seconds of each
+# other leave in one vectored write. Off by default: every frame (interactive
+# ones included) would wait up to the delay. 0 = one synchronous write per frame.
+COALESCE_DELAY = 0
+COALESCE_MAX_BYTES = 256 * 1024  # Unflushed bytes per link before send_frame blocks
+IOV_MAX = 1024                   # Buffers per sendmsg() call (the Linux limit)
+WRITER_IDLE = 5                  # Seconds before an idle link's writer thread exits
+
+def send_parts(sock, parts):
+    """
+    Writes a list of buffers with as few syscalls as possible. Returns the number of calls.
+    An OSError carries `written`: the bytes handed to the kernel before it failed.
+    """
+    if not hasattr(sock, "sendmsg"):
+        sock.sendall(b"".join(parts))
+        return 1
+    calls = written = 0
+    parts = [memoryview(p) for p in parts]
+    while parts:
+        try:
+            sent = sock.sendmsg(parts[:IOV_MAX])
+        except OSError as e:
+            e.written = written
+            raise
+        calls += 1
+        written += sent
+        # Drop what was written; a partial write leaves the tail of one buffer
+        done = 0
+        while done < len(parts) and sent >= len(parts[done]):
+            sent -= len(parts[done])
+            done += 1
+        parts = parts[done:]
+        if sent:
+            parts[0] = parts[0][sent:]
+    return calls
+
+def recv_into_exact(sock, view):
+    """Fills the writable memoryview `view` from the socket. Returns False on EOF."""
+    got = 0
+    while got < len(view):
+        n = sock.recv_into(view[got:])
+        if not n: return False
+        got += n
+    return True
+
+def recvall(sock, n):
+    """Helper to receive exactly n bytes to prevent fragmentation."""
+    data = bytearray(n)
+    return data if recv_into_exact(sock, memoryview(data)) else None
+
+def read_frame(sock, header=None):
+    """
+    Reads one length-prefixed frame. Returns None on EOF or an oversized frame
+    (the stream cannot be resynchronized after either, so the caller must close).
+    The body is received straight into one buffer of the announced size; it
+    is not recycled, since parsers may hand out memoryviews into it.
+    `header` is an optional reusable 4-byte buffer for the length prefix.
+    """
+    header = header if header is not None else bytearray(4)
+    if not recv_into_exact(sock, memoryview(header)): return None
+    msglen = struct.unpack('>I', header)[0]
+    if msglen > MAX_MESSAGE_SIZE:
+        print(f"[SECURITY] Rejected message: size {msglen} exceeds limit {MAX_MESSAGE_SIZE}")
+        return None
+    return recvall(sock, msglen)
+
+def serve_frames(sock, handler, idle_timeout=None, running=lambda: True):
+    """
+    Frame loop shared by the relay (inbound links) and the pool (replies on
+    outbound links): calls handler(frame) for each frame until EOF, error,
+    or idle_timeout seconds without traffic.
+    """
+    last_frame = time.time()
+    header = bytearray(4)
+    while running():
+        readable, _, _ = select.select([sock], [], [], 1.0)
+        if not readable:
+            if idle_timeout and time.time() - last_frame > idle_timeout:
+                return
+            continue
+        data = read_frame(sock, header)
+        if data is None: return
+        last_frame = time.time()
+        handler(data)
+
+class Connection:
+    """
+    A long-lived TCP link carrying many length-prefixed frames.
+    With coalesce_delay > 0, send_frame() only queues the frame: a writer
+    thread waits that long for more, then writes the whole batch with one
+    sendmsg(). A write error kills the link, so the next send_frame() raises
+    and the pool reconnects; frames queued but not fully written by then are
+    handed to on_error(frames) rather than dropped.
+    on_flush(nbytes, frames, seconds) sees every write.
+    """
+    def __init__(self, sock, addr, coalesce_delay=0, on_flush=None, on_error=None):
+        self.sock = sock
+        self.addr = addr
+        self.send_lock = threading.Lock()
+        self.alive = True
+        self.created = time.time()
+        self.last_used = self.created
+        self.frames_sent = 0
+        self.writes = 0  # send syscalls
+        self.coalesce_delay = coalesce_delay
+        self.on_flush = on_flush
+        self.on_error = on_error
+        self.pending = []  # Frames not yet written, each a list of buffers (header first)
+        self.pending_bytes = 0
+        self.pending_cond = threading.Condition()
+        self.writer = None
+
+    def send_frame(self, data):
+        """`data` is one buffer or a list of buffers (see protocol.serialize_parts); none are copied."""
+        parts = data if isinstance(data, list) else [data]
+        length = sum(len(p) for p in parts)
+        header = struct.pack('>I', length)
+        if not self.coalesce_delay:
+            with self.send_lock:
+                start = time.perf_counter()
+                self.writes += send_parts(self.sock, [header] + parts)
+                self.last_used = time.time()
+                self.frames_sent += 1
+            if self.on_flush: self.on_flush(length + 4, 1, time.perf_counter() - start)
+            return
+
+        with self.pending_cond:
+            # Bounded like a socket buffer: a stalled link pushes back on the sender
+            if not self.pending_cond.wait_for(
+                    lambda: not self.alive or self.pending_bytes < COALESCE_MAX_BYTES, IO_TIMEOUT):
+                raise TimeoutError(f"{self.addr} write buffer full")
+            if not self.alive:
+                raise ConnectionError(f"{self.addr} link closed")
+            self.pending.append([header] + parts)
+            self.pending_bytes += length + 4
+            self.frames_sent += 1
+            self.last_used = time.time()
+            self._wake_writer()
+
+    def requeue(self, frames):
+        """Puts frames another link failed to write ahead of anything queued here."""
+        with self.pending_cond:
+            if not self.alive:
+                raise ConnectionError(f"{self.addr} link closed")
+            self.pending[:0] = frames
+            self.pending_bytes += sum(len(p) for frame in frames for p in frame)
+            self._wake_writer()
+
+    # NOTE: Must be called while self.pending_cond is held
+    def _wake_writer(self):
+        if self.writer is None:
+            self.writer = threading.Thread(target=self._write_loop, daemon=True)
+            self.writer.start()
+        self.pending_cond.notify_all()
+
+    def _write_loop(self):
+        while True:
+            with self.pending_cond:
+                if not self.pending_cond.wait_for(lambda: self.pending or not self.alive, WRITER_IDLE) \
+                        or not self.alive:
+                    self.writer = None
+                    return
+            # Let the rest of the burst arrive
+            time.sleep(self.coalesce_delay)
+            with self.pending_cond:
+                batch, nbytes = self.pending, self.pending_bytes
+                self.pending, self.pending_bytes = [], 0
+                self.pending_cond.notify_all()
+            try:
+                with self.send_lock:
+                    start = time.perf_counter()
+                    self.writes += send_parts(self.sock, [p for frame in batch for p in frame])
+                if self.on_flush: self.on_flush(nbytes, len(batch), time.perf_counter() - start)
+            except OSError as e:
+                with self.pending_cond:
+                    self.writer = None
+                self.close(unsent=self._unwritten(batch, getattr(e, "written", 0)))
+                return
+
+    @staticmethod
+    def _unwritten(batch, written):
+        """Frames of a batch not fully handed to the kernel (a torn frame is resent whole)."""
+        for i, frame in enumerate(batch):
+            written -= sum(len(p) for p in frame)
+            if written < 0:
+                return batch[i:]
+        return []
+
+    def close(self, unsent=()):
+        """Kills the link. Frames still queued (plus `unsent`) go to on_error for another link."""
+        with self.pending_cond:
+            self.alive = False
+            frames = list(unsent) + self.pending
+            self.pending, self.pending_bytes = [], 0
+            self.pending_cond.notify_all()
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+        if frames and self.on_error:
+            self.on_error(frames)
+
+class ConnectionPool:
+    """
+    Keyed pool of persistent links, one per (host, port).
+    - Links are reused for every frame to that peer and closed after IDLE_TIMEOUT.
+    - A reader thread per link hands frames the peer sends back to on_frame,
+      and marks the link dead on EOF (the health check used by get()).
+    - A failed send is retried once on a fresh link; failed connects back off
+      exponentially so a dead peer is not hammered.
+    - Small frames to the same peer can be coalesced into one write (see Connection);
+      on_flush(key, nbytes, seconds) is called after each write.
+    - A coalesced send has already returned when its write fails, so the pool
+      moves the link's unwritten frames to a fresh link itself and reports the
+      failure to on_failure(key), like the synchronous retry path does.
+    """
+    def __init__(self, on_frame=None, coalesce_delay=COALESCE_DELAY, on_flush=None, on_failure=None):
+        self.on_frame = on_frame
+        self.coalesce_delay = coalesce_delay
+        self.on_flush = on_flush
+        self.on_failure = on_failure
+        self.conns = {}
+        self.backoff = {}   # (host, port) -> (consecutive_failures, retry_at)
+        self.lock = threading.Lock()
+        self.running = True
+        self.stats = {"connects": 0, "reuses": 0, "reconnects": 0, "evictions": 0, "failures": 0,
+                      "flushes": 0, "frames_flushed": 0,
+                      "requeued": 0, "lost_frames": 0}
+        threading.Thread(target=self._evict_idle, daemon=True).start()
+
+    def send(self, host, port, data):
+        key = (host, port)
+        conn = self.get(host, port)
+        try:
+            conn.send_frame(data)
+        except OSError:
+            # Stale link (peer restarted, NAT dropped it...): reconnect once
+            self._discard(key, conn)
+            self.stats["reconnects"] += 1
+            self.get(host, port).send_frame(data)
+
+    def get(self, host, port):
+        key = (host, port)
+        with self.lock:
+            conn = self.conns.get(key)
+            if conn and conn.alive:
+                self.stats["reuses"] += 1
+                return conn
+            failures, retry_at = self.backoff.get(key, (0, 0))
+            if time.time() < retry_at:
+                raise ConnectionError(f"{host}:{port} in reconnect backoff")
+
+        try:
+            sock = socket.create_connection(key, timeout=CONNECT_TIMEOUT)
+        except OSError:
+            with self.lock:
+                self.backoff[key] = (failures + 1, time.time() + min(BACKOFF_BASE * 2 ** failures, BACKOFF_MAX))
+            self.stats["failures"] += 1
+            raise
+        sock.settimeout(IO_TIMEOUT)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn = Connection(sock, key, self.coalesce_delay,
+                          on_flush=lambda nbytes, frames, seconds: self._flushed(key, nbytes, frames, seconds),
+                          on_error=lambda frames: self._requeue(key, frames))
+
+        with self.lock:
+            existing = self.conns.get(key)
+            if existing and existing.alive:
+                # Another thread connected first; keep a single link per peer
+                conn.close()
+                return existing
+            self.conns[key] = conn
+            self.backoff.pop(key, None)
+        self.stats["connects"] += 1
+        threading.Thread(target=self._reader, args=(conn,), daemon=True).start()
+        return conn
+
+    def _flushed(self, key, nbytes, frames, seconds):
+        self.stats["flushes"] += 1
+        self.stats["frames_flushed"] += frames
+        if self.on_flush: self.on_flush(key, nbytes, seconds)
+
+    def _requeue(self, key, frames):
+        """A link died holding frames its senders think are sent: retry them once on a fresh link."""
+        self.stats["reconnects"] += 1
+        if self.on_failure: self.on_failure(key)
+        if not self.running: return
+        try:
+            self.get(*key).requeue(frames)
+            self.stats["requeued"] += len(frames)
+        except OSError as e:
+            self.stats["lost_frames"] += len(frames)
+            print(f"Send failed: {len(frames)} queued frames to {key[0]}:{key[1]} lost ({e})")
+
+    def _reader(self, conn):
+        try:
+            serve_frames(conn.sock, lambda data: self._received(conn, data), running=lambda: conn.alive)
+        except (OSError, ValueError):
+            pass
+        finally:
+            self._discard(conn.addr, conn)
+
+    def _received(self, conn, data):
+        # Frames coming back (SENDMEs, replies) keep a link in use as much as
+        # ours going out; evicting it would strand the circuits returning on it
+        conn.last_used = time.time()
+        if self.on_frame: self.on_frame(data, conn)
+
+    def _discard(self, key, conn):
+        with self.lock:
+            if self.conns.get(key) is conn:
+                del self.conns[key]
+        conn.close()
+
+    def _evict_idle(self):
+        while self.running:
+            time.sleep(5)
+            now = time.time()
+            with self.lock:
+                idle = [(k, c) for k, c in self.conns.items() if now - c.last_used > IDLE_TIMEOUT]
+            for key, conn in idle:
+                self.stats["evictions"] += 1
+                self._discard(key, conn)
+
+    def close_all(self):
+        self.running = False
+        with self.lock:
+            conns = list(self.conns.items())
+        for key, conn in conns:
+            self._discard(key, conn)
@@ -0,0 +1,64 @@
+import zlib
+
+class Bitfield:
+    """Fixed-size set of piece indices, packed MSB-first like a BitTorrent bitfield."""
+    def __init__(self, size, data=None):
+        self.size = size
+        nbytes = (size + 7) // 8
+        self.bits = bytearray(data[:nbytes]) if data is not None else bytearray(nbytes)
+        if len(self.bits) < nbytes:
+            self.bits.extend(bytes(nbytes - len(self.bits)))
+        # Spare bits in the last byte must stay clear or count() is off
+        if size % 8 and nbytes:
+            self.bits[-1] &= (0xFF << (8 - size % 8)) & 0xFF
+
+    @classmethod
+    def from_indices(cls, size, indices):
+        field = cls(size)
+        for idx in indices:
+            field.set(idx)
+        return field
+
+    @classmethod
+    def from_compressed(cls, size, blob):
+        """Inverse of compressed(). Raises ValueError on a corrupt or oversized blob."""
+        try:
+            data = zlib.decompressobj().decompress(blob, (size + 7) // 8 + 1)
+        except zlib.error as e:
+            raise ValueError(f"Bad bitfield: {e}")
+        if len(data) != (size + 7) // 8:
+            raise ValueError("Bad bitfield: wrong length")
+        return cls(size, data)
+
+    def set(self, idx):
+        """Returns True if the bit was newly set."""
+        if not 0 <= idx < self.size: return False
+        mask = 0x80 >> (idx & 7)
+        if self.bits[idx >> 3] & mask: return False
+        self.bits[idx >> 3] |= mask
+        return True
+
+    def __contains__(self, idx):
+        return 0 <= idx < self.size and bool(self.bits[idx >> 3] & (0x80 >> (idx & 7)))
+
+    def count(self):
+        return sum(bin(b).count("1") for b in self.bits)
+
+    @property
+    def complete(self):
+        return self.count() == self.size
+
+    def indices(self):
+        out = []
+        for pos, byte in enumerate(self.bits):
+            if not byte: continue  # Skip empty bytes; sparse fields are cheap to walk
+            base = pos << 3
+            out.extend(base + bit for bit in range(8) if byte & (0x80 >> bit))
+        return out
+
+    def to_bytes(self):
+        return bytes(self.bits)
+
+    def compressed(self):
+        """zlib-compressed bytes for the wire; all-set and all-clear fields shrink to a few bytes."""
+        return zlib.compress(self.bits)
@@ -1,16 +1,19 @@
+import os
 from datetime import datetime
 
 class ChatModule:
     def __init__(self, node):
         self.node = node
         self.messages = []  # List of {timestamp, msg}
+        # Random per session: links our messages to each other, never to our key or address
+        self.pseudonym = os.urandom(8).hex()
 
     def send_message(self, text):
         # Create Payload
         msg_packet = {
             "text": text, 
             "ts": datetime.now().strftime("%H:%M:%S"),
-            "sender_fp": self.node.pub_key.decode('utf-8')[:20] + "..." # Anonymous Fingerprint
+            "sender_fp": self.pseudonym
         }
         
         # Log locally
@@ -22,6 +25,6 @@ class ChatModule:
         for peer_id in self.node.peers:
             self.node.send_onion_to_peer(peer_id, "chat", msg_packet)
 
-    def receive(self, payload):
+    def receive(self, payload, reply=None):
         # Deduplication could go here, but for MVP we just append
         self.messages.append(payload)
\ No newline at end of file
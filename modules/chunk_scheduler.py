@@ -0,0 +1,150 @@
+import heapq
+import random
+import time
+from modules.bitfield import Bitfield
+
+CHUNK_WINDOW = 8         # Requests kept in flight per download
+PER_PEER_LIMIT = 4       # ...of which at most this many to one holder
+REQUEST_TIMEOUT = 15     # Seconds before an unanswered get_chunk is re-requested
+
+class ChunkScheduler:
+    """
+    Decides which chunk to request next, and from which holder, for one download.
+
+    - Keeps up to `window` requests in flight, spread across holders
+      (least-loaded holder first, at most `per_peer_limit` each).
+    - Rarest-first: chunks come off a heap keyed by how many holders have them.
+      Heap entries are lazy; stale ones (availability changed, already in flight
+      or received) are skipped when popped, so no re-sorting per chunk.
+    - Requests that time out or fail verification are retried, preferring a
+      different holder.
+    - Endgame: once every missing chunk is already requested, the remaining ones
+      are also requested from a second holder so one slow peer cannot stall the tail.
+    """
+    def __init__(self, total, window=CHUNK_WINDOW, per_peer_limit=PER_PEER_LIMIT, timeout=REQUEST_TIMEOUT, held=()):
+        self.total = total
+        self.window = window
+        self.per_peer_limit = per_peer_limit
+        self.timeout = timeout
+
+        self.needed = set(range(total)) - set(held)  # `held`: chunks already on disk (resume)
+        self.availability = [0] * total
+        self.peer_pieces = {}      # peer_id -> Bitfield of indices it holds
+        self.in_flight = {}        # idx -> {peer_id: deadline}
+        self.peer_load = {}        # peer_id -> requests in flight
+        self.failed = {}           # idx -> peers that timed out or sent a bad copy
+        self._heap = []
+        self.stats = {"requested": 0, "received": 0, "timeouts": 0, "duplicates": 0, "rejected": 0}
+
+    @property
+    def done(self):
+        return not self.needed
+
+    def add_peer(self, peer_id, indices):
+        """Records (or extends) what a holder has. `indices` may be a Bitfield."""
+        if isinstance(indices, Bitfield): indices = indices.indices()
+        pieces = self.peer_pieces.get(peer_id)
+        if pieces is None:
+            pieces = self.peer_pieces[peer_id] = Bitfield(self.total)
+        self.peer_load.setdefault(peer_id, 0)
+        for idx in indices:
+            if not pieces.set(idx): continue  # Already known or out of range
+            self.availability[idx] += 1
+            if idx in self.needed:
+                heapq.heappush(self._heap, (self.availability[idx], random.random(), idx))
+
+    def remove_peer(self, peer_id):
+        pieces = self.peer_pieces.pop(peer_id, None)
+        for idx in (pieces.indices() if pieces else []):
+            self.availability[idx] -= 1
+            if idx in self.needed:
+                heapq.heappush(self._heap, (self.availability[idx], random.random(), idx))
+        for idx, holders in self.in_flight.items():
+            holders.pop(peer_id, None)
+        self.in_flight = {i: h for i, h in self.in_flight.items() if h}
+        self.peer_load.pop(peer_id, None)
+
+    def received(self, idx):
+        """Marks a chunk as stored. Returns False if it was a duplicate/unneeded copy."""
+        if idx not in self.needed:
+            self.stats["duplicates"] += 1
+            return False
+        self.needed.discard(idx)
+        self.failed.pop(idx, None)
+        for peer_id in self.in_flight.pop(idx, {}):
+            self.peer_load[peer_id] = max(0, self.peer_load.get(peer_id, 0) - 1)
+        self.stats["received"] += 1
+        return True
+
+    def rejected(self, idx, peer_id):
+        """A chunk from `peer_id` failed verification: re-queue it, preferring other holders."""
+        if idx not in self.needed: return
+        holders = self.in_flight.get(idx, {})
+        if holders.pop(peer_id, None) is not None:
+            self.peer_load[peer_id] = max(0, self.peer_load.get(peer_id, 0) - 1)
+        self.failed.setdefault(idx, set()).add(peer_id)
+        self.stats["rejected"] += 1
+        if not holders:
+            self.in_flight.pop(idx, None)
+            heapq.heappush(self._heap, (self.availability[idx], random.random(), idx))
+
+    def expire(self, now=None):
+        """Drops requests past their deadline so next_requests() re-issues them."""
+        now = time.time() if now is None else now
+        for idx in list(self.in_flight):
+            holders = self.in_flight[idx]
+            for peer_id, deadline in list(holders.items()):
+                if deadline > now: continue
+                del holders[peer_id]
+                self.peer_load[peer_id] = max(0, self.peer_load.get(peer_id, 0) - 1)
+                self.failed.setdefault(idx, set()).add(peer_id)
+                self.stats["timeouts"] += 1
+            if not holders:
+                del self.in_flight[idx]
+                heapq.heappush(self._heap, (self.availability[idx], random.random(), idx))
+
+    def next_requests(self, now=None):
+        """Fills the window. Returns [(idx, peer_id)] to send get_chunk for."""
+        now = time.time() if now is None else now
+        requests = []
+        deferred = []
+
+        while len(self.in_flight) < self.window and self._heap:
+            avail, tiebreak, idx = heapq.heappop(self._heap)
+            if idx not in self.needed or idx in self.in_flight or avail != self.availability[idx]:
+                continue  # Stale heap entry
+            peer_id = self._pick_holder(idx)
+            if peer_id is None:
+                deferred.append((avail, tiebreak, idx))
+                continue
+            self._assign(idx, peer_id, now)
+            requests.append((idx, peer_id))
+
+        for entry in deferred:
+            heapq.heappush(self._heap, entry)
+
+        # Endgame: every missing chunk is in flight; duplicate the stragglers
+        if self.needed and len(self.needed) <= self.window and all(i in self.in_flight for i in self.needed):
+            for idx in sorted(self.needed):
+                if len(self.in_flight[idx]) > 1: continue
+                peer_id = self._pick_holder(idx)
+                if peer_id is None: continue
+                self._assign(idx, peer_id, now)
+                requests.append((idx, peer_id))
+
+        return requests
+
+    def _pick_holder(self, idx):
+        asked = self.in_flight.get(idx, {})
+        failed = self.failed.get(idx, set())
+        candidates = [p for p, pieces in self.peer_pieces.items()
+                      if idx in pieces and p not in asked and self.peer_load[p] < self.per_peer_limit]
+        if not candidates: return None
+        # Prefer holders that have not failed on this chunk, then the least loaded
+        fresh = [p for p in candidates if p not in failed] or candidates
+        return min(fresh, key=lambda p: (self.peer_load[p], random.random()))
+
+    def _assign(self, idx, peer_id, now):
+        self.in_flight.setdefault(idx, {})[peer_id] = now + self.timeout
+        self.peer_load[peer_id] += 1
+        self.stats["requested"] += 1
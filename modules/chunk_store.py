@@ -0,0 +1,211 @@
+import os
+import io
+import mmap
+from collections import OrderedDict
+
+# Bytes of unreferenced pieces kept around for reuse by later files
+PIECE_CACHE_LIMIT = 64 * 1024 * 1024
+
+class PieceReader(io.RawIOBase):
+    """Read-only file object over a list of pieces, copied out as they are read (nothing joined up front)."""
+    def __init__(self, pieces):
+        self.pieces = pieces
+        self.index = 0   # Piece being read
+        self.offset = 0  # Position within it
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        view = memoryview(buf).cast('B')
+        n = 0
+        while n < len(view) and self.index < len(self.pieces):
+            piece = self.pieces[self.index]
+            take = min(len(view) - n, len(piece) - self.offset)
+            view[n:n + take] = piece[self.offset:self.offset + take]
+            n += take
+            self.offset += take
+            if self.offset == len(piece):
+                self.index, self.offset = self.index + 1, 0
+        return n
+
+class PieceStore:
+    """
+    Content-addressed in-memory store: each distinct chunk is kept once, keyed
+    by its SHA-256 digest (the file's Merkle leaf), with a reference count.
+    A file is just a manifest of digests, so files sharing content (successive
+    builds, say) share the pieces; put() of a piece already held only adds a
+    reference.
+
+    Referenced pieces are never evicted. When the last file using a piece is
+    removed, the piece moves to an LRU cache of PIECE_CACHE_LIMIT bytes, where
+    a later file can still pick it up.
+    """
+    def __init__(self, chunk_size, cache_limit=PIECE_CACHE_LIMIT):
+        self.chunk_size = chunk_size
+        self.cache_limit = cache_limit
+        self.pieces = {}                # digest -> bytes (referenced)
+        self.refs = {}                  # digest -> number of manifest slots using it
+        self.unreferenced = OrderedDict()  # digest -> bytes, oldest first
+        self.cached_bytes = 0
+        self.manifests = {}             # f_hash -> {"leaves": [digest], "have": set(idx)}
+
+    def create(self, f_hash, size, total, leaves):
+        if f_hash not in self.manifests:
+            self.manifests[f_hash] = {"leaves": leaves, "have": set()}
+
+    def _ref(self, manifest, idx, digest, data):
+        if digest in self.unreferenced:
+            self.pieces[digest] = self.unreferenced.pop(digest)
+            self.cached_bytes -= len(self.pieces[digest])
+        elif digest not in self.pieces:
+            self.pieces[digest] = bytes(data)
+        self.refs[digest] = self.refs.get(digest, 0) + 1
+        manifest['have'].add(idx)
+
+    def put(self, f_hash, idx, data):
+        manifest = self.manifests[f_hash]
+        if idx in manifest['have']: return
+        self._ref(manifest, idx, manifest['leaves'][idx], data)
+
+    def get(self, f_hash, idx):
+        manifest = self.manifests.get(f_hash)
+        if manifest is None or idx not in manifest['have']: return None
+        return self.pieces[manifest['leaves'][idx]]
+
+    def lookup(self, digest):
+        """A piece by digest, whichever file (if any) it came from."""
+        return self.pieces.get(digest) or self.unreferenced.get(digest)
+
+    def has(self, f_hash, idx):
+        return idx in self.manifests.get(f_hash, {}).get('have', ())
+
+    def indices(self, f_hash):
+        return list(self.manifests.get(f_hash, {}).get('have', ()))
+
+    def count(self, f_hash):
+        return len(self.manifests.get(f_hash, {}).get('have', ()))
+
+    def adopt(self, f_hash, indices, verify=None):
+        return []  # Nothing survives a restart
+
+    def finalize(self, f_hash):
+        pass
+
+    def open(self, f_hash):
+        """Readable file object over the assembled file, streamed piece by piece."""
+        manifest = self.manifests[f_hash]
+        return io.BufferedReader(PieceReader([self.pieces[d] for d in manifest['leaves']]))
+
+    def remove(self, f_hash):
+        manifest = self.manifests.pop(f_hash, None)
+        if not manifest: return
+        for idx in manifest['have']:
+            digest = manifest['leaves'][idx]
+            self.refs[digest] -= 1
+            if self.refs[digest]: continue
+            del self.refs[digest]
+            data = self.unreferenced[digest] = self.pieces.pop(digest)
+            self.cached_bytes += len(data)
+        while self.cached_bytes > self.cache_limit and self.unreferenced:
+            _, data = self.unreferenced.popitem(last=False)
+            self.cached_bytes -= len(data)
+
+    def stats(self):
+        held = sum(len(b) for b in self.pieces.values())
+        logical = sum(len(self.pieces[d]) * n for d, n in self.refs.items())
+        return {
+            "pieces": len(self.pieces), "bytes": held,
+            "bytes_saved": logical - held, "cached_bytes": self.cached_bytes
+        }
+
+class FileChunkStore:
+    """
+    One preallocated file per torrent under `directory`; chunk i lives at
+    offset i * chunk_size. Reads are memoryview slices of an mmap, so serving
+    a chunk does not copy it and the file never has to fit in RAM.
+    """
+    def __init__(self, directory, chunk_size):
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.files = {}  # f_hash -> {path, fh, mm, size, have}
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, f_hash):
+        return os.path.join(self.directory, f_hash)
+
+    def create(self, f_hash, size, total, leaves=None):
+        if f_hash in self.files: return
+        path = self.path(f_hash)
+        fh = open(path, 'r+b' if os.path.exists(path) else 'w+b')
+        fh.truncate(size)  # Sparse preallocation
+        mm = mmap.mmap(fh.fileno(), size) if size else None
+        self.files[f_hash] = {"path": path, "fh": fh, "mm": mm, "size": size, "have": set()}
+
+    def put(self, f_hash, idx, data):
+        entry = self.files[f_hash]
+        start = idx * self.chunk_size
+        if start + len(data) > entry['size']:
+            raise ValueError(f"Chunk {idx} of {f_hash} overruns the preallocated file")
+        entry['mm'][start:start + len(data)] = data
+        entry['have'].add(idx)
+
+    def get(self, f_hash, idx):
+        entry = self.files.get(f_hash)
+        if entry is None or idx not in entry['have']: return None
+        start = idx * self.chunk_size
+        return memoryview(entry['mm'])[start:min(start + self.chunk_size, entry['size'])]
+
+    def has(self, f_hash, idx):
+        entry = self.files.get(f_hash)
+        return entry is not None and idx in entry['have']
+
+    def indices(self, f_hash):
+        entry = self.files.get(f_hash)
+        return list(entry['have']) if entry else []
+
+    def count(self, f_hash):
+        entry = self.files.get(f_hash)
+        return len(entry['have']) if entry else 0
+
+    def adopt(self, f_hash, indices, verify=None):
+        """
+        Marks chunks already present in a preexisting file (after a restart).
+        With `verify(idx, view)`, only chunks that pass are kept. Returns them.
+        """
+        entry = self.files[f_hash]
+        adopted = []
+        for idx in indices:
+            start = idx * self.chunk_size
+            if not 0 <= start < entry['size']: continue
+            view = memoryview(entry['mm'])[start:min(start + self.chunk_size, entry['size'])]
+            try:
+                if verify is None or verify(idx, view):
+                    entry['have'].add(idx)
+                    adopted.append(idx)
+            finally:
+                view.release()
+        return adopted
+
+    def finalize(self, f_hash):
+        """Flushes a completed file to disk."""
+        entry = self.files[f_hash]
+        if entry['mm']: entry['mm'].flush()
+
+    def open(self, f_hash):
+        return open(self.files[f_hash]['path'], 'rb')
+
+    def remove(self, f_hash, delete=False):
+        """Closes a file; with `delete`, its backing file is removed from disk too."""
+        entry = self.files.pop(f_hash, None)
+        if not entry: return
+        try:
+            if entry['mm']: entry['mm'].close()
+        except BufferError:
+            pass  # A chunk view is still being sent; the map is freed with it
+        entry['fh'].close()
+        if delete:
+            try:
+                os.remove(entry['path'])
+            except OSError:
+                pass
@@ -1,135 +1,663 @@
-import hashlib
+import io
+import json
+import base64
 import math
+import os
 import threading
+import time
+from collections import OrderedDict
+from modules.chunk_scheduler import ChunkScheduler, CHUNK_WINDOW
+from modules.chunk_store import PieceStore, FileChunkStore
+from modules.merkle import MerkleVerifier, leaf_hash, file_id, pack_leaves, unpack_leaves
+from modules.bitfield import Bitfield
 
 CHUNK_SIZE = 64 * 1024
+# Files up to this size go to the in-memory piece store; larger ones to mmap-backed files
+MEMORY_STORE_LIMIT = 8 * 1024 * 1024
+# Holders that send this many corrupt chunks are dropped from the download
+MAX_BAD_CHUNKS = 3
+# Download state is written to <download_dir>/<hash>.state at most this often
+CHECKPOINT_INTERVAL = 2
+# A download with no known holders re-asks who_has this often (e.g. after a restart)
+WHO_HAS_RETRY = 10
+# Peer-supplied have_range runs beyond this many are ignored
+MAX_HAVE_RANGES = 1024
+# Askers remembered per download for have_piece/have_range (least recent dropped)
+MAX_INTERESTED = 64
+# Merkle leaves travel in runs of this many digests (1 MB), fetched with get_leaves
+LEAVES_PER_MESSAGE = 32768
+
+def check_dimensions(size, total):
+    """
+    Raises ValueError unless `size` bytes make exactly `total` chunks. `size`
+    sets the preallocated file and mmap length, so it must never exceed
+    total * CHUNK_SIZE (the leaves, and through them the file id, bound `total`).
+    """
+    if not (isinstance(size, int) and isinstance(total, int)) or isinstance(size, bool) \
+            or size < 0 or total != -(-size // CHUNK_SIZE):
+        raise ValueError(f"size {size!r} does not match {total!r} chunks")
+
+def range_indices(ranges, total):
+    """
+    Chunk indices covered by a peer's [start, end) runs, clamped to [0, total).
+    Runs are merged first, so overlapping or repeated runs cost nothing extra.
+    Returns None if `ranges` is malformed.
+    """
+    if not isinstance(ranges, list): return None
+    runs = []
+    for run in ranges[:MAX_HAVE_RANGES]:
+        if not (isinstance(run, (list, tuple)) and len(run) == 2
+                and all(isinstance(b, int) and not isinstance(b, bool) for b in run)):
+            return None
+        start, end = max(run[0], 0), min(run[1], total)
+        if start < end: runs.append((start, end))
+    indices, covered = [], 0
+    for start, end in sorted(runs):
+        start = max(start, covered)
+        indices.extend(range(start, end))
+        covered = max(covered, end)
+    return indices
 
 class TorrentModule:
-    def __init__(self, node):
+    def __init__(self, node, window=CHUNK_WINDOW, seed_dir="data/torrents", download_dir="data/received"):
         self.node = node
-        self.chunks = {}  
+        self.window = window
+        self.piece_store = PieceStore(CHUNK_SIZE)
+        self.seed_store = FileChunkStore(seed_dir, CHUNK_SIZE)
+        self.download_store = FileChunkStore(download_dir, CHUNK_SIZE)
+        self.stores = {}  # f_hash -> the store holding its chunks
+        self.piece_index = {}  # digest -> (f_hash, idx) of a verified chunk in a file store
+        self.stats = {"chunks_reused": 0, "chunks_downloaded": 0}
         self.files = {}   
         self.pending = {} 
+        self.download_dir = download_dir
+        self.interested = {}  # f_hash -> OrderedDict of fingerprints that asked who_has (pending downloads only)
+        self.announce = {}    # f_hash -> chunk indices gained since the last have_piece/have_range
         self.lock = threading.Lock()
+        # Re-requests timed-out chunks and checkpoints every active download
+        threading.Thread(target=self._watchdog, daemon=True).start()
+        # Picks up downloads interrupted by a restart
+        threading.Thread(target=self._resume_downloads, daemon=True).start()
 
     def add_file(self, filename, data):
-        f_hash = hashlib.sha256(data).hexdigest()[:16]
-        total = math.ceil(len(data) / CHUNK_SIZE)
-        
-        self.files[f_hash] = {
-            "name": filename, 
-            "size": len(data), 
-            "total": total, 
-            "owner_fp": self.node.pub_key.decode('utf-8')
-        }
-        
-        self.chunks[f_hash] = {}
-        for i in range(total):
-            start = i * CHUNK_SIZE
-            self.chunks[f_hash][i] = data[start:start + CHUNK_SIZE]
+        """
+        Seeds `data` (bytes or a seekable binary file object). The source is
+        read CHUNK_SIZE at a time, once to hash and once to store, so large
+        files never need to be held in memory.
+        The file id commits to the size and the Merkle root over per-chunk SHA-256 leaves.
+        """
+        source = io.BytesIO(data) if isinstance(data, (bytes, bytearray, memoryview)) else data
+        source.seek(0, os.SEEK_END)
+        size = source.tell()
+
+        source.seek(0)
+        leaves = [leaf_hash(block) for block in iter(lambda: source.read(CHUNK_SIZE), b"")]
+        f_hash = file_id(leaves, size)
+        total = math.ceil(size / CHUNK_SIZE)
+
+        with self.lock:
+            store = self._open_store(f_hash, size, total, leaves, seeding=True)
+            source.seek(0)
+            for i in range(total):
+                block = source.read(CHUNK_SIZE)
+                store.put(f_hash, i, block)  # Piece store: no-op for pieces it already holds
+            store.finalize(f_hash)
+            self._index_pieces(f_hash, leaves, range(total))
+
+            self.files[f_hash] = {
+                "name": filename, 
+                "size": size, 
+                "total": total, 
+                "leaves": leaves,
+                "owner_fp": self.node.fingerprint
+            }
+        self.node.dht.announce(f_hash)
         return f_hash
 
+    def _open_store(self, f_hash, size, total, leaves, seeding):
+        # NOTE: Must be called while self.lock is held
+        if f_hash not in self.stores:
+            check_dimensions(size, total)
+            if size <= MEMORY_STORE_LIMIT:
+                store = self.piece_store
+            else:
+                store = self.seed_store if seeding else self.download_store
+            store.create(f_hash, size, total, leaves)
+            self.stores[f_hash] = store
+        return self.stores[f_hash]
+
+    def _index_pieces(self, f_hash, leaves, indices):
+        """
+        Records where file-store chunks live by digest, so other files can reuse them.
+        (Piece-store chunks are already addressed by digest.)
+        NOTE: Must be called while self.lock is held
+        """
+        if self.stores[f_hash] is self.piece_store: return
+        for idx in indices:
+            self.piece_index.setdefault(leaves[idx], (f_hash, idx))
+
+    def _reuse_local_pieces(self, f_hash, leaves):
+        """
+        Fills a new download with chunks already held under other files, by
+        digest, so only genuinely new content is requested. Returns how many.
+        NOTE: Must be called while self.lock is held
+        """
+        store = self.stores[f_hash]
+        reused = []
+        for idx, digest in enumerate(leaves):
+            if store.has(f_hash, idx): continue
+            data = self.piece_store.lookup(digest)
+            if data is None and digest in self.piece_index:
+                src_hash, src_idx = self.piece_index[digest]
+                data = self.stores[src_hash].get(src_hash, src_idx)
+            if data is None: continue
+            store.put(f_hash, idx, data)
+            reused.append(idx)
+        self._index_pieces(f_hash, leaves, reused)
+        self.stats["chunks_reused"] += len(reused)
+        return len(reused)
+
+    def remove_file(self, f_hash):
+        """
+        Stops seeding (or downloading) a file and frees its storage: piece-store
+        chunks lose a reference (unshared ones move to its LRU cache), a file
+        store's backing file and any download state are deleted.
+        """
+        with self.lock:
+            meta = self.files.pop(f_hash, None)
+            entry = self.pending.pop(f_hash, None)
+            store = self.stores.pop(f_hash, None)
+            self.interested.pop(f_hash, None)
+            self.announce.pop(f_hash, None)
+            if store is None: return
+            if store is self.piece_store:
+                store.remove(f_hash)
+            else:
+                store.remove(f_hash, delete=True)
+                # Re-point reuse entries at another copy of the same content, if one is held
+                lost = {d for d, (src, _) in self.piece_index.items() if src == f_hash}
+                for digest in lost:
+                    del self.piece_index[digest]
+                for other, other_store in self.stores.items():
+                    if other_store is self.piece_store or not lost: continue
+                    leaves = self._leaves(other)
+                    held = [i for i in other_store.indices(other) if leaves[i] in lost]
+                    self._index_pieces(other, leaves, held)
+                    lost.difference_update(leaves[i] for i in held)
+        self.node.dht.withdraw(f_hash)
+        for path in (self._state_path(f_hash), os.path.join(self.download_dir, f"{f_hash}.leaves")):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        print(f"[TORRENT] Removed {(meta or {}).get('name', f_hash)}" + (" (download cancelled)" if entry else ""))
+
+    def _leaves(self, f_hash):
+        # NOTE: Must be called while self.lock is held
+        meta = self.files.get(f_hash)
+        if meta: return meta['leaves']
+        return self.pending[f_hash]['verifier'].leaves
+
+    def has_chunk(self, f_hash, idx):
+        store = self.stores.get(f_hash)
+        return store is not None and store.has(f_hash, idx)
+
+    def chunk_count(self, f_hash):
+        store = self.stores.get(f_hash)
+        return store.count(f_hash) if store else 0
+
+    def open_file(self, f_hash):
+        """Readable file object over a complete file (for saving to disk)."""
+        return self.stores[f_hash].open(f_hash)
+
     def request_file(self, f_hash):
-        my_fp = self.node.pub_key.decode('utf-8')
         with self.lock:
+            if f_hash in self.files: return
             if f_hash not in self.pending:
-                self.pending[f_hash] = {"needed": set(), "total": None, "peers": {}}
+                self.pending[f_hash] = self._new_entry()
+            entry = self.pending[f_hash]
+            entry['asked'] = time.time()
+            holders = list(entry['holders'])
+        self._ask_holders(f_hash, holders)
+
+    def _new_entry(self):
+        return {
+            "scheduler": None, "verifier": None, "total": None, "size": None, "bad": {},
+            "holders": set(), "asked": 0, "dirty": False, "saved": 0, "announced": False,
+            "meta": None  # Leaves being fetched before the download can start (see _add_leaves)
+        }
+
+    def _ask_holders(self, f_hash, known_fps=()):
+        """Sends who_has to the file's providers, located through the DHT (in the background)."""
+        threading.Thread(target=self._locate_holders, args=(f_hash, list(known_fps)), daemon=True).start()
 
-        for peer_id in list(self.node.peers.keys()):
+    def _locate_holders(self, f_hash, known_fps):
+        # Holders remembered from before a restart are asked first
+        targets = list(known_fps)
+        targets += [c['fp'] for c in self.node.dht.find_providers(f_hash) if c['fp'] not in targets]
+        with self.lock:
+            entry = self.pending.get(f_hash)
+            # Holders send leaves only until we have them; after that a have is just a bitfield
+            need_leaves = entry is not None and entry['total'] is None
+        for fp in targets:
+            peer_id = self.node.find_peer_by_fp(fp)
+            if not peer_id: continue
             self.node.send_onion_to_peer(peer_id, "torrent", {
                 "action": "who_has",
                 "hash": f_hash,
-                "origin_fp": my_fp
+                "origin_fp": self.node.fingerprint,
+                "need_leaves": need_leaves
             })
 
-    def receive(self, payload):
+    # --- Download checkpoints ---
+    def _state_path(self, f_hash):
+        return os.path.join(self.download_dir, f"{f_hash}.state")
+
+    def _checkpoint(self, f_hash, entry, complete=False):
+        """
+        Writes a download's metadata, known holders and have-bitmap.
+        The Merkle leaves go to a .leaves sidecar once; the state file stays small.
+        NOTE: Must be called while self.lock is held
+        """
+        state = {
+            "hash": f_hash,
+            "size": entry['size'],
+            "total": entry['total'],
+            "holders": sorted(entry['holders']),
+            "have": base64.b64encode(
+                Bitfield.from_indices(entry['total'], self.stores[f_hash].indices(f_hash)).to_bytes()
+            ).decode('utf-8'),
+            "complete": complete
+        }
+        path = self._state_path(f_hash)
+        try:
+            os.makedirs(self.download_dir, exist_ok=True)
+            leaves_path = os.path.join(self.download_dir, f"{f_hash}.leaves")
+            if not os.path.exists(leaves_path):
+                with open(leaves_path + ".tmp", 'wb') as f:
+                    f.write(pack_leaves(entry['verifier'].leaves))
+                os.replace(leaves_path + ".tmp", leaves_path)
+            with open(path + ".tmp", 'w') as f:
+                json.dump(state, f)
+            os.replace(path + ".tmp", path)  # Atomic: a crash never leaves half a state file
+            entry['dirty'] = False
+            entry['saved'] = time.time()
+        except OSError as e:
+            print(f"[TORRENT] Failed to checkpoint {f_hash}: {e}")
+
+    def _resume_downloads(self):
+        """
+        Rebuilds downloads from their state files. Partial files are rehashed
+        chunk by chunk against the Merkle leaves (the bitmap may lag the file
+        by up to CHECKPOINT_INTERVAL), so only missing or torn chunks are fetched again.
+        """
+        if not os.path.isdir(self.download_dir): return
+        for name in sorted(os.listdir(self.download_dir)):
+            if not name.endswith(".state"): continue
+            try:
+                with open(os.path.join(self.download_dir, name)) as f:
+                    state = json.load(f)
+                f_hash, total, size = state['hash'], state['total'], state['size']
+                check_dimensions(size, total)
+                with open(os.path.join(self.download_dir, f"{f_hash}.leaves"), 'rb') as f:
+                    verifier = MerkleVerifier(f_hash, unpack_leaves(f.read(), total) or [], size)
+            except (OSError, ValueError, KeyError) as e:
+                print(f"[TORRENT] Skipping unreadable download state {name}: {e}")
+                continue
+
+            with self.lock:
+                if f_hash in self.files or f_hash in self.pending: continue
+                store = self._open_store(f_hash, size, total, verifier.leaves, seeding=False)
+
+            if state.get('complete'):
+                # Finished before the restart: trust the bitmap and seed it again
+                have = Bitfield(total, base64.b64decode(state['have']))
+                held = store.adopt(f_hash, have.indices())
+            else:
+                held = store.adopt(f_hash, range(total), verify=verifier.verify)
+
+            with self.lock:
+                self._index_pieces(f_hash, verifier.leaves, held)
+                if len(held) < total:
+                    self._reuse_local_pieces(f_hash, verifier.leaves)
+                    held = store.indices(f_hash)
+                if len(held) == total:
+                    store.finalize(f_hash)
+                    self.files[f_hash] = {
+                        "name": f"Downloaded_{f_hash}", "size": size, "total": total,
+                        "leaves": verifier.leaves
+                    }
+                    self.node.dht.announce(f_hash)
+                    continue
+                entry = self.pending[f_hash] = self._new_entry()
+                entry.update({
+                    "verifier": verifier, "total": total, "size": size, "asked": time.time(),
+                    "scheduler": ChunkScheduler(total, window=self.window, held=held),
+                    "holders": set(state.get('holders', []))
+                })
+                holders = list(entry['holders'])
+            print(f"[TORRENT] Resuming {f_hash}: {len(held)}/{total} chunks already on disk")
+            if held:
+                entry['announced'] = True
+                self.node.dht.announce(f_hash)
+            self._ask_holders(f_hash, holders)
+
+    def receive(self, payload, reply=None):
+        # Answers (have, chunk) go back along the request's circuit when it came with one
         action = payload.get("action")
-        my_fp = self.node.pub_key.decode('utf-8')
+        my_fp = self.node.fingerprint
 
         if action == "who_has":
             req_hash = payload.get('hash')
             origin_fp = payload.get('origin_fp')
-            if req_hash in self.chunks:
-                indices = list(self.chunks[req_hash].keys())
-                total = self.files[req_hash]['total']
-                target_peer_id = self._find_peer_by_key(origin_fp)
-                if target_peer_id:
-                    self.node.send_onion_to_peer(target_peer_id, "torrent", {
-                        "action": "have", "hash": req_hash, 
-                        "indices": indices, "total": total, "holder_fp": my_fp
-                    })
+            with self.lock:
+                # Partial downloads answer too; later chunks follow as have_piece/have_range
+                meta = self.files.get(req_hash) or self.pending.get(req_hash)
+                if not meta or not isinstance(origin_fp, str): return
+                if req_hash in self.pending:
+                    askers = self.interested.setdefault(req_hash, OrderedDict())
+                    askers[origin_fp] = True
+                    askers.move_to_end(origin_fp)
+                    if len(askers) > MAX_INTERESTED:
+                        askers.popitem(last=False)
+                if meta['total'] is None: return
+                field = Bitfield.from_indices(meta['total'], self.stores[req_hash].indices(req_hash))
+                msg = {
+                    "action": "have", "hash": req_hash,
+                    "bitfield": field.compressed(), "total": meta['total'], "size": meta['size'],
+                    "holder_fp": my_fp
+                }
+                if payload.get('need_leaves') is True:
+                    # The first run rides along; the rest is fetched with get_leaves
+                    msg["leaves"] = pack_leaves(self._leaves(req_hash)[:LEAVES_PER_MESSAGE])
+            if field.count() == 0: return
+            self.node.send_reply(reply, origin_fp, "torrent", msg)
+
+        elif action == "get_leaves":
+            f_hash = payload.get('hash')
+            start = payload.get('start')
+            with self.lock:
+                meta = self.files.get(f_hash) or self.pending.get(f_hash)
+                if not meta or meta['total'] is None: return
+                if not (isinstance(start, int) and not isinstance(start, bool) and 0 <= start < meta['total']): return
+                leaves = self._leaves(f_hash)[start:start + LEAVES_PER_MESSAGE]
+            self.node.send_reply(reply, payload.get('origin_fp'), "torrent", {
+                "action": "leaves", "hash": f_hash, "start": start,
+                "leaves": pack_leaves(leaves), "holder_fp": my_fp
+            })
+
+        elif action == "leaves":
+            f_hash = payload.get('hash')
+            with self.lock:
+                entry = self.pending.get(f_hash)
+                if not entry or not entry['meta'] or entry['meta']['holder'] != payload.get('holder_fp'): return
+                more, requests = self._add_leaves(f_hash, entry, payload.get('start'), payload.get('leaves'))
+            self._fetch_leaves(f_hash, more)
+            self._send_requests(f_hash, requests)
 
         elif action == "have":
             f_hash = payload.get('hash')
-            indices = payload.get('indices', [])
             total = payload.get('total')
+            size = payload.get('size')
             holder_fp = payload.get('holder_fp')
 
+            holder_peer_id = self.node.find_peer_by_fp(holder_fp)
+            if not holder_peer_id: return
+            try:
+                check_dimensions(size, total)
+            except ValueError as e:
+                print(f"[TORRENT] Ignoring have for {f_hash} from {holder_fp[:8]}: {e}")
+                return
+            try:
+                pieces = Bitfield.from_compressed(total, payload.get('bitfield') or b"")
+            except (ValueError, TypeError) as e:
+                print(f"[TORRENT] Ignoring have for {f_hash} from {holder_fp[:8]}: {e}")
+                return
+
+            more = None
             with self.lock:
                 if f_hash not in self.pending: return
                 entry = self.pending[f_hash]
+                if entry['total'] not in (None, total): return
                 if entry['total'] is None:
-                    entry['total'] = total
-                    entry['needed'] = set(range(total))
-                
-                holder_peer_id = self._find_peer_by_key(holder_fp)
-                if holder_peer_id:
-                    entry['peers'][holder_peer_id] = set(indices)
-                    # Keep lock held while calling _request_next_chunk to prevent race conditions
-                    self._request_next_chunk(f_hash)
+                    # Leaves come from one holder at a time; other holders wait until they check out
+                    meta = entry['meta']
+                    if meta is None or time.time() - meta['updated'] >= WHO_HAS_RETRY:
+                        meta = entry['meta'] = {
+                            "holder": holder_fp, "total": total, "size": size,
+                            "leaves": [], "peers": {}, "updated": time.time()
+                        }
+                        more = 0
+                    if (meta['total'], meta['size']) != (total, size): return
+                    meta['peers'][holder_peer_id] = (holder_fp, pieces)
+                    if holder_fp != meta['holder'] or 'leaves' not in payload:
+                        requests = []
+                    else:
+                        more, requests = self._add_leaves(f_hash, entry, 0, payload['leaves'])
+                else:
+                    self._add_holder(f_hash, entry, holder_fp, holder_peer_id, pieces)
+                    requests = entry['scheduler'].next_requests()
+            self._fetch_leaves(f_hash, more)
+            self._send_requests(f_hash, requests)
+
+        elif action in ("have_piece", "have_range"):
+            # A holder gained chunks after its have (it is downloading too)
+            f_hash = payload.get('hash')
+            holder_peer_id = self.node.find_peer_by_fp(payload.get('holder_fp'))
+            if not holder_peer_id: return
+
+            with self.lock:
+                entry = self.pending.get(f_hash)
+                if not entry or entry['scheduler'] is None: return
+                if action == "have_piece":
+                    idx = payload.get('index')
+                    indices = range_indices([[idx, idx + 1]], entry['total']) \
+                        if isinstance(idx, int) and not isinstance(idx, bool) else None
+                else:
+                    indices = range_indices(payload.get('ranges'), entry['total'])
+                if indices is None:
+                    print(f"[TORRENT] Ignoring malformed {action} for {f_hash} from {holder_peer_id}")
+                    return
+                entry['scheduler'].add_peer(holder_peer_id, indices)
+                requests = entry['scheduler'].next_requests()
+            self._send_requests(f_hash, requests)
 
         elif action == "get_chunk":
             f_hash = payload.get('hash')
             idx = payload.get('index')
             origin_fp = payload.get('origin_fp')
-            if f_hash in self.chunks and idx in self.chunks[f_hash]:
-                target_peer_id = self._find_peer_by_key(origin_fp)
-                if target_peer_id:
-                    self.node.send_onion_to_peer(target_peer_id, "torrent", {
-                        "action": "chunk", "hash": f_hash, "index": idx,
-                        "data": self.chunks[f_hash][idx], "holder_fp": my_fp
-                    })
+            if self.has_chunk(f_hash, idx):
+                self.node.send_reply(reply, origin_fp, "torrent", {
+                    "action": "chunk", "hash": f_hash, "index": idx,
+                    "data": self.stores[f_hash].get(f_hash, idx), "holder_fp": my_fp
+                }, paths=self.node.multipath)
 
         elif action == "chunk":
             f_hash = payload.get('hash')
             idx = payload.get('index')
             data = payload.get('data')
+            holder_peer_id = self.node.find_peer_by_fp(payload.get('holder_fp'))
+
+            with self.lock:
+                entry = self.pending.get(f_hash)
+                verifier = entry and entry['verifier']
+            if verifier is None: return
+            # Hash outside the lock; a 64 KB SHA-256 should not stall other downloads
+            valid = isinstance(data, (bytes, bytearray)) and verifier.verify(idx, data)
 
             with self.lock:
                 if f_hash not in self.pending: return
                 entry = self.pending[f_hash]
-                self.chunks.setdefault(f_hash, {})[idx] = data
-                
-                # CRITICAL: Mark chunk as received
-                entry['needed'].discard(idx)
+                scheduler = entry['scheduler']
 
-                if not entry['needed']:
-                    self.files[f_hash] = {
-                        "name": f"Downloaded_{f_hash}", 
-                        "size": sum(len(v) for v in self.chunks[f_hash].values()), 
-                        "total": entry['total']
-                    }
-                    del self.pending[f_hash]
+                if not valid:
+                    # Re-request right away, from another holder if there is one
+                    print(f"[TORRENT] Chunk {idx} of {f_hash} from {holder_peer_id} failed verification")
+                    scheduler.rejected(idx, holder_peer_id)
+                    entry['bad'][holder_peer_id] = entry['bad'].get(holder_peer_id, 0) + 1
+                    if entry['bad'][holder_peer_id] >= MAX_BAD_CHUNKS:
+                        scheduler.remove_peer(holder_peer_id)
                 else:
-                    self._request_next_chunk(f_hash)
-
-    def _request_next_chunk(self, f_hash):
-        # NOTE: This method must be called while self.lock is held
-        # to prevent race conditions when accessing shared state
-        entry = self.pending[f_hash]
-        if not entry['needed']: return
-        next_idx = sorted(list(entry['needed']))[0]
-        for p_id, p_indices in entry['peers'].items():
-            if next_idx in p_indices:
-                self.node.send_onion_to_peer(p_id, "torrent", {
-                    "action": "get_chunk", "hash": f_hash, 
-                    "index": next_idx, "origin_fp": self.node.pub_key.decode('utf-8')
-                })
-                break
-
-    def _find_peer_by_key(self, target_pub_key_str):
-        for pid, meta in self.node.peers.items():
-            p_key = meta.get('pub_key')
-            if isinstance(p_key, bytes): p_key = p_key.decode('utf-8')
-            if p_key == target_pub_key_str: return pid
-        return None
\ No newline at end of file
+                    # CRITICAL: Mark chunk as received (endgame duplicates are dropped)
+                    if not scheduler.received(idx): return
+                    store = self.stores[f_hash]
+                    store.put(f_hash, idx, data)
+                    self._index_pieces(f_hash, entry['verifier'].leaves, [idx])
+                    self.stats["chunks_downloaded"] += 1
+                    entry['dirty'] = True
+                    if not entry['announced']:
+                        # Partial holders serve too; become findable from the first chunk
+                        entry['announced'] = True
+                        self.node.dht.announce(f_hash)
+                    if self.interested.get(f_hash):
+                        self.announce.setdefault(f_hash, set()).add(idx)
+
+                    if scheduler.done:
+                        self._complete(f_hash, entry, store)
+                        return
+                requests = scheduler.next_requests()
+            self._send_requests(f_hash, requests)
+
+    def _add_leaves(self, f_hash, entry, start, blob):
+        """
+        Appends a run of leaves to a download's metadata fetch. Once all have
+        arrived they must hash up to the file id before the download starts.
+        Returns (start of the next run to fetch or None, chunk requests).
+        """
+        # NOTE: Must be called while self.lock is held
+        meta = entry['meta']
+        if start != len(meta['leaves']): return None, []
+        leaves = unpack_leaves(blob, min(LEAVES_PER_MESSAGE, meta['total'] - start))
+        if leaves is None: return None, []
+        meta['leaves'] += leaves
+        meta['updated'] = time.time()
+        if len(meta['leaves']) < meta['total']: return len(meta['leaves']), []
+
+        entry['meta'] = None
+        total, size, leaves = meta['total'], meta['size'], meta['leaves']
+        # 1. Only trust metadata whose leaves hash up to the id we asked for
+        try:
+            entry['verifier'] = MerkleVerifier(f_hash, leaves, size)
+        except ValueError:
+            print(f"[TORRENT] Ignoring {f_hash} metadata from {meta['holder'][:8]}: bad Merkle leaves")
+            return None, []
+        entry['total'] = total
+        entry['size'] = size
+        store = self._open_store(f_hash, size, total, leaves, seeding=False)
+        # 2. Chunks we already hold under other files are copied, not fetched
+        if self._reuse_local_pieces(f_hash, leaves) == total:
+            self._complete(f_hash, entry, store)
+            return None, []
+        entry['scheduler'] = ChunkScheduler(total, window=self.window, held=store.indices(f_hash))
+        entry['dirty'] = True
+        for peer_id, (holder_fp, pieces) in meta['peers'].items():
+            self._add_holder(f_hash, entry, holder_fp, peer_id, pieces)
+        return None, entry['scheduler'].next_requests()
+
+    def _add_holder(self, f_hash, entry, holder_fp, holder_peer_id, pieces):
+        # NOTE: Must be called while self.lock is held
+        if holder_fp not in entry['holders']:
+            entry['holders'].add(holder_fp)
+            entry['dirty'] = True
+        if entry['saved'] == 0:
+            self._checkpoint(f_hash, entry)
+        entry['scheduler'].add_peer(holder_peer_id, pieces)
+
+    def _fetch_leaves(self, f_hash, start):
+        if start is None: return
+        with self.lock:
+            entry = self.pending.get(f_hash)
+            meta = entry and entry['meta']
+            if not meta: return
+            peer_id = self.node.find_peer_by_fp(meta['holder'])
+        if peer_id:
+            self.node.send_onion_to_peer(peer_id, "torrent", {
+                "action": "get_leaves", "hash": f_hash, "start": start,
+                "origin_fp": self.node.fingerprint
+            })
+
+    def _complete(self, f_hash, entry, store):
+        # NOTE: Must be called while self.lock is held
+        store.finalize(f_hash)
+        self.files[f_hash] = {
+            "name": f"Downloaded_{f_hash}", 
+            "size": entry['size'], 
+            "total": entry['total'],
+            "leaves": entry['verifier'].leaves
+        }
+        del self.pending[f_hash]
+        if not entry['announced']:
+            self.node.dht.announce(f_hash)
+        if store is self.piece_store:
+            # Nothing on disk to seed from after a restart
+            for path in (self._state_path(f_hash), os.path.join(self.download_dir, f"{f_hash}.leaves")):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        else:
+            self._checkpoint(f_hash, entry, complete=True)
+
+    def _flush_announcements(self):
+        """
+        Tells peers that asked who_has about chunks gained since the last flush.
+        Coalesced once a second: a lone chunk goes out as have_piece, anything
+        else as one have_range with [start, end) runs.
+        """
+        with self.lock:
+            batch, self.announce = self.announce, {}
+            targets = {f_hash: list(self.interested.get(f_hash, ())) for f_hash in batch}
+            # Finished downloads announce nothing more; forget who asked about them
+            for f_hash in [h for h in self.interested if h not in self.pending]:
+                del self.interested[f_hash]
+
+        for f_hash, indices in batch.items():
+            if len(indices) == 1:
+                msg = {"action": "have_piece", "hash": f_hash, "index": next(iter(indices))}
+            else:
+                ranges = []
+                for idx in sorted(indices):
+                    if ranges and ranges[-1][1] == idx:
+                        ranges[-1][1] = idx + 1
+                    else:
+                        ranges.append([idx, idx + 1])
+                msg = {"action": "have_range", "hash": f_hash, "ranges": ranges}
+            msg["holder_fp"] = self.node.fingerprint
+            for fp in targets[f_hash]:
+                peer_id = self.node.find_peer_by_fp(fp)
+                if peer_id:
+                    self.node.send_onion_to_peer(peer_id, "torrent", msg)
+
+    def _send_requests(self, f_hash, requests):
+        # Scheduler state is updated under self.lock; the sends happen outside it.
+        # Chunks come back along the circuit of their request, so spreading the
+        # requests across node.multipath circuits spreads the chunks too
+        for idx, peer_id in requests:
+            self.node.send_onion_to_peer(peer_id, "torrent", {
+                "action": "get_chunk", "hash": f_hash, 
+                "index": idx, "origin_fp": self.node.fingerprint
+            }, paths=self.node.multipath)
+
+    def _watchdog(self):
+        while True:
+            time.sleep(1)
+            due, lost = [], []
+            now = time.time()
+            with self.lock:
+                for f_hash, entry in self.pending.items():
+                    scheduler = entry['scheduler']
+                    fetching = entry['meta'] and now - entry['meta']['updated'] < WHO_HAS_RETRY
+                    if (scheduler is None or not scheduler.peer_pieces) and not fetching \
+                            and now - entry['asked'] >= WHO_HAS_RETRY:
+                        entry['asked'] = now
+                        lost.append((f_hash, list(entry['holders'])))
+                    if scheduler is None: continue
+                    scheduler.expire()
+                    due.append((f_hash, scheduler.next_requests()))
+                    if entry['dirty'] and now - entry['saved'] >= CHECKPOINT_INTERVAL:
+                        self._checkpoint(f_hash, entry)
+            for f_hash, requests in due:
+                self._send_requests(f_hash, requests)
+            for f_hash, holders in lost:
+                self._ask_holders(f_hash, holders)
+            self._flush_announcements()
\ No newline at end of file
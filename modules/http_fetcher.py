@@ -0,0 +1,318 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from http.cookiejar import DefaultCookiePolicy
+import requests
+from requests.adapters import HTTPAdapter
+
+FETCH_WORKERS = 8          # Upstream fetches (and their streams back) running at once
+MAX_QUEUED = 64            # Requests waiting for a worker; more are refused
+FETCH_TIMEOUT = 5          # Connect / read timeout per upstream request
+FETCH_CHUNK = 64 * 1024    # Body is read and streamed back in pieces of this size
+POOL_HOSTS = 32            # Upstream hosts with pooled keep-alive connections
+
+# Shared response cache (the exit serves many clients, so `private` is never stored)
+CACHE_BYTES = 32 * 1024 * 1024
+CACHE_MAX_ENTRY = 2 * 1024 * 1024
+CACHEABLE_STATUS = {200, 203, 204, 300, 301, 404, 410}
+# Headers passed back to the requester
+FORWARDED_HEADERS = ("Content-Type", "Cache-Control", "ETag", "Last-Modified", "Expires")
+
+# A request for a URL already being fetched joins that fetch while its body
+# so far is at most SHARE_MAX_BYTES; a joiner may lag the fastest reader by
+# SHARE_MAX_LAG bytes before the fetch waits for it (and drops it after FETCH_TIMEOUT)
+SHARE_MAX_BYTES = CACHE_MAX_ENTRY
+SHARE_MAX_LAG = 4 * 1024 * 1024
+SHARE_READ_TIMEOUT = 30   # A follower gives up if the shared fetch publishes nothing for this long
+
+def cache_lifetime(status, headers, now=None):
+    """Seconds a response may be served from a shared cache; 0 if it must not be stored."""
+    if status not in CACHEABLE_STATUS: return 0
+    directives = {}
+    for part in headers.get("Cache-Control", "").split(","):
+        name, _, value = part.strip().partition("=")
+        if name: directives[name.lower()] = value.strip('"')
+    if {"no-store", "no-cache", "private"} & directives.keys() or headers.get("Vary", "").strip() == "*":
+        return 0
+    try:
+        age = int(headers.get("Age", 0))
+    except ValueError:
+        age = 0
+    for name in ("s-maxage", "max-age"):
+        if name in directives:
+            try:
+                return max(0, int(directives[name]) - age)
+            except ValueError:
+                return 0
+    if "Expires" in headers:
+        try:
+            expires = parsedate_to_datetime(headers["Expires"]).timestamp()
+            date = parsedate_to_datetime(headers["Date"]).timestamp() if "Date" in headers else (now or time.time())
+            return max(0, int(expires - date))
+        except (TypeError, ValueError):
+            return 0
+    return 0  # No explicit freshness: not cached
+
+class ResponseCache:
+    """LRU of complete response bodies, bounded in bytes, each with its own expiry."""
+    def __init__(self, max_bytes=CACHE_BYTES, max_entry=CACHE_MAX_ENTRY):
+        self.max_bytes = max_bytes
+        self.max_entry = max_entry
+        self.entries = OrderedDict()  # url -> (meta, body, expires)
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, url):
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry is None: return None
+            if entry[2] <= time.monotonic():
+                self._drop(url)
+                return None
+            self.entries.move_to_end(url)
+            return entry[0], entry[1]
+
+    def put(self, url, meta, body, lifetime):
+        if lifetime <= 0 or len(body) > self.max_entry: return
+        with self.lock:
+            if url in self.entries: self._drop(url)
+            self.entries[url] = (meta, body, time.monotonic() + lifetime)
+            self.bytes += len(body)
+            while self.bytes > self.max_bytes:
+                self._drop(next(iter(self.entries)))
+
+    def _drop(self, url):
+        # NOTE: Must be called while self.lock is held
+        _, body, _ = self.entries.pop(url)
+        self.bytes -= len(body)
+
+class _SharedFetch:
+    """
+    One upstream response being read, teed to every request that joined it.
+    The leading request publishes chunks as it streams them; followers read
+    the same chunks from here. Chunks every follower has read are dropped
+    once the body outgrows SHARE_MAX_BYTES, after which nobody new may join.
+    """
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.meta = None
+        self.chunks = []
+        self.base = 0        # Index in the body of chunks[0]
+        self.size = 0
+        self.readers = {}    # reader id -> index of its next chunk
+        self.done = False
+        self.error = None
+
+    def join(self):
+        """Registers a follower; returns its reader id, or None if the start of the body is gone."""
+        with self.cond:
+            if self.base or self.done and self.error: return None
+            rid = object()
+            self.readers[rid] = 0
+            return rid
+
+    def leave(self, rid):
+        with self.cond:
+            self.readers.pop(rid, None)
+            self.cond.notify_all()
+
+    def set_meta(self, meta):
+        with self.cond:
+            self.meta = meta
+            self.cond.notify_all()
+
+    def publish(self, chunk):
+        with self.cond:
+            self.chunks.append(chunk)
+            self.size += len(chunk)
+            self.cond.notify_all()
+            # A slow follower holds the fetch back, up to SHARE_MAX_LAG bytes
+            while self.readers and self._lag() > SHARE_MAX_LAG:
+                if not self.cond.wait(FETCH_TIMEOUT):
+                    slowest = min(self.readers, key=self.readers.get)
+                    del self.readers[slowest]
+            self._trim()
+
+    def finish(self, error=None):
+        with self.cond:
+            self.done = True
+            self.error = error
+            self.cond.notify_all()
+
+    def read(self, rid):
+        """Generator over the body for reader `rid`; raises ConnectionError if the fetch failed."""
+        try:
+            while True:
+                with self.cond:
+                    while rid in self.readers and self.readers[rid] - self.base >= len(self.chunks) \
+                            and not self.done:
+                        if not self.cond.wait(SHARE_READ_TIMEOUT):
+                            raise TimeoutError("Shared fetch stalled")
+                    if rid not in self.readers:
+                        raise ConnectionError("Fell too far behind the shared fetch")
+                    pos = self.readers[rid] - self.base
+                    if pos >= len(self.chunks):
+                        if self.error: raise ConnectionError(self.error)
+                        return
+                    chunk = self.chunks[pos]
+                    self.readers[rid] += 1
+                    self._trim()
+                    self.cond.notify_all()
+                yield chunk
+        finally:
+            with self.cond:
+                self.readers.pop(rid, None)
+                self.cond.notify_all()
+
+    def wait_meta(self):
+        with self.cond:
+            self.cond.wait_for(lambda: self.meta is not None or self.done, FETCH_TIMEOUT * 2)
+            return self.meta
+
+    def _lag(self):
+        # NOTE: Must be called while self.cond is held
+        return sum(len(c) for c in self.chunks[min(self.readers.values()) - self.base:])
+
+    def _trim(self):
+        # NOTE: Must be called while self.cond is held
+        if self.size <= SHARE_MAX_BYTES: return
+        keep = min(self.readers.values()) if self.readers else self.base + len(self.chunks)
+        if keep > self.base:
+            del self.chunks[:keep - self.base]
+            self.base = keep
+
+class ExitFetcher:
+    """
+    Exit-side HTTP engine for the proxy module.
+    - One requests.Session with pooled keep-alive connections per host and no
+      cookie jar, so requests from different clients never share cookies.
+    - A bounded worker pool; requests beyond MAX_QUEUED are refused, not queued forever.
+    - A shared LRU/TTL cache that honours Cache-Control / Expires.
+    - Identical URLs requested while a fetch is in flight share that fetch.
+    submit(url, deliver) calls deliver(meta, chunks) on a worker thread with the
+    response metadata and an iterator over the body; an upstream failure is a
+    meta with "error" and no body.
+    """
+    def __init__(self, workers=FETCH_WORKERS, cache_bytes=CACHE_BYTES):
+        self.session = requests.Session()
+        self.session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        adapter = HTTPAdapter(pool_connections=POOL_HOSTS, pool_maxsize=workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="exit-fetch")
+        self.slots = threading.BoundedSemaphore(workers + MAX_QUEUED)
+        self.cache = ResponseCache(cache_bytes)
+        self.in_flight = {}  # url -> _SharedFetch
+        self.lock = threading.Lock()
+        self.counters = {"requests": 0, "cache_hits": 0, "joined": 0, "upstream": 0, "errors": 0, "refused": 0}
+
+    def submit(self, url, deliver):
+        """Queues a fetch of `url`. Returns False (and delivers nothing) if the queue is full."""
+        if not self.slots.acquire(blocking=False):
+            self._count("refused")
+            print(f"[PROXY] Refused {url}: fetch queue full")
+            return False
+        self._count("requests")
+        self.executor.submit(self._run, url, deliver)
+        return True
+
+    def _run(self, url, deliver):
+        try:
+            cached = self.cache.get(url)
+            if cached:
+                self._count("cache_hits")
+                meta, body = cached
+                view = memoryview(body)
+                deliver(dict(meta, cached=True), (view[i:i + FETCH_CHUNK] for i in range(0, len(body), FETCH_CHUNK)))
+                return
+            with self.lock:
+                shared = self.in_flight.get(url)
+                rid = shared.join() if shared else None
+                if rid is None:
+                    shared = self.in_flight[url] = _SharedFetch()
+            if rid is not None:
+                self._count("joined")
+                meta = shared.wait_meta() or {"url": url, "status": None, "error": f"Error fetching {url}: timed out"}
+                if meta.get("error"):
+                    shared.leave(rid)
+                    deliver(dict(meta, shared=True), ())
+                else:
+                    deliver(dict(meta, shared=True), shared.read(rid))
+                return
+            self._lead(url, shared, deliver)
+        except Exception as e:
+            print(f"[PROXY] Fetch Error for {url}: {e}")
+        finally:
+            self.slots.release()
+
+    def _lead(self, url, shared, deliver):
+        """Fetches upstream and streams to our requester, publishing each chunk for followers."""
+        self._count("upstream")
+        error = None
+        try:
+            resp = self.session.get(url, timeout=FETCH_TIMEOUT, stream=True)
+        except Exception as e:
+            error = f"Error fetching {url}: {e}"
+            self._count("errors")
+            meta = {"url": url, "status": None, "error": error}
+            self._end(url, shared, meta, error)
+            deliver(meta, ())
+            return
+
+        with resp:
+            meta = {"url": url, "status": resp.status_code,
+                    "headers": {h: resp.headers[h] for h in FORWARDED_HEADERS if h in resp.headers}}
+            shared.set_meta(meta)
+            lifetime = cache_lifetime(resp.status_code, resp.headers)
+            body = [] if lifetime else None
+            size = 0
+            complete = False
+
+            def chunks():
+                nonlocal body, size, error, complete
+                try:
+                    for chunk in resp.iter_content(FETCH_CHUNK):
+                        shared.publish(chunk)
+                        size += len(chunk)
+                        if body is not None:
+                            body = body if size <= CACHE_MAX_ENTRY else None
+                            if body is not None: body.append(chunk)
+                        yield chunk
+                    complete = True
+                except Exception as e:
+                    error = f"Error reading {url}: {e}"
+                    self._count("errors")
+                    raise
+
+            body_iter = chunks()
+            try:
+                deliver(meta, body_iter)
+                # Our requester may have gone away; followers still need the whole body
+                if shared.readers:
+                    for _ in body_iter: pass
+            except Exception as e:
+                error = error or str(e)
+            finally:
+                self._end(url, shared, meta, error)
+            if complete and error is None and body is not None:
+                self.cache.put(url, meta, b"".join(body), lifetime)
+
+    def _end(self, url, shared, meta, error):
+        shared.set_meta(meta)
+        shared.finish(error)
+        with self.lock:
+            if self.in_flight.get(url) is shared:
+                del self.in_flight[url]
+
+    def _count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def stats(self):
+        with self.lock:
+            c = dict(self.counters, in_flight=len(self.in_flight))
+        c["cache_entries"] = len(self.cache.entries)
+        c["cache_bytes"] = self.cache.bytes
+        return c
@@ -1,17 +1,29 @@
-import requests
+import os
 import json
+import threading
+from collections import OrderedDict
+from modules.http_fetcher import ExitFetcher
+
+# Client side: bodies of the last MAX_RESULTS responses are kept, each up to MAX_BODY bytes
+MAX_RESULTS = 20
+MAX_BODY = 8 * 1024 * 1024
 
 class ProxyModule:
     def __init__(self, node):
         self.node = node
         self.responses = []
+        self.results = OrderedDict()  # request id -> {"url", "status", "headers", "body", "truncated"}
+        self.results_lock = threading.Lock()
+        # Exit side: pooled, cached, bounded upstream fetches
+        self.fetcher = ExitFetcher()
 
     def fetch(self, url):
         """
         Client Side: Send a request through the onion network.
         CRITICAL FIX: We do NOT send our IP address. We send a cryptographic fingerprint.
+        Returns the request id; the response lands in self.results under it.
         """
-        my_fp = self.node.pub_key.decode('utf-8')
+        my_fp = self.node.fingerprint
         
         # Send anonymous request via random peer's circuit
         peers = list(self.node.peers.keys())
@@ -20,13 +32,18 @@ class ProxyModule:
             return
         
         random_peer = peers[0] if len(peers) == 1 else __import__('random').choice(peers)
+        request_id = os.urandom(8).hex()
+        # The response comes back along this request's circuit; the fingerprint
+        # is only used by an exit that got the request without one
         self.node.send_onion_to_peer(random_peer, "proxy", {
             "type": "request",
+            "id": request_id,
             "url": url, 
-            "reply_to_fp": my_fp  # <--- No IP, just a key identity
+            "reply_to_fp": my_fp  # <--- No IP, just a key fingerprint
         })
+        return request_id
 
-    def receive(self, payload):
+    def receive(self, payload, reply=None):
         """
         Handles both acting as an Exit Node (receiving requests)
         and acting as a Client (receiving website data).
@@ -35,41 +52,48 @@ class ProxyModule:
 
         # --- EXIT NODE LOGIC (I am fetching the site for someone else) ---
         if msg_type == "request":
-            url = payload.get('url')
-            reply_to_fp = payload.get('reply_to_fp')
-            
-            try:
-                # 1. Perform the actual web request (Masking the original user)
-                # We use a short timeout to prevent blocking the node
-                resp = requests.get(url, timeout=5)
-                status_msg = f"Fetched {url} [Status: {resp.status_code}] | Size: {len(resp.content)} bytes"
-            except Exception as e:
-                status_msg = f"Error fetching {url}: {str(e)}"
-
-            # 2. Send response back ANONYMOUSLY via a new Onion Circuit
-            # We look up the peer by their fingerprint, not their IP.
-            target_peer_id = self._find_peer_by_key(reply_to_fp)
-            
-            if target_peer_id:
-                self.node.send_onion_to_peer(target_peer_id, "proxy", {
-                    "type": "response", 
-                    "data": status_msg
-                })
+            self._serve_request(payload.get('url'), payload.get('reply_to_fp'), payload.get('id'), reply)
 
-        # --- CLIENT LOGIC (I received the website data I asked for) ---
+        # --- CLIENT LOGIC (a response from an exit that does not stream) ---
         elif msg_type == "response":
             self.responses.append(payload.get('data'))
 
-    def _find_peer_by_key(self, target_pub_key_str):
-        """Helper to map a Public Key Fingerprint back to a Peer ID"""
-        for pid, meta in self.node.peers.items():
-            pub_key = meta.get('pub_key')
-            if not pub_key:
-                continue
-            if isinstance(pub_key, (bytes, bytearray)):
-                pub_key_str = pub_key.decode('utf-8')
-            else:
-                pub_key_str = str(pub_key)
-            if pub_key_str == target_pub_key_str:
-                return pid
-        return None
\ No newline at end of file
+    def _serve_request(self, url, reply_to_fp, request_id=None, reply=None):
+        """
+        Exit side: hands the fetch to the fetcher's worker pool, which streams
+        the response body back as it arrives (or from its cache).
+        """
+        # The response goes back ANONYMOUSLY along the request's own circuit.
+        # Without one we look up the peer by their fingerprint, not their IP.
+        if not url or reply is None and not self.node.find_peer_by_fp(reply_to_fp): return
+
+        def deliver(meta, chunks):
+            self.node.send_reply_stream(reply, reply_to_fp, "proxy", dict(meta, type="response", id=request_id), chunks)
+
+        if not self.fetcher.submit(url, deliver):
+            # Streams back may wait for window credits; never on the thread that delivers them
+            threading.Thread(target=deliver, daemon=True,
+                             args=({"url": url, "status": None, "error": f"Exit busy, {url} not fetched"}, ())).start()
+
+    def receive_stream(self, meta, stream):
+        """Client side: a streamed response. Chunks arrive while the exit is still downloading."""
+        url = meta.get('url')
+        if meta.get('error'):
+            self.responses.append(meta['error'])
+            return
+        body = bytearray()
+        size = 0
+        try:
+            for chunk in stream:
+                size += len(chunk)
+                if len(body) < MAX_BODY:
+                    body += chunk[:MAX_BODY - len(body)]
+            source = " (exit cache)" if meta.get('cached') else " (shared fetch)" if meta.get('shared') else ""
+            self.responses.append(f"Fetched {url} [Status: {meta.get('status')}] | Size: {size} bytes{source}")
+        except (ConnectionError, TimeoutError) as e:
+            self.responses.append(f"Error fetching {url}: {e} (after {size} bytes)")
+        with self.results_lock:
+            self.results[meta.get('id')] = {"url": url, "status": meta.get('status'), "headers": meta.get('headers', {}),
+                                            "body": bytes(body), "truncated": size > len(body)}
+            while len(self.results) > MAX_RESULTS:
+                self.results.popitem(last=False)
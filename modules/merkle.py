@@ -0,0 +1,50 @@
+import hashlib
+
+DIGEST_SIZE = 32
+# Domain separation (as in RFC 6962): a chunk can never hash to the same value
+# as an interior node, and the file id is not the value of any tree node
+LEAF_PREFIX = b"\x00"
+NODE_PREFIX = b"\x01"
+ID_PREFIX = b"\x02"
+
+def leaf_hash(chunk):
+    return hashlib.sha256(LEAF_PREFIX + chunk).digest()
+
+def merkle_root(leaves):
+    """
+    Root over a list of 32-byte chunk digests. Interior nodes are
+    sha256(0x01 + left + right); an odd node at the end of a level is carried up as-is.
+    """
+    if not leaves: return hashlib.sha256(b"").digest()
+    level = list(leaves)
+    while len(level) > 1:
+        nxt = [hashlib.sha256(NODE_PREFIX + level[i] + level[i + 1]).digest() for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2: nxt.append(level[-1])
+        level = nxt
+    return level[0]
+
+def pack_leaves(leaves):
+    return b"".join(leaves)
+
+def unpack_leaves(blob, total):
+    """Splits a `have`/`leaves` blob. Returns None if it does not hold `total` digests."""
+    if not isinstance(blob, (bytes, bytearray)) or len(blob) != total * DIGEST_SIZE: return None
+    return [bytes(blob[i:i + DIGEST_SIZE]) for i in range(0, len(blob), DIGEST_SIZE)]
+
+def file_id(leaves, size):
+    """
+    The 16-hex-char id a file is shared under: sha256(0x02 + size + Merkle root),
+    truncated. Committing the byte size (and so the chunk count) means a peer
+    cannot pass off an interior node, or the root itself, as a shorter leaf list.
+    """
+    return hashlib.sha256(ID_PREFIX + size.to_bytes(8, "big") + merkle_root(leaves)).hexdigest()[:16]
+
+class MerkleVerifier:
+    """Checks downloaded chunks against leaves that were verified against the file id."""
+    def __init__(self, f_hash, leaves, size):
+        if not isinstance(size, int) or not 0 <= size < 2 ** 64 or file_id(leaves, size) != f_hash:
+            raise ValueError(f"Leaves do not match file id {f_hash}")
+        self.leaves = leaves
+
+    def verify(self, idx, chunk):
+        return 0 <= idx < len(self.leaves) and leaf_hash(chunk) == self.leaves[idx]
@@ -0,0 +1,78 @@
+import os
+import threading
+from types import SimpleNamespace
+import pytest
+from core.relay import RelayService
+from core.crypto import generate_session_key, sym_encrypt
+from core.protocol import CODEC_BINARY
+
+NEXT_HOP = ("127.0.0.1", 6001)
+
+class FakeLink:
+    alive = True
+    def send_frame(self, data):
+        pass
+
+@pytest.fixture
+def relay():
+    sent = []
+    done = threading.Event()
+    def send_raw(host, port, msg_type, payload):
+        sent.append((host, port, msg_type, payload))
+        done.set()
+    service = RelayService(SimpleNamespace(send_raw=send_raw))
+    service.sent, service.done = sent, done
+    yield service
+    service.sock.close()
+
+def create(relay, circ_id, key, link):
+    relay._finish_create({"circ_id": circ_id, "key": key, "next_hop": NEXT_HOP,
+                          "next_circ_id": "next-" + circ_id, "data": b""}, (link, CODEC_BINARY))
+    relay.done.wait(2)
+    relay.done.clear()
+
+def test_forged_cell_does_not_move_prev(relay):
+    key, origin, forger = generate_session_key(), FakeLink(), FakeLink()
+    create(relay, "c1", key, origin)
+
+    relay._process_cell({"circ_id": "c1", "data": os.urandom(64)}, (forger, CODEC_BINARY))
+    assert relay.circuits["c1"]["prev"][0] is origin
+
+    # A cell under the circuit's key does rebind (the previous hop reconnected)
+    relay._process_cell({"circ_id": "c1", "data": sym_encrypt(key, b"x")}, (forger, CODEC_BINARY))
+    assert relay.circuits["c1"]["prev"][0] is forger
+
+def test_duplicate_create_is_rejected(relay):
+    key, origin = generate_session_key(), FakeLink()
+    create(relay, "c1", key, origin)
+    entry = relay.circuits["c1"]
+
+    relay._finish_create({"circ_id": "c1", "key": generate_session_key(), "next_hop": None,
+                          "next_circ_id": None, "data": b""}, (FakeLink(), CODEC_BINARY))
+    assert relay.circuits["c1"] is entry
+    assert entry["key"] == key and entry["prev"][0] is origin
+
+def test_pending_cells_stay_within_global_bound(relay):
+    data = memoryview(bytearray(1024))
+    for i in range(3 * RelayService.MAX_PENDING_TOTAL):
+        relay._process_cell({"circ_id": f"unknown-{i % 100}", "data": data}, (FakeLink(), CODEC_BINARY))
+    assert relay.pending_count == RelayService.MAX_PENDING_TOTAL
+    assert relay.pending_count == sum(len(held) for held in relay.pending_cells.values())
+    assert relay.pending_bytes <= RelayService.MAX_PENDING_BYTES
+    # Held cells are copies, not views pinning the received frame
+    assert all(type(cell["data"]) is bytes for held in relay.pending_cells.values() for _, cell, _ in held)
+
+def test_pending_cells_byte_bound(relay):
+    data = bytes(512 * 1024)
+    for i in range(32):
+        relay._process_cell({"circ_id": f"unknown-{i}", "data": data}, (FakeLink(), CODEC_BINARY))
+    assert relay.pending_bytes <= RelayService.MAX_PENDING_BYTES
+
+def test_stale_pending_cells_expire_on_insert(relay):
+    relay._process_cell({"circ_id": "old", "data": b"x"}, (FakeLink(), CODEC_BINARY))
+    held = relay.pending_cells["old"]
+    held[0] = (held[0][0] - RelayService.PENDING_CELL_TTL - 1,) + held[0][1:]
+
+    relay._process_cell({"circ_id": "new", "data": b"y"}, (FakeLink(), CODEC_BINARY))
+    assert "old" not in relay.pending_cells
+    assert relay.pending_count == 1 and relay.pending_bytes == 1
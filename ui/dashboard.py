@@ -52,6 +52,24 @@ def render_dashboard(node):
                     except ValueError:
                         pass
 
+        with st.expander("Traffic Shaping"):
+            with st.form("traffic_shaping"):
+                st.caption("Outbound rate limits in KB/s (0 = unlimited). Applied immediately.")
+                config = node.scheduler.config()
+                peer_kbps = st.number_input("Per peer", min_value=0, value=int((config["peer_rate"] or 0) / 1024))
+                module_kbps = {
+                    module: st.number_input(f"Module: {module}", min_value=0,
+                                            value=int(config["module_rates"].get(module, 0) / 1024))
+                    for module in node.modules
+                }
+                if st.form_submit_button("Apply"):
+                    node.scheduler.configure(peer_rate=peer_kbps * 1024,
+                                             module_rates={m: kbps * 1024 for m, kbps in module_kbps.items()})
+                    st.success("Limits updated.")
+
+        with st.expander("Relay Stats"):
+            st.json(node.stats())
+
         if st.button("Refresh Network"):
             st.rerun()
 
@@ -12,4 +12,4 @@ def render_chat(node):
     # Display
     st.write("---")
     for m in reversed(node.modules['chat'].messages):
-        st.text(f"[{m['ts']}] {m['text']}")
+        st.text(f"[{m['ts']}] <{m.get('sender_fp', '?')[:8]}> {m['text']}")
@@ -12,3 +12,12 @@ def render_proxy(node):
     st.write("Exit Node Logs:")
     for resp in node.modules['proxy'].responses:
         st.code(resp)
+
+    results = list(node.modules['proxy'].results.values())
+    if results:
+        latest = results[-1]
+        with st.expander(f"Last response: {latest['url']} [{latest['status']}]"):
+            st.json(latest['headers'])
+            st.code(latest['body'][:4096].decode('utf-8', errors='replace'))
+            if latest['truncated'] or len(latest['body']) > 4096:
+                st.caption(f"Showing the first 4 KB of {len(latest['body'])} bytes kept.")
@@ -7,8 +7,8 @@ def render_torrent(node):
     st.markdown("### 📤 Seed a File")
     uploaded = st.file_uploader("Choose a file to seed", label_visibility="collapsed")
     if uploaded and st.button("Seed File"):
-        data = uploaded.read()
-        f_hash = node.modules['torrent'].add_file(uploaded.name, data)
+        # Pass the file object through; the module streams it chunk by chunk
+        f_hash = node.modules['torrent'].add_file(uploaded.name, uploaded)
         st.success(f"Seeding! Share this Magnet Hash:")
         st.code(f_hash)
 
@@ -32,25 +32,32 @@ def render_torrent(node):
     if not node.modules['torrent'].files:
         st.caption("No files yet.")
     
-    for f_hash, meta in node.modules['torrent'].files.items():
+    for f_hash, meta in list(node.modules['torrent'].files.items()):
         with st.expander(f"📄 {meta['name']}"):
             st.caption(f"Hash: {f_hash}")
             st.caption(f"Size: {meta['size']} bytes")
             
-            # Fix: Define chunks_dict by accessing the module's chunk storage
-            if f_hash in node.modules['torrent'].chunks:
-                chunks_dict = node.modules['torrent'].chunks[f_hash]
-                
-                # Only allow saving to disk if we have all the parts
-                if len(chunks_dict) == meta['total']: 
-                    # Assemble chunks in order
-                    data = b"".join(chunks_dict[i] for i in sorted(chunks_dict.keys()))
+            have = node.modules['torrent'].chunk_count(f_hash)
+
+            # Only allow saving to disk if we have all the parts. The file is read
+            # only after "Save to Disk" is asked for, not on every rerun of the page
+            prepared = f"save_{f_hash}"
+            if have == meta['total'] and st.session_state.get(prepared):
+                with node.modules['torrent'].open_file(f_hash) as f:
                     st.download_button(
-                        label="Save to Disk",
-                        data=data,
-                        file_name=meta['name']
+                        label="⬇️ Download",
+                        data=f.read(),
+                        file_name=meta['name'],
+                        on_click=lambda key=prepared: st.session_state.pop(key, None)
                     )
-                else:
-                    progress = len(chunks_dict) / meta['total']
-                    st.progress(progress)
-                    st.caption(f"Downloading... {len(chunks_dict)}/{meta['total']} chunks")
\ No newline at end of file
+            elif have == meta['total']:
+                if st.button("Save to Disk", key=f"prepare_{f_hash}"):
+                    st.session_state[prepared] = True
+                    st.rerun()
+            elif meta['total']:
+                st.progress(have / meta['total'])
+                st.caption(f"Downloading... {have}/{meta['total']} chunks")
+
+            if st.button("🗑️ Remove", key=f"rm_{f_hash}", help="Stop seeding and free its storage"):
+                node.modules['torrent'].remove_file(f_hash)
+                st.rerun()
\ No newline at end of file